@@ -2,10 +2,12 @@ import os
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-from datetime import datetime
 from scipy import interpolate
 import matplotlib.pyplot as plt
 import re
+import json
+from collections import OrderedDict
+from functools import partial
 
 propToDrop=['quality_category','system:index', '.geo','order_id', 'pixel_resolution','gsd','provider', 'published', 'publishing_stage', 'item_type', 'item_id', 'snow_ice_percent', 'strip_id','updated']
 maxRank = 4 # exclude altitude levels above this
@@ -14,14 +16,37 @@ forMerge=['ident','weekdayThisAreaIsActive','date','mktDay','mktID','locGroup','
 patterns_to_drop = ['ground_control','strictnessRank', 'subStrictnessRank''Geography','origName_', 'coorLength_', '.geo', 'system:index_b0', 'system:index', 'weekday_','market']
 _startDateNorm='2018-01-01'
 _endDateNorm='2018-12-31'
-
-
-def prepare_properties(locGroup, loc, propToDrop):  
+shapeCacheSize = 256 # number of markets whose shapes are kept in memory
+shapeCacheDir = None # optional folder for GeoParquet copies of the market shapefiles (requires pyarrow)
+_shapeCache = OrderedDict()
+intermediateStoreDir = os.path.join('..', 'datasets', 'intermediate_store') # Parquet copies of the GEE exports, partitioned by locGroup/loc
+measuresColumns = ['ident', 'strictnessRank', 'subStrictnessRank', 'weekdayShp', 'sumsum', 'ccount'] # columns of the measures export used downstream
+minRankFloor = 30 # the least strict rank kept is the strictest rank of the export, but at least this
+measuresDtypes = {'ident': 'string', 'strictnessRank': 'float32', 'subStrictnessRank': 'float32', 'weekdayShp': 'float32', 'sumsum': 'float64', 'ccount': 'float64'}
+wideDtype = 'float64' # dtype of the (image x area) blocks of the wide frame; float32 halves their memory but moves activity_measure_norm by up to ~1e-3
+propertiesKind = 'properties' # image properties from the GEE export, or 'metadata' for the property tables of the download step
+metadataTableDir = os.path.join('.', 'temp', 'imgProperties') # property tables of the download step (metadata_table_dir of download_imagery), {loc}.parquet
+activityStateDir = os.path.join('..', 'datasets', 'activity_state') # per-market state of activity_processor_incremental
+statsTolerance = 0.005 # change of the outlier statistics and normalization means beyond which activity_processor_incremental recomputes a market in full, see normalization_moved
+identFormats = { # regex capturing (date, time) from the start of an image id, and the format of date+time
+    'YYYYMMDD_HHMMSS': (r'^(\d{8})_(\d{6})', '%Y%m%d%H%M%S'),
+    'N_YYYYMMDD_HHMMSS': (r'^.{2}(\d{8})_(\d{6})', '%Y%m%d%H%M%S'),
+    'YYMMDD_HHMMSS': (r'^(\d{6})_(\d{6})', '%y%m%d%H%M%S'),
+    'N_YYMMDDHHMMSS': (r'^.{2}(\d{6})(\d{6})', '%y%m%d%H%M%S'),
+}
+
+
+def prepare_properties(locGroup, loc, propToDrop, kind='properties', idents=None):  
+    # idents: only prepare the properties of these images
+    # kind: 'properties' for the GEE export, 'metadata' for the image property table of the download step
+    # (process_json_files, read from {metadataTableDir}/{loc}.parquet, or a copy of gs://<bucket>/imgProperties/{loc}.parquet placed there)
     
-    prop_path = os.path.join('..', 'datasets', 'intermediate_outputs', f'{locGroup}_properties_propEx_{locGroup}_{loc}.csv')
-    df_prop = pd.read_csv(prop_path)
+    # only load the properties we keep, plus the image id
+    df_prop = read_intermediate(kind, locGroup, loc, columns=lambda col: (col not in propToDrop and col not in ['image_ID', 'geometry']) or col == 'system:index')
     # Extract 'ident' from 'system:index' column
     df_prop['ident'] = df_prop['system:index'].str.slice(stop=23) 
+    if idents is not None:
+        df_prop = df_prop[df_prop['ident'].isin(idents)].copy()
     # Determine the imagery generation of each image
     df_prop['instrument'] = df_prop.apply(determine_sensor, axis=1)
         
@@ -33,6 +58,73 @@ def prepare_properties(locGroup, loc, propToDrop):
             pass
     return df_prop  
 
+def intermediate_csv_path(kind, locGroup, loc): # path of the GEE export of a market ('measures' or 'properties')
+    if kind == 'measures':
+        file_name = f'{locGroup}_measures_exportAct5_maxpMax{loc}_w7.csv'
+    elif kind == 'properties':
+        file_name = f'{locGroup}_properties_propEx_{locGroup}_{loc}.csv'
+    else: # tables that only exist in the Parquet store
+        file_name = f'{locGroup}_{kind}_{loc}.csv'
+    return os.path.join('..', 'datasets', 'intermediate_outputs', file_name)
+
+def intermediate_parquet_path(kind, locGroup, loc): # path of the Parquet copy of the export in the intermediate store
+    if kind == 'metadata': # the property table of the download step is read where process_json_files writes it
+        return os.path.join(metadataTableDir, f'{loc}.parquet')
+    return os.path.join(intermediateStoreDir, kind, f'locGroup={locGroup}', f'loc={loc}', 'part-0.parquet')
+
+def convert_intermediate_to_parquet(locGroup, loc, kinds=('measures', 'properties')):
+    # Convert the CSV exports of a market to typed Parquet. Measures are pruned to measuresColumns,
+    # properties are small and kept in full so that changes to propToDrop do not require a re-conversion.
+    paths = []
+    for kind in kinds:
+        if kind == 'measures':
+            df = pd.read_csv(intermediate_csv_path(kind, locGroup, loc), usecols=measuresColumns, dtype=measuresDtypes)
+        else:
+            df = pd.read_csv(intermediate_csv_path(kind, locGroup, loc))
+        pq_path = intermediate_parquet_path(kind, locGroup, loc)
+        os.makedirs(os.path.dirname(pq_path), exist_ok=True)
+        df.to_parquet(pq_path, index=False)
+        paths.append(pq_path)
+    return paths
+
+def convert_intermediate_outputs(folder=os.path.join('..', 'datasets', 'intermediate_outputs')):
+    # Convert all measures/properties exports found in the folder to the Parquet store
+    converted = []
+    for file_name in sorted(os.listdir(folder)):
+        match = re.match(r'^(.+)_measures_exportAct5_maxpMax(.+)_w7\.csv$', file_name)
+        if match:
+            locGroup, loc = match.groups()
+            try:
+                converted.extend(convert_intermediate_to_parquet(locGroup, loc))
+            except Exception as e:
+                print(f'problem converting {locGroup} {loc}', e)
+    return converted
+
+def iter_intermediate(kind, locGroup, loc, columns=None, chunksize=500000):
+    # Same as read_intermediate, but yields the export in chunks of chunksize rows
+    csv_path = intermediate_csv_path(kind, locGroup, loc)
+    pq_path = intermediate_parquet_path(kind, locGroup, loc)
+    dtype = measuresDtypes if kind == 'measures' else None
+    if os.path.isfile(pq_path) and (not os.path.isfile(csv_path) or os.path.getmtime(pq_path) >= os.path.getmtime(csv_path)):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(pq_path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas().astype({col: t for col, t in (dtype or {}).items() if col in batch.schema.names})
+    else:
+        yield from pd.read_csv(csv_path, usecols=columns, dtype=dtype, chunksize=chunksize)
+
+def read_intermediate(kind, locGroup, loc, columns=None):
+    # Read a market export from the Parquet store if it has a copy that is not older than the CSV, from the CSV otherwise.
+    # columns: list of columns or a function of the column name; only those columns are loaded.
+    csv_path = intermediate_csv_path(kind, locGroup, loc)
+    pq_path = intermediate_parquet_path(kind, locGroup, loc)
+    if os.path.isfile(pq_path) and (not os.path.isfile(csv_path) or os.path.getmtime(pq_path) >= os.path.getmtime(csv_path)):
+        if callable(columns):
+            import pyarrow.parquet as pq
+            columns = [col for col in pq.read_schema(pq_path).names if columns(col)]
+        return pd.read_parquet(pq_path, columns=columns)
+    dtype = measuresDtypes if kind == 'measures' else None
+    return pd.read_csv(csv_path, usecols=columns, dtype=dtype)
+
 def determine_sensor(row):
     image_id = row['ident']
     condition1 = '3B' in image_id[-2:]
@@ -48,67 +140,76 @@ def prepend_zero_if_single_digit(value):
     else:
         return str(value)
 
+def parse_ident_timestamps(idents): # parse acquisition date and time from image ids that come in several formats
+    # Some exports have band names starting with 1_ or 2_, not the date. Comes from merge of two image collections ic_old and ic_new.
+    # Each row is matched against the formats in order and parsed with the first one that yields a valid timestamp.
+    idents = idents.astype(str)
+    timestamps = pd.Series(pd.NaT, index=idents.index, dtype='datetime64[ns]')
+    formats = pd.Series('unparsed', index=idents.index, dtype=object)
+    for name, (pattern, fmt) in identFormats.items():
+        todo = timestamps.isna()
+        parts = idents[todo].str.extract(pattern).dropna()
+        if parts.empty:
+            continue
+        parsed = pd.to_datetime(parts[0] + parts[1], format=fmt, errors='coerce').dropna()
+        timestamps.loc[parsed.index] = parsed
+        formats.loc[parsed.index] = name
+    return timestamps, formats
+
 def infoVars(df, mktID, locGroup, country): # assign info variables based on date and location
     df['mktID'] = mktID
     df['locGroup'] = locGroup
     df['country'] = country
-    try: # Necessary because some exports have band names starting with 1_ or 2_, not the date. Comes from merge of two image collections ic_old and ic_new
-        df['date'] = pd.to_datetime(df['ident'].apply(lambda x: datetime.strptime(x[:8], "%Y%m%d").date()))
-        df['time'] = df['ident'].apply(lambda x: datetime.strptime(x[9:15], "%H%M%S").time())
-    except:         
-        try:
-            df['date'] = pd.to_datetime(df['ident'].apply(lambda x: datetime.strptime(x[2:10], "%Y%m%d").date()))
-            df['time'] = df['ident'].apply(lambda x: datetime.strptime(x[11:17], "%H%M%S").time())
-        except:
-            try:         
-                df['date'] = pd.to_datetime(df['ident'].apply(lambda x: datetime.strptime(x[0:6], "%y%m%d").date()))
-                df['time'] = df['ident'].apply(lambda x: datetime.strptime(x[7:13], "%H%M%S").time())
-            except:
-                try:
-                    df['date'] = pd.to_datetime(df['ident'].apply(lambda x: datetime.strptime(x[2:8], "%y%m%d").date()))
-                    df['time'] = df['ident'].apply(lambda x: datetime.strptime(x[8:14], "%H%M%S").time())
-                except Exception as e:
-                    print("not a valid date format", e)
-                    pass
-        
+    timestamps, formats = parse_ident_timestamps(df['ident'])
+    if (formats == 'unparsed').any():
+        print('ident formats', formats.value_counts().to_dict())
+        print("not a valid date format", df.loc[formats == 'unparsed', 'ident'].unique()[:5].tolist())
+
+    df['date'] = timestamps.dt.normalize()
+    df['time'] = timestamps.dt.time
     df['year'] = df['date'].dt.year
     df['month'] = df['date'].dt.month
-    df['time_decimal'] = df['time'].apply(lambda t: t.hour + t.minute / 60 + t.second / 3600)
+    df['time_decimal'] = timestamps.dt.hour + timestamps.dt.minute / 60 + timestamps.dt.second / 3600
     df['weekday'] = (df['date'].dt.weekday + 1) % 7
-    df['mkt_lat'] = pd.to_numeric(df['mktID'].str.extract(r'lon(-?\d+)_(\d+)').apply(lambda x: f"{x[0]}.{x[1]}", axis=1))
-    df['mkt_lon'] = pd.to_numeric(df['mktID'].str.extract(r'lat(-?\d+)_(\d+)').apply(lambda x: f"{x[0]}.{x[1]}", axis=1))
+    df['mkt_lat'], df['mkt_lon'] = mktID_coords(df['mktID'], country)
+    return df
+
+def mktID_coords(mktID, country): # market coordinates (lat, lon) parsed from market ids such as lon38_0000lat13_0000
+    mktID = pd.Series(mktID)
+    lat = mktID.str.extract(r'lon(-?\d+)_(\d+)')
+    lon = mktID.str.extract(r'lat(-?\d+)_(\d+)')
+    mkt_lat = pd.to_numeric(lat[0] + '.' + lat[1])
+    mkt_lon = pd.to_numeric(lon[0] + '.' + lon[1])
+    origLat = mkt_lat.copy()
     if country=="Kenya": # For some locations in Kenya, the lon and lat coordinates were flipped in their mktid
-        df['origLat'] = df['mkt_lat']
-        df.loc[df['mkt_lat'] > 30, 'mkt_lat'] = df['mkt_lon']
-        df.loc[df['mkt_lon'] < 30, 'mkt_lon'] = df['origLat']
-        df.drop(columns=['origLat'], inplace=True)
+        mkt_lat[origLat > 30] = mkt_lon
+        mkt_lon[mkt_lon < 30] = origLat
     if country=="Ethiopia": # For some locations in Ethiopia, the lon and lat coordinates were flipped in their mktid
-        df['origLat'] = df['mkt_lat']
-        df.loc[df['mkt_lat'] > 20, 'mkt_lat'] = df['mkt_lon']
-        df.loc[df['mkt_lon'] < 20, 'mkt_lon'] = df['origLat']
-        df.drop(columns=['origLat'], inplace=True)
-    return df
+        mkt_lat[origLat > 20] = mkt_lon
+        mkt_lon[mkt_lon < 20] = origLat
+    return mkt_lat, mkt_lon
+
+def identifyMktDays(loc, df, minRank, by=None, localMktDays=None): # identify market days based on detected areas and their threshold values
+    # by: column identifying the market of each row (e.g. 'mktID') to classify several markets in one call
+    # localMktDays: weekdays found to be market days earlier (e.g. in the previous run of the market), used instead of detecting them in df
+    keys = [by] if by else []
+
+    if localMktDays is None:
+        # List all maximum threshold values on the days-of-week where we detected something and that detection falls below a threshold 
+        min_thres_by_day = df.groupby(keys + ['weekdayThisAreaIsActive'])['strictnessRank'].min()
+        # Find the clearest detection 
+        lowest_thres = min_thres_by_day.groupby(level=by).transform('min') if by else min_thres_by_day.min()
+        # Filter unique days of week where the threshold is within 3 ranks of the lowest threshold value -> identifies all similarly high detections
+        localMktDays = min_thres_by_day[min_thres_by_day - lowest_thres <= 3].index
+    if by:
+        onMktWeekday = pd.MultiIndex.from_arrays([df[by], df['weekday']]).isin(localMktDays)
+    else:
+        onMktWeekday = df['weekday'].isin(localMktDays).to_numpy()
+    onActiveWeekday = (df['weekday'] == df['weekdayThisAreaIsActive']).to_numpy()
 
-def identifyMktDays(loc, df, minRank): # identify market days based on detected areas and their threshold values
-    
-    # List all maximum threshold values on the days-of-week where we detected something and that detection falls below a threshold 
-    min_thres_by_day = df.groupby('weekdayThisAreaIsActive')['strictnessRank'].min()
-    #print('strictness rank and active weekdays',min_thres_by_day)
-    # Find the clearest detection 
-    lowest_thres = min_thres_by_day.min()
-    #print('lowest strictness rank',lowest_thres)
-    # Filter unique days of week where the threshold is within 3 ranks of the lowest threshold value -> identifies all similarly high detections
-    localMktDays = list(min_thres_by_day[min_thres_by_day - lowest_thres <= 3].index.unique())
-    def find_position(weekday):
-        try:
-            return list(localMktDays).index(weekday)
-        except ValueError:
-            return -1  # Return 0 if the weekday is not found in the list
-    df['pos'] = df['weekday'].apply(find_position)
-    df['mktDay'] = None
-    df.loc[(df['weekday'] == df['weekdayThisAreaIsActive']) & (df['pos'] >= 0), 'mktDay'] = 1 # detected market day
-    df.loc[ (df['pos'] == -1), 'mktDay'] = 0 # detected non-market day
-    df.loc[(df['weekday'] != df['weekdayThisAreaIsActive']) & (df['pos'] >= 0), 'mktDay'] = 99 # observation of detected market area for a given weekday on a different weekday
+    # 1: detected market day, 0: detected non-market day,
+    # 99: observation of detected market area for a given weekday on a different weekday
+    df['mktDay'] = np.where(onMktWeekday, np.where(onActiveWeekday, 1, 99), 0).astype('int64')
     return df
 
 def drop_columns_by_pattern(df, patterns_to_drop):
@@ -119,51 +220,80 @@ def drop_columns_by_pattern(df, patterns_to_drop):
             print(f"Error occurred while dropping columns for pattern '{pattern}': {e}")
     return df
 
-def cleanActMeasures(df, geos, varsOfInterest): 
-    # Set values to NA that exceed the median value per market, weekday of operation
-    # and instrument by more than twice the IQR , calculated over the period 
-    # outside Covid and for typical times and good images
-
-    df['median_time'] = df.groupby('instrument')['time_decimal'].transform('median')
-    df['diff_to_median_time'] = abs(df['time_decimal'] - df['median_time'])
-    mask = (
+def excluded_dates(df, diff_to_median_time): # images left out of the outlier statistics
+    return (
         (df['date'].between('2020-03-01', '2021-02-28')) | # potentially covid-affected
         (df['date'] < '2018-01-01') |                      # generally noisier because of sparse imagery
-        (df['diff_to_median_time'] > .5) |                  # differing sun angle
+        (diff_to_median_time > .5) |                       # differing sun angle
         ((df['clear_percent'].notnull()) & (df['clear_percent'] < 10)) | # noisy imagery
         ((df['cloud_percent'].notnull()) & (df['cloud_percent'] > 50))
     )
+
+def stat_rows(table, df, keys): # align a table of group statistics to the rows of df
+    index = pd.MultiIndex.from_arrays([df[k].astype('int64') if k != 'instrument' else df[k] for k in keys])
+    return table.reindex(index).to_numpy()
+
+def area_values(df, geos, varsOfInterest): # one column per (variable, area), with sums converted into mean deviations
+    geos = [b for b in geos if f'sumsum_maxpMax_{b}' in df.columns and f'ccount_maxpMax_{b}' in df.columns]
+    count_cols = [f'ccount_maxpMax_{b}' for b in geos]
+    cols = [f'{p}_maxpMax_{b}' for p in varsOfInterest for b in geos]
+    values = df[cols].to_numpy(dtype='float64', na_value=np.nan)
+    counts = df[count_cols].to_numpy(dtype='float64', na_value=np.nan)
+    for i, p in enumerate(varsOfInterest):
+        if p == 'sumsum':
+            values[:, i * len(geos):(i + 1) * len(geos)] /= counts
+    return geos, cols, count_cols, values, counts
+
+def outlier_statistics(df, geos, varsOfInterest): 
+    # Statistics used by cleanActMeasures, computed over the wide rows in df: median acquisition time by instrument,
+    # typical footprint by weekday of operation and market day, and median and IQR by weekday of operation, market day and instrument
+    median_time = df.groupby('instrument')['time_decimal'].median()
+    incl = ~excluded_dates(df, abs(df['time_decimal'] - df['instrument'].map(median_time)))
+    geos, cols, count_cols, values, counts = area_values(df, geos, varsOfInterest)
+
+    keys = [df['weekdayThisAreaIsActive'].astype('int64'), df['mktDay'].astype('int64')]
+    max_count = pd.DataFrame(counts, columns=count_cols, index=df.index).where(incl).groupby(keys).max()
+
+    # set to NA those values coming from images that cover less than 50% of the typical footprint
+    small_footprint = counts < 0.5 * stat_rows(max_count, df, ['weekdayThisAreaIsActive', 'mktDay'])
+    values[np.tile(small_footprint, len(varsOfInterest))] = np.nan
+
+    grouped = pd.DataFrame(values, columns=cols, index=df.index).where(incl).groupby(keys + [df['instrument']])
+    median = grouped.median()
+    iqr = grouped.quantile(0.75) - grouped.quantile(0.25)
+    return {'median_time': median_time, 'max_count': max_count, 'median': median, 'iqr': iqr}
+
+def cleanActMeasures(df, geos, varsOfInterest, stats=None): 
+    # Set values to NA that exceed the median value per market, weekday of operation
+    # and instrument by more than twice the IQR , calculated over the period 
+    # outside Covid and for typical times and good images.
+    # The statistics are computed from df unless given (e.g. those stored from a previous run, see outlier_statistics)
+    if stats is None:
+        stats = outlier_statistics(df, geos, varsOfInterest)
+
+    df['median_time'] = df['instrument'].map(stats['median_time'])
+    df['diff_to_median_time'] = abs(df['time_decimal'] - df['median_time'])
     # Create a new column 'exclDates' based on the mask
-    df['exclDates'] = mask.astype(int)
-    for b in geos: # within each possible area
-        df[f'sumsum_maxpMax_{b}'] = df[f'sumsum_maxpMax_{b}'] / df[f'ccount_maxpMax_{b}'] # convert sum variable into mean deviations
+    df['exclDates'] = excluded_dates(df, df['diff_to_median_time']).astype(int)
 
-        # Typical number of pixels per shape
-        max_count = df.loc[df['exclDates'] != 1].groupby(['weekdayThisAreaIsActive', 'mktDay'])[f'ccount_maxpMax_{b}'].max().reset_index()
-        df = pd.merge(df, max_count, on=[ 'weekdayThisAreaIsActive', 'mktDay'], how='outer', suffixes=('', '_max_count'))        
+    geos, cols, count_cols, values, counts = area_values(df, geos, varsOfInterest)
 
-        for p in varsOfInterest:
-            try:
-                # set to NA those values coming from images that cover less than 50% of the typical footprint
-                df.loc[df[f'ccount_maxpMax_{b}']  < 0.5 *(df[f'ccount_maxpMax_{b}_max_count']), f'{p}_maxpMax_{b}'] = pd.NA
-
-                # calculate median, iqr by detected area and sensor, and merge to dataframe
-                median = df.loc[df['exclDates'] != 1].groupby(['weekdayThisAreaIsActive', 'mktDay', 'instrument'])[f'{p}_maxpMax_{b}'].quantile(0.5).reset_index()
-                df = pd.merge(df, median, on=[ 'weekdayThisAreaIsActive', 'mktDay', 'instrument'], how='outer', suffixes=('', '_median'))
-
-                p25 = df.loc[df['exclDates'] != 1].groupby(['weekdayThisAreaIsActive', 'mktDay', 'instrument'])[f'{p}_maxpMax_{b}'].quantile(0.25)
-                p75 = df.loc[df['exclDates'] != 1].groupby(['weekdayThisAreaIsActive', 'mktDay', 'instrument'])[f'{p}_maxpMax_{b}'].quantile(0.75)
-                iqr = (p75-p25).reset_index()
-                df = pd.merge(df, iqr, on=[ 'weekdayThisAreaIsActive', 'mktDay', 'instrument'], how='outer', suffixes=('', '_iqr'))
-                
-                # set to NA those values that are more than twice the IQR above the median
-                df.loc[df[f'{p}_maxpMax_{b}']  > (df[f'{p}_maxpMax_{b}_median'] + 2 * df[f'{p}_maxpMax_{b}_iqr']), f'{p}_maxpMax_{b}'] = pd.NA
-                df = df.drop([f'{p}_maxpMax_{b}_median', f'{p}_maxpMax_{b}_iqr'], axis=1)    
+    # Typical number of pixels per shape
+    max_count = stat_rows(stats['max_count'].reindex(columns=count_cols), df, ['weekdayThisAreaIsActive', 'mktDay'])
+    df[[f'{col}_max_count' for col in count_cols]] = max_count
 
-            except Exception as e:
-                print('Error in cleanActMeasures', e)
-                pass
-    return df
+    # set to NA those values coming from images that cover less than 50% of the typical footprint
+    values[np.tile(counts < 0.5 * max_count, len(varsOfInterest))] = np.nan
+
+    # set to NA those values that are more than twice the IQR above the median by detected area and sensor
+    keys = ['weekdayThisAreaIsActive', 'mktDay', 'instrument']
+    median = stat_rows(stats['median'].reindex(columns=cols), df, keys)
+    iqr = stat_rows(stats['iqr'].reindex(columns=cols), df, keys)
+    values[values > median + 2 * iqr] = np.nan
+    df[cols] = values
+
+    # order rows by detected area, market day and sensor
+    return df.sort_values(['weekdayThisAreaIsActive', 'mktDay', 'instrument'], kind='stable').reset_index(drop=True)
 
 def identify_varying_areas(wide_df, locGroup,loc): # Identify the largest ring in which P75 non-market day activity still does not exceed P50 market day activity
     market_days = wide_df.loc[wide_df['mktDay'] == 1, 'weekday'].unique().tolist()
@@ -221,6 +351,32 @@ def identify_varying_areas(wide_df, locGroup,loc): # Identify the largest ring i
     else:
         return pd.DataFrame(),pd.DataFrame()
 
+def load_market_shapes(locGroup, loc): # read the shapes of a market once and index them by (weekdayShp, strictness, subStrictn)
+    key = (locGroup, loc)
+    if key in _shapeCache:
+        _shapeCache.move_to_end(key)
+        return _shapeCache[key]
+
+    # load shapefile using relative path, or its GeoParquet copy if a cache folder is set and the copy is up to date
+    shp_path = os.path.join('..', 'datasets', 'intermediate_outputs', f'{locGroup}_shapes_shp_MpM6_{locGroup}{loc}.shp')
+    gdf = None
+    if shapeCacheDir:
+        pq_path = os.path.join(shapeCacheDir, f'{locGroup}_shapes_{loc}.parquet')
+        if os.path.isfile(pq_path) and (not os.path.isfile(shp_path) or os.path.getmtime(pq_path) >= os.path.getmtime(shp_path)):
+            gdf = gpd.read_parquet(pq_path)
+    if gdf is None:
+        gdf = gpd.read_file(shp_path)
+        if shapeCacheDir:
+            os.makedirs(shapeCacheDir, exist_ok=True)
+            gdf.to_parquet(pq_path)
+
+    shapes = {key_shp: group for key_shp, group in gdf.groupby(['weekdayShp', 'strictness', 'subStrictn'])}
+    _shapeCache[key] = (gdf.iloc[:0], shapes)
+    # keep only the most recently used markets in memory
+    while len(_shapeCache) > shapeCacheSize:
+        _shapeCache.popitem(last=False)
+    return _shapeCache[key]
+
 def select_areas(market_day, first_row_index, locGroup, loc): #select the shapes associated with the selected market area
     # extract substring between second last and last instance of _
     temp = first_row_index.split('_')
@@ -228,12 +384,9 @@ def select_areas(market_day, first_row_index, locGroup, loc): #select the shapes
         minRing =  int(temp[-2])
     else:
         minRing = None  # Return None if there aren't enough parts
-    # load shapefile using relative path
-    shp_path = os.path.join('..', 'datasets', 'intermediate_outputs', f'{locGroup}_shapes_shp_MpM6_{locGroup}{loc}.shp')
-    gdf = gpd.read_file(shp_path)    
-    filtered_gdf = gdf[(gdf['weekdayShp'] == market_day) & 
-                   (gdf['strictness'] == minRing) & 
-                   (gdf['subStrictn'] == 100)].copy()
+    # look up the shapes of this market, indexed by (weekdayShp, strictness, subStrictn)
+    empty_gdf, shapes = load_market_shapes(locGroup, loc)
+    filtered_gdf = shapes.get((market_day, minRing, 100), empty_gdf).copy()
     #filtered_gdf.plot()
     filtered_gdf.loc[:, 'mktid'] = loc  # Use .loc to set values
     return filtered_gdf
@@ -246,6 +399,21 @@ def getActivityMeans(df, loc, startDate, endDate):
     #convert dates to datetime format
     startDate = pd.to_datetime(startDate)
     endDate = pd.to_datetime(endDate)    
+    allActivity = activity_for_means(df)
+    
+    # Apply  smoothing for each group separately
+#     print(f'getting mean_nonmktday, initial upload for {loc}')
+    mean_nonmktday = nonmktday_means(allActivity)
+    allActivity = pd.merge(allActivity, mean_nonmktday, on=['weekdayThisAreaIsActive', 'instrument'], how='outer', suffixes=('', '_mean_nonmktday'))
+    
+#     print(f'getting activity_measure_mean0_mean_mktday, initial upload for {loc}')
+    # Zero the market data by subtracting nonmarket average, calculate mean within reference range
+    allActivity['activity_measure_mean0'] = allActivity['activity_measure'] - allActivity['activity_measure_mean_nonmktday']
+    mean_mktday = smooth_means(allActivity[allActivity['mktDay']==1], 'activity_measure_mean0', startDate, endDate)
+    
+    return mean_nonmktday, mean_mktday
+
+def activity_for_means(df): # PS2 activity rows the normalization means are computed from
     #cols to merge
     cols = ['mktID', 'instrument', 'ident', 'weekdayThisAreaIsActive', 'mktDay', 'activity_measure', 'date']
     allActivity=df[cols]
@@ -257,19 +425,10 @@ def getActivityMeans(df, loc, startDate, endDate):
     allActivity['mktDay'] = allActivity['mktDay'].astype(int)
 
     allActivity['date'] = pd.to_datetime(allActivity['date'])
-    allActivity = allActivity.sort_values(by='date')
-    
-    # Apply  smoothing for each group separately
-#     print(f'getting mean_nonmktday, initial upload for {loc}')
-    mean_nonmktday = allActivity[allActivity['mktDay']==0].groupby(['weekdayThisAreaIsActive', 'instrument'], group_keys=False).apply(lambda g: interval_mean(g, 'activity_measure'))
-    allActivity = pd.merge(allActivity, mean_nonmktday, on=['weekdayThisAreaIsActive', 'instrument'], how='outer', suffixes=('', '_mean_nonmktday'))
-    
-#     print(f'getting activity_measure_mean0_mean_mktday, initial upload for {loc}')
-    # Zero the market data by subtracting nonmarket average, calculate mean within reference range
-    allActivity['activity_measure_mean0'] = allActivity['activity_measure'] - allActivity['activity_measure_mean_nonmktday']
-    mean_mktday = allActivity[allActivity['mktDay']==1].groupby(['weekdayThisAreaIsActive', 'instrument'], group_keys=False).apply(lambda g: apply_smooth(g,'activity_measure_mean0', startDate, endDate))
-    
-    return mean_nonmktday, mean_mktday
+    return allActivity.sort_values(by='date')
+
+def nonmktday_means(allActivity): # mean non-market day activity by detected area and instrument, over all dates
+    return allActivity[allActivity['mktDay']==0].groupby(['weekdayThisAreaIsActive', 'instrument'], group_keys=False).apply(lambda g: interval_mean(g, 'activity_measure'))
 
 def interval_mean(df, col, lower_q=0.10, upper_q=0.90):
     lower = df[col].quantile(lower_q)
@@ -379,11 +538,112 @@ def apply_smooth(df, y_col="activity_measure", startDate=None, endDate=None, sho
     return result_df
 
 
+def smooth_means(df, y_col="activity_measure", startDate=None, endDate=None, keys=('weekdayThisAreaIsActive', 'instrument')):
+    # Same means as apply_smooth applied to each group of keys, for all groups at once (add 'mktID' to keys to smooth
+    # several markets in one call). Observations are consolidated per date in one pass, splines are only evaluated on
+    # the days the mean is taken over, and groups too small for a spline are interpolated without building a frame
+    keys = list(keys)
+    origin = pd.to_datetime("2000-01-01")
+    df = df[~(df['instrument'].str.contains('.SD', regex=False, na=False) & (df['date'] < '2020-03-01'))]
+    result_df = df[keys].drop_duplicates().dropna().sort_values(keys)
+
+    # Drop NA and consolidate to 1 observation per date, buffered around the date range
+    daily = df.dropna(subset=[y_col]).groupby(keys + ['date'])[y_col].mean().reset_index()
+    if startDate and endDate:
+        daily = daily[daily['date'].between(startDate - pd.Timedelta(days=182), endDate + pd.Timedelta(days=182))]
+        start, end = (startDate - origin).days, (endDate - origin).days
+
+    # groups are contiguous in daily, sorted by date
+    x_all = (daily['date'] - origin).dt.days.to_numpy(dtype=np.int64)
+    y_all = daily[y_col].to_numpy(dtype='float64')
+    group = daily.groupby(keys, sort=False).ngroup().to_numpy()
+    bounds = np.r_[0, np.flatnonzero(np.diff(group)) + 1, len(group)]
+    mktIDs = df.groupby(keys)['mktID'].first() if 'mktID' in df.columns else None
+
+    means = {}
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        key = tuple(daily[keys].iloc[first])
+        x_vals, y_vals = x_all[first:last], y_all[first:last]
+
+        # If the data is too small to generate a spline, use linear interpolation over the days of the date range
+        if len(x_vals) < 10:
+            if startDate and endDate:
+                inside = (x_vals >= start) & (x_vals <= end)
+                days = np.arange(x_vals[inside][0], end + 1) if inside.any() else np.array([])
+                means[key] = np.interp(days, x_vals[inside], y_vals[inside]).mean() if len(days) else np.nan
+            else:
+                means[key] = y_vals.mean()
+            continue
+
+        spl = interpolate.UnivariateSpline(x=x_vals, y=y_vals, s=len(y_vals) * np.var(y_vals) / 1.5)
+        if startDate and endDate:
+            x_eval = np.arange(max(x_vals.min(), start), min(x_vals.max(), end) + 1)
+            y_range = y_vals[(x_vals >= start) & (x_vals <= end)]
+        else:
+            x_eval = np.arange(x_vals.min() + 182, x_vals.max() - 182 + 1)
+            y_range = y_vals
+        means[key] = np.clip(spl(x_eval), np.min(y_vals), a_max=np.max(y_vals)).mean()
+
+        # Mark if there is a concerning difference between simple and smoothed means
+        sd = y_range.std(ddof=1) if len(y_range) > 1 else np.nan
+        if abs(means[key] - y_range.mean()) > sd:
+            loc = mktIDs[key if len(keys) > 1 else key[0]] if mktIDs is not None else ''
+            print(f'Warning: difference between smoothed mean and simple mean for {loc} exceeds the standard deviation.')
+
+    result_df[y_col] = [means.get(tuple(row), np.nan) for row in result_df[keys].itertuples(index=False)]
+    return result_df
+
 def replace_after_underscore(s):
     return s[:s.rfind('_') + 1] + '100'
 
 
-def activity_processor(loc, GEEbucket, locGroup, country):
+def eligible_measures(df, minRank): # keep the rank window and, per strictness rank, the outermost eligible ring and the full shape
+    # keep only entries that fall between the strictest rank we define and the least strict one for a given shape, but at least 30
+    df = df[(df['strictnessRank'] <= minRank) & (df['strictnessRank'] >= maxRank)]
+    df = df[((df['subStrictnessRank'] <= minRank) & (df['subStrictnessRank'] > maxRank)) | (pd.isna(df['subStrictnessRank'])) | (df['subStrictnessRank'] ==100)].copy()
+ 
+    df['subStrictnessRank'] = df['subStrictnessRank'].fillna(100).astype(int)
+
+    eligible_rings = df[df['subStrictnessRank'] != 100].groupby('strictnessRank', as_index=False)['subStrictnessRank'].max()
+    additional_rows = pd.DataFrame({
+        'strictnessRank': df['strictnessRank'].unique(),
+        'subStrictnessRank': 100
+    })
+    eligible_shapes = pd.concat([eligible_rings, additional_rows]).sort_values(by='strictnessRank').reset_index(drop=True)
+
+    return pd.merge(df, eligible_shapes, on=['strictnessRank', 'subStrictnessRank'])
+
+def read_measures_streaming(locGroup, loc, chunksize=500000):
+    # Read the measures export chunk by chunk and only keep rows that can still pass eligible_measures.
+    # The rank window can only shrink as the minimum strictness rank of the export is discovered, and rings
+    # with both ranks at or below minRankFloor are always inside the window, so their maximum subStrictnessRank
+    # per strictnessRank is a safe lower bound for the eligible ring. Returns the surviving rows and minRank.
+    kept = []
+    running_min = np.inf
+    ring_floor = pd.Series(dtype='float64')
+    for chunk in iter_intermediate('measures', locGroup, loc, columns=measuresColumns, chunksize=chunksize):
+        running_min = min(running_min, chunk['strictnessRank'].min())
+        upper = max(running_min, minRankFloor)
+        sub = chunk['subStrictnessRank']
+        chunk = chunk[(chunk['strictnessRank'] <= upper) & (chunk['strictnessRank'] >= maxRank) &
+                      (((sub <= upper) & (sub > maxRank)) | sub.isna() | (sub == 100))]
+
+        always_in = chunk[(chunk['strictnessRank'] <= minRankFloor) & (chunk['subStrictnessRank'] <= minRankFloor)]
+        ring_floor = np.fmax(ring_floor, always_in.groupby('strictnessRank')['subStrictnessRank'].max()) # aligned on strictnessRank
+
+        # drop inner rings of a shape with a known larger eligible ring; earlier chunks are filtered once after the loop
+        kept.append(ring_filter(chunk, upper, ring_floor))
+
+    # drop rows that fell out of the window, or whose shape had its larger eligible ring in a later chunk
+    minRank = max(running_min, minRankFloor)
+    return ring_filter(pd.concat(kept, ignore_index=True), minRank, ring_floor), minRank
+
+def ring_filter(df, upper, ring_floor): # rows within the rank window up to upper, without rings inside the eligible ring floor per strictnessRank
+    sub = df['subStrictnessRank']
+    floor = df['strictnessRank'].map(ring_floor)
+    return df[(df['strictnessRank'] <= upper) & (sub.isna() | (sub == 100) | ((sub <= upper) & ~(sub < floor)))]
+
+def activity_processor(loc, GEEbucket, locGroup, country, chunksize=None):
     # Since we're now using relative paths, we don't need repl_pkg_path parameter
     #locCount=0
     #print(f'Uploading activity for {loc}...')
@@ -402,31 +662,40 @@ def activity_processor(loc, GEEbucket, locGroup, country):
     #except:  
     #try: 
     # prepare image property dataframe to be merged in later
-    df_prop = prepare_properties(locGroup, loc, propToDrop)
+    df_prop = prepare_properties(locGroup, loc, propToDrop, propertiesKind)
 
-    # Read the activity CSV file
-    df = pd.read_csv(os.path.join('..', 'datasets', 'intermediate_outputs', f'{locGroup}_measures_exportAct5_maxpMax{loc}_w7.csv'))
- 
-    # keep only entries that fall between the strictest rank we define and the least strict one for a given shape, but at least 30
-    minRank = max(df['strictnessRank'].min(),30)
-    df = df[(df['strictnessRank'] <= minRank) & (df['strictnessRank'] >= maxRank)]
-    df = df[((df['subStrictnessRank'] <= minRank) & (df['subStrictnessRank'] > maxRank)) | (pd.isna(df['subStrictnessRank'])) | (df['subStrictnessRank'] ==100)]
- 
-    df['subStrictnessRank'] = df['subStrictnessRank'].fillna(100).astype(int)
+    # Read the activity measures, assign info variables and market days
+    df_elig, geos = prepare_measures(loc, locGroup, country, chunksize)
 
-    eligible_rings = df[df['subStrictnessRank'] != 100].groupby('strictnessRank', as_index=False)['subStrictnessRank'].max()
-    additional_rows = pd.DataFrame({
-        'strictnessRank': df['strictnessRank'].unique(),
-        'subStrictnessRank': 100
-    })
-    eligible_shapes = pd.concat([eligible_rings, additional_rows]).sort_values(by='strictnessRank').reset_index(drop=True)
+    # Reshape to one row per image and detected area, merged with properties
+    wide_df = widen_measures(df_elig, df_prop)
+
+    df, _ = activity_from_wide(wide_df, geos, locGroup, loc)
+    return df
+
+def prepare_measures(loc, locGroup, country, chunksize=None): # eligible measures of a market with info variables and market days
+    # Read the activity measures (Parquet store if converted, CSV otherwise), in chunks if requested to bound memory
+    if chunksize:
+        df, minRank = read_measures_streaming(locGroup, loc, chunksize)
+    else:
+        df = read_intermediate('measures', locGroup, loc, columns=measuresColumns)
+        minRank = max(df['strictnessRank'].min(), minRankFloor)
+
+    df_elig = label_measures(eligible_measures(df, minRank), loc, locGroup, country)
+    geos = df_elig['area_id'].unique()
+
+    # Identify market days
+    df_elig = identifyMktDays(loc, df_elig, minRank)
+    return df_elig, geos
 
-    df_elig =  pd.merge(df, eligible_shapes, on=['strictnessRank', 'subStrictnessRank'])
+def image_ids(idents): # image id of the rows of a measures export, from their ident (X<image id>_maxpMax...)
+    return idents.str.rsplit('_maxpMax', n=1).str[0].str[1:]
 
-    df_elig.rename(columns={'weekdayShp': 'weekdayThisAreaIsActive'}, inplace=True)
+def label_measures(df_elig, loc, locGroup, country): # area ids, image ids and info variables of eligible measures
+    df_elig = df_elig.rename(columns={'weekdayShp': 'weekdayThisAreaIsActive'})
 
     # Extract image id 
-    df_elig['ident'] = df_elig['ident'].str.rsplit('_maxpMax', n=1).str[0].str[1:] 
+    df_elig['ident'] = image_ids(df_elig['ident'])
     df_elig['weekdayThisAreaIsActive'] = df_elig['weekdayThisAreaIsActive'].astype(int)
     df_elig['strictnessRank'] = df_elig['strictnessRank'].astype(int)
 
@@ -435,30 +704,48 @@ def activity_processor(loc, GEEbucket, locGroup, country):
     df_elig['subStrictnessRank_str'] = df_elig['subStrictnessRank'].apply(prepend_zero_if_single_digit)
     df_elig['area_id'] = df_elig['strictnessRank_str'].astype(str) + '_' + df_elig['subStrictnessRank_str'].astype(str)
 
-    geos = df_elig['area_id'].unique()
-
     # Append area id to variable names
-    new_column_names = {old_col: old_col + '_maxpMax'  for old_col in varsOfInterest}
-    df_elig = df_elig.rename(columns=new_column_names)
+    df_elig = df_elig.rename(columns={old_col: old_col + '_maxpMax'  for old_col in varsOfInterest})
 
     # Assign info variables
-    df_elig = infoVars(df_elig, loc, locGroup, country)
-
-    # Identify market days
-    df_elig = identifyMktDays(loc, df_elig, minRank)
-
-    wide_df = df_elig.pivot_table(index=forMerge, columns='area_id', values=list(new_column_names.values()))
-    wide_df.columns = ['_'.join(str(s).strip() for s in col if s) for col in wide_df.columns]
-    wide_df.reset_index(inplace=True)    
+    return infoVars(df_elig, loc, locGroup, country)
+
+def widen_measures(df_elig, df_prop): # one row per image and detected area, one column per variable and area
+    # Same frame as pivot_table(index=forMerge, columns='area_id'), built from an image metadata table and one dense
+    # (image x area) wideDtype block per variable. The other columns of forMerge are fixed by ident and weekdayThisAreaIsActive
+    df_elig = df_elig.dropna(subset=forMerge)
+    rows = df_elig.groupby(['ident', 'weekdayThisAreaIsActive'], sort=True).ngroup().to_numpy()
+    first = np.unique(rows, return_index=True)[1]
+    meta = df_elig[forMerge].iloc[first].reset_index(drop=True)
+    cols, areas = pd.factorize(df_elig['area_id'], sort=True)
+
+    blocks = []
+    for var in sorted(p + '_maxpMax' for p in varsOfInterest):
+        # mean of the values per cell, as pivot_table
+        values = df_elig[var].to_numpy(dtype='float64', na_value=np.nan)
+        valid = ~np.isnan(values)
+        sums = np.zeros((len(meta), len(areas)))
+        counts = np.zeros((len(meta), len(areas)))
+        np.add.at(sums, (rows[valid], cols[valid]), values[valid])
+        np.add.at(counts, (rows[valid], cols[valid]), 1)
+        block = pd.DataFrame(np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0).astype(wideDtype),
+                             columns=[f'{var}_{area}' for area in areas])
+        blocks.append(block.loc[:, counts.any(axis=0)])
+    wide_df = pd.concat([meta] + blocks, axis=1)
 
     # Drop unnecessary columns
     wide_df = drop_columns_by_pattern(wide_df, patterns_to_drop)
 
     # Merge with properties
-    wide_df = pd.merge(wide_df, df_prop, on='ident', how='left')
+    return pd.merge(wide_df, df_prop, on='ident', how='left')
+
+def activity_from_wide(wide_df, geos, locGroup, loc):
+    # Clean the wide rows, select the market area per market day and normalize the activity measure.
+    # Returns the activity data and the statistics it was derived with (see activity_processor_incremental)
 
     # Exclude outliers
-    wide_df = cleanActMeasures(wide_df, geos, varsOfInterest)
+    stats = outlier_statistics(wide_df, geos, varsOfInterest)
+    wide_df = cleanActMeasures(wide_df, geos, varsOfInterest, stats)
     pd.set_option('display.max_columns', None)
 
     # Identify varying areas on market days
@@ -466,7 +753,16 @@ def activity_processor(loc, GEEbucket, locGroup, country):
 
     ### Clean and upload activity data  
     df = df.drop(columns=df.filter(like='count').columns)
+    df, tokeep = select_activity_measure(df, market_days)
+
+    #normalize the activity measure
+    (mean_nonmktday, mean_mktday) = getActivityMeans(df, loc, _startDateNorm, _endDateNorm)
 
+    run = {'stats': stats, 'market_days': market_days, 'tokeep': tokeep, 'mean_nonmktday': mean_nonmktday, 'mean_mktday': mean_mktday,
+           'maxVar': {market_day: df[f'maxVar_s_{market_day}_maxpMax'].iloc[0] for market_day in market_days}}
+    return normalize_activity(df, loc, market_days, tokeep, mean_nonmktday, mean_mktday), run
+
+def select_activity_measure(df, market_days): # activity of each market day taken from its selected area
     tokeep=[]
     for market_day in market_days:
         df = df.rename(columns = {f"maxVar_s_{market_day}_maxpMax_1": f"maxVar_s_{market_day}_maxpMax"})
@@ -475,21 +771,20 @@ def activity_processor(loc, GEEbucket, locGroup, country):
         #print(target_var, target_var_100)
         tokeep.extend([df[f"maxVar_s_{market_day}_maxpMax"].unique().tolist()[0].replace("maxpmax", "maxpMax")])
         df.loc[(market_day == df['weekdayThisAreaIsActive']) , 'activity_measure'] = df[target_var_100]
+    return df, tokeep
 
-    #normalize the activity measure
-    (mean_nonmktday, mean_mktday) = getActivityMeans(df, loc, _startDateNorm, _endDateNorm)
-
-    df = pd.merge(df, mean_nonmktday, on=['weekdayThisAreaIsActive', 'instrument'], how='outer', suffixes=('', '_mean_nonmktday'))
-    df['activity_measure_mean0'] = df['activity_measure'] - df['activity_measure_mean_nonmktday']
-    df = pd.merge(df, mean_mktday, on=['weekdayThisAreaIsActive', 'instrument'], how='outer', suffixes=('', '_mean_mktday'))
-    df['activity_measure_norm'] = 100*df['activity_measure_mean0']/df['activity_measure_mean0_mean_mktday'] 
-    
+def normalize_activity(df, loc, market_days, tokeep, mean_nonmktday, mean_mktday): # normalize and keep the columns exported per market
     # Apply the function to each string in listA
     tokeep_100 = [replace_after_underscore(col) for col in tokeep]        
     cols_to_drop = [col for col in df.columns if ('maxVar' not in col and 'maxpMax' in col) and col not in tokeep and col not in tokeep_100 ]
     #print(cols_to_drop)
     df = df.drop(columns=cols_to_drop)
-    df = df.drop(columns=['ground_control', 'time', 'locGroup'])
+    df = df.drop(columns=['ground_control', 'time', 'locGroup'], errors='ignore') # the metadata table has no ground_control
+
+    df = pd.merge(df, mean_nonmktday, on=['weekdayThisAreaIsActive', 'instrument'], how='outer', suffixes=('', '_mean_nonmktday'))
+    df['activity_measure_mean0'] = df['activity_measure'] - df['activity_measure_mean_nonmktday']
+    df = pd.merge(df, mean_mktday, on=['weekdayThisAreaIsActive', 'instrument'], how='outer', suffixes=('', '_mean_mktday'))
+    df['activity_measure_norm'] = 100*df['activity_measure_mean0']/df['activity_measure_mean0_mean_mktday'] 
 
     #filter for this market day and clean
     df = df[df['mktDay'] != 99].dropna(subset=['date', 'acquired'])
@@ -511,3 +806,244 @@ def activity_processor(loc, GEEbucket, locGroup, country):
     df['acquired'] = pd.to_datetime(df['acquired'], utc=True, errors='coerce')
 
     return df
+
+def activity_state_paths(loc): # files holding the state of a market between incremental runs
+    folder = os.path.join(activityStateDir, loc)
+    return {'wide': os.path.join(folder, 'wide.parquet'), 'activity': os.path.join(folder, 'activity.parquet'), 'state': os.path.join(folder, 'state.json')}
+
+def _table_records(table): # statistics table -> json-serializable dict
+    keys = list(table.index.names) if isinstance(table, (pd.Series, pd.DataFrame)) and table.index.names != [None] else []
+    frame = table.reset_index() if keys else table
+    return {'keys': keys, 'data': frame.to_dict('list')}
+
+def _table_from_records(records, series=False):
+    table = pd.DataFrame(records['data'])
+    if records['keys']:
+        table = table.set_index(records['keys'])
+    return table.iloc[:, 0] if series else table
+
+def save_activity_state(loc, wide_df, activity, geos, run, kind='full'):
+    # kind: 'full' or 'incremental', the kind of run that produced the state
+    paths = activity_state_paths(loc)
+    os.makedirs(os.path.dirname(paths['state']), exist_ok=True)
+    wide_df.to_parquet(paths['wide'], index=False)
+    activity.rename_axis('acquired_index').to_parquet(paths['activity']) # the index duplicates the acquired column
+    state = {'reference_window': [_startDateNorm, _endDateNorm],
+             'run': kind,
+             'geos': sorted(str(g) for g in geos),
+             'market_days': [int(d) for d in run['market_days']],
+             'tokeep': list(run['tokeep']),
+             'maxVar': {str(int(d)): v for d, v in run['maxVar'].items()},
+             'stats': {name: _table_records(table) for name, table in run['stats'].items()},
+             'mean_nonmktday': _table_records(run['mean_nonmktday'].reset_index(drop=True)),
+             'mean_mktday': _table_records(run['mean_mktday'].reset_index(drop=True))}
+    with open(paths['state'], 'w') as f:
+        json.dump(state, f, default=lambda o: o.item())
+
+def load_activity_state(loc): # state saved by save_activity_state, None if the market has not been processed yet
+    paths = activity_state_paths(loc)
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    with open(paths['state']) as f:
+        state = json.load(f)
+    state['stats'] = {name: _table_from_records(records, series=(name == 'median_time')) for name, records in state['stats'].items()}
+    state['mean_nonmktday'] = _table_from_records(state['mean_nonmktday'])
+    state['mean_mktday'] = _table_from_records(state['mean_mktday'])
+    state['maxVar'] = {int(d): v for d, v in state['maxVar'].items()}
+    state['wide'] = pd.read_parquet(paths['wide'])
+    state['activity'] = pd.read_parquet(paths['activity']).rename_axis('acquired')
+    return state
+
+def same_groups(old, new): # whether two statistics tables have the same groups and columns
+    old, new = pd.DataFrame(old), pd.DataFrame(new)
+    return set(old.index) == set(new.index) and set(old.columns) == set(new.columns)
+
+def statistics_moved(old, new, tol=statsTolerance): # whether a statistics table changed its groups, or a value by more than tol (relative)
+    if not same_groups(old, new):
+        return True
+    old, new = pd.DataFrame(old), pd.DataFrame(new)
+    a = old.to_numpy(dtype='float64', na_value=np.nan)
+    b = new.reindex(index=old.index, columns=old.columns).to_numpy(dtype='float64', na_value=np.nan)
+    if (np.isnan(a) != np.isnan(b)).any():
+        return True
+    both = ~np.isnan(a)
+    return bool((np.abs(b[both] - a[both]) > tol * np.abs(a[both])).any())
+
+def selected_activity(wide_df, state, stats): # activity_measure of the wide rows, cleaned with stats, in the selected areas of state
+    df = cleanActMeasures(wide_df.copy(), state['geos'], varsOfInterest, stats)
+    for market_day, var in state['maxVar'].items():
+        df[f'maxVar_s_{market_day}_maxpMax'] = var
+    df['activity_measure'] = np.nan
+    return select_activity_measure(df, state['market_days'])[0]
+
+def normalization_moved(wide_df, state, tol=statsTolerance):
+    # Why the frozen statistics of state no longer hold for the wide rows (old and new images), None if they do: recomputed
+    # outlier statistics have other groups, move the median acquisition time by more than tol (relative), or change the
+    # activity of more than a share tol of the rows, or the non-market day means that follow from them move by more than
+    # tol of the market day mean (that is, activity_measure_norm by more than 100 * tol).
+    stats = outlier_statistics(wide_df, state['geos'], varsOfInterest)
+    if not all(same_groups(state['stats'][name], stats[name]) for name in stats):
+        return 'groups of the outlier statistics changed'
+    if statistics_moved(state['stats']['median_time'], stats['median_time'], tol):
+        return 'median acquisition time changed'
+
+    frozen = selected_activity(wide_df, state, state['stats'])['activity_measure'].to_numpy(dtype='float64')
+    df = selected_activity(wide_df, state, stats)
+    recomputed = df['activity_measure'].to_numpy(dtype='float64')
+    valid = ~(np.isnan(frozen) & np.isnan(recomputed))
+    if (~np.isclose(frozen, recomputed, equal_nan=True) & valid).sum() > tol * valid.sum():
+        return 'outlier statistics changed'
+
+    keys = ['weekdayThisAreaIsActive', 'instrument']
+    old, mkt = state['mean_nonmktday'].set_index(keys)['activity_measure'], state['mean_mktday'].set_index(keys)['activity_measure_mean0']
+    new = nonmktday_means(activity_for_means(df)).set_index(keys)['activity_measure']
+    if set(old.index) != set(new.index):
+        return 'groups of the non-market day means changed'
+    shift = (new.reindex(old.index) - old).abs() / mkt.reindex(old.index).abs()
+    if (shift > tol).any():
+        return 'non-market day means changed'
+    return None
+
+def read_new_measures(locGroup, loc, known, chunksize=500000): # rows of the measures export whose image is not in known
+    new = [chunk[~image_ids(chunk['ident']).isin(known)]
+           for chunk in iter_intermediate('measures', locGroup, loc, columns=measuresColumns, chunksize=chunksize)]
+    return pd.concat(new, ignore_index=True)
+
+def eligible_new_measures(df, geos):
+    # Rows of new images in the detected areas geos of a previous run, None if they change the detected areas.
+    # The rank window and the outermost eligible ring per strictness rank follow from geos (see eligible_measures):
+    # a new image changes them if it has a strictness rank or a larger eligible ring the previous run did not have.
+    ranks = pd.DataFrame([g.split('_') for g in geos], columns=['strictnessRank', 'subStrictnessRank']).astype(int)
+    minRank = max(ranks['strictnessRank'].min(), minRankFloor)
+    rings = ranks[ranks['subStrictnessRank'] != 100].groupby('strictnessRank')['subStrictnessRank'].max()
+    rings = rings.reindex(ranks['strictnessRank'].unique(), fill_value=-1)
+
+    df = df[(df['strictnessRank'] <= minRank) & (df['strictnessRank'] >= maxRank)]
+    df = df[((df['subStrictnessRank'] <= minRank) & (df['subStrictnessRank'] > maxRank)) | (pd.isna(df['subStrictnessRank'])) | (df['subStrictnessRank'] ==100)].copy()
+    df['subStrictnessRank'] = df['subStrictnessRank'].fillna(100).astype(int)
+
+    ring = df['strictnessRank'].map(rings)
+    if (ring.isna() | ((df['subStrictnessRank'] != 100) & (df['subStrictnessRank'] > ring))).any():
+        return None, minRank
+    return df[(df['subStrictnessRank'] == 100) | (df['subStrictnessRank'] == ring)], minRank
+
+def activity_processor_incremental(loc, GEEbucket, locGroup, country, chunksize=None):
+    # Like activity_processor, but only reads, cleans and normalizes the images not seen in the previous run of this market.
+    # The outlier statistics, market days, selected market areas and normalization means of the last full run are applied
+    # to the new images. The market is recomputed in full if it has no previous run, the reference window changed (its dates,
+    # or new market day images fall into it), the new images change the detected areas, or the outlier statistics or
+    # non-market day means recomputed over all images differ from those of the last full run (in their groups, or beyond
+    # statsTolerance, see normalization_moved). The kind of the last run is kept in the state ('run' of load_activity_state).
+    state = load_activity_state(loc)
+    if state is None or state['reference_window'] != [_startDateNorm, _endDateNorm]:
+        print(f'full run for {loc}: no matching state')
+        return _full_activity_run(loc, locGroup, country, chunksize)
+
+    new = read_new_measures(locGroup, loc, set(state['wide']['ident']), chunksize or 500000)
+    new_elig, minRank = eligible_new_measures(new, state['geos'])
+    if new_elig is None:
+        print(f'full run for {loc}: detected areas changed')
+        return _full_activity_run(loc, locGroup, country, chunksize)
+    if new_elig.empty:
+        print(f'no new images for {loc}')
+        return state['activity']
+    print(f'{new_elig["ident"].nunique()} new images for {loc}')
+
+    # the new images are labelled with the market days of the previous run
+    new_elig = label_measures(new_elig, loc, locGroup, country)
+    mkt_weekdays = state['wide'].loc[state['wide']['mktDay'] != 0, 'weekday'].unique()
+    new_elig = identifyMktDays(loc, new_elig, minRank, localMktDays=mkt_weekdays)
+    df_prop = prepare_properties(locGroup, loc, propToDrop, propertiesKind, idents=new_elig['ident'].unique())
+
+    # align the new rows to the stored columns, areas missing from the new images become NA
+    wide_df = pd.concat([state['wide'], widen_measures(new_elig, df_prop)], ignore_index=True)
+    new_rows = wide_df.iloc[len(state['wide']):].copy()
+
+    # the market day mean only uses images in the buffered reference window
+    in_window = pd.to_datetime(new_rows['date']).between(
+        pd.to_datetime(_startDateNorm) - pd.Timedelta(days=182), pd.to_datetime(_endDateNorm) + pd.Timedelta(days=182))
+    if (in_window & (new_rows['mktDay'] == 1) & (new_rows['instrument'] == 'PS2')).any():
+        print(f'full run for {loc}: new images in the reference window')
+        return _full_activity_run(loc, locGroup, country, chunksize)
+
+    moved = normalization_moved(wide_df, state)
+    if moved:
+        print(f'full run for {loc}: {moved}')
+        return _full_activity_run(loc, locGroup, country, chunksize)
+
+    df = cleanActMeasures(new_rows, state['geos'], varsOfInterest, state['stats'])
+    for market_day, var in state['maxVar'].items():
+        df[f'maxVar_s_{market_day}_maxpMax'] = var
+    df = df.drop(columns=df.filter(like='count').columns)
+    df, tokeep = select_activity_measure(df, state['market_days'])
+
+    activity = pd.concat([state['activity'], normalize_activity(df, loc, state['market_days'], tokeep, state['mean_nonmktday'], state['mean_mktday'])])
+    run = {name: state[name] for name in ['stats', 'market_days', 'tokeep', 'maxVar', 'mean_nonmktday', 'mean_mktday']}
+    save_activity_state(loc, wide_df, activity, state['geos'], run, kind='incremental')
+    return activity
+
+def _full_activity_run(loc, locGroup, country, chunksize=None): # activity_processor, saving the state for the next incremental run
+    df_prop = prepare_properties(locGroup, loc, propToDrop, propertiesKind)
+    df_elig, geos = prepare_measures(loc, locGroup, country, chunksize)
+    wide_df = widen_measures(df_elig, df_prop)
+    raw = wide_df.copy() # cleanActMeasures modifies the wide rows in place
+    df, run = activity_from_wide(wide_df, geos, locGroup, loc)
+    save_activity_state(loc, raw, df, geos, run)
+    return df
+
+def _activity_worker(market, chunksize=None): # run one market, returning the error instead of raising so one bad market does not stop the batch
+    loc, locGroup, country = market
+    try:
+        return loc, activity_processor(loc, None, locGroup, country, chunksize), None
+    except Exception as e:
+        return loc, None, f'{type(e).__name__}: {e}'
+
+def write_activity_batch(list_df_acrossLocs, dataset_name, batch_counter, out_dir):
+    df_acrossLocs = pd.concat(list_df_acrossLocs, ignore_index=True)
+
+    # Rearrange column order
+    new_order = ['mktID', 'weekdayThisAreaIsActive']
+    df_acrossLocs = df_acrossLocs[new_order + [col for col in df_acrossLocs.columns if col not in new_order]]
+
+    # Save to CSV
+    path = os.path.join(out_dir, f'df_{dataset_name}_batch{batch_counter}.csv')
+    df_acrossLocs.to_csv(path, index=False)
+    print('saved batch', batch_counter, path)
+    return path
+
+def activity_batch_processor(markets, dataset_name, out_dir=os.path.join('..', 'datasets', 'activity_raw'), n_workers=None, locs_per_batch=50, chunksize=None):
+    # Run activity_processor over many markets in a process pool and write the results in the
+    # df_<dataset_name>_batchN.csv layout read by 01_importer.do (e.g. dataset_name="ETH_20250623").
+    # markets: list of (loc, locGroup, country) tuples
+    # chunksize: if set, the measures exports are streamed in chunks of this many rows (see read_measures_streaming)
+    # Returns the written batch files and a dict of {loc: error message} for markets that failed.
+    from multiprocess import Pool # dill-based pool, so the workers also run from within notebooks
+
+    os.makedirs(out_dir, exist_ok=True)
+    n_workers = n_workers or os.cpu_count()
+
+    list_df_acrossLocs = []
+    batch_files = []
+    problemLocs = {}
+    loc_counter = 0
+    with Pool(n_workers) as pool:
+        # imap keeps the input order, so batch contents are reproducible across runs
+        for loc, df, error in pool.imap(partial(_activity_worker, chunksize=chunksize), markets):
+            if error is not None:
+                print(f'problem with {loc}', error)
+                problemLocs[loc] = error
+                continue
+            list_df_acrossLocs.append(df)
+            loc_counter += 1
+
+            # Export and reset for every locs_per_batch locations
+            if loc_counter % locs_per_batch == 0:
+                batch_files.append(write_activity_batch(list_df_acrossLocs, dataset_name, len(batch_files), out_dir))
+                list_df_acrossLocs = []
+
+    # Handle the final batch if it has fewer than locs_per_batch locations
+    if list_df_acrossLocs:
+        batch_files.append(write_activity_batch(list_df_acrossLocs, dataset_name, len(batch_files), out_dir))
+
+    print(f'{loc_counter}/{len(markets)} markets processed, {len(problemLocs)} failed')
+    return batch_files, problemLocs
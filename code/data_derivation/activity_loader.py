@@ -0,0 +1,175 @@
+import os
+import re
+import csv
+import glob
+import json
+import hashlib
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+activityRawDir = os.path.join('..', 'datasets', 'activity_raw') # df_<dataset_name>_batchN.csv files read by 01_importer.do
+activityCacheDir = os.path.join('..', 'datasets', 'activity_cache') # Parquet copies of the batches, named by the hash of their source file
+activityRawDtypes = { # explicit types of the known columns, by lowercase name (Stata lowercases them, the CSVs may not)
+    'location': pa.string(),
+    'mktid': pa.string(),
+    'image_id': pa.string(),
+    'mktday': pa.int8(),
+    'weekdaythisareaisactive': pa.int8(),
+    'weekday': pa.int8(),
+    'month': pa.int8(),
+    'year': pa.int16(),
+    'instrument': pa.string(),
+    'admlvl1': pa.string(),
+    'clear_percent': pa.float32(),
+    'diff_to_median_time': pa.float32(),
+    'marketlat': pa.float64(),
+    'marketlon': pa.float64(),
+    'mkt_lat': pa.float64(),
+    'mkt_lon': pa.float64(),
+    'activity_measure': pa.float64(),
+    'activity_measure_norm': pa.float64(),
+}
+activityRawPatterns = {r'activity_measure_norm_\d{4}': pa.float64()} # typed like the above, for columns matching a pattern
+activityRowGroupSize = 65536 # rows per row group of the cached copies; smaller groups let filters skip more of a file
+activityNulls = ['', 'NA', 'NaN', 'nan', '.']
+
+def raw_batch_files(dataset_name='ETH_20250623', raw_dir=activityRawDir): # batch files of a dataset, in batch order
+    files = glob.glob(os.path.join(raw_dir, f'df_{dataset_name}_batch*.csv'))
+    return sorted(files, key=lambda f: int(re.search(r'_batch(\d+)\.csv$', f).group(1)))
+
+def column_type(name):
+    key = name.lower()
+    if key in activityRawDtypes:
+        return activityRawDtypes[key]
+    for pattern, dtype in activityRawPatterns.items():
+        if re.fullmatch(pattern, key):
+            return dtype
+    return None
+
+def find_column(names, name): # actual name of a column, matched case-insensitively (e.g. 'mktDay' or 'mktday')
+    for col in names:
+        if col.lower() == name.lower():
+            return col
+    return None
+
+def file_hash(path, known=None): # sha256 of a file, reused from known (a manifest entry) while its size and mtime are unchanged
+    stat = os.stat(path)
+    if known and known.get('size') == stat.st_size and known.get('mtime_ns') == stat.st_mtime_ns:
+        return known
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+
+def convert_batch(path, out_path): # parse a batch CSV with explicit types and write it sorted by market and date
+    with open(path, newline='') as f:
+        header = next(csv.reader(f))
+    dateCol = find_column(header, 'date')
+    column_types = {col: column_type(col) for col in header if column_type(col) is not None}
+    if dateCol is not None:
+        column_types[dateCol] = pa.string() # dates are parsed below, also when they carry a time
+    # integer columns are parsed as float64, since pandas writes them as e.g. '0.0' when they have missing values, and cast below
+    parse_types = {col: pa.float64() if pa.types.is_integer(dtype) else dtype for col, dtype in column_types.items()}
+    table = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 24),
+        convert_options=pacsv.ConvertOptions(column_types=parse_types, null_values=activityNulls, strings_can_be_null=True),
+    )
+    for col, dtype in column_types.items():
+        if pa.types.is_integer(dtype):
+            try:
+                table = table.set_column(table.schema.get_field_index(col), col, pc.cast(table[col], dtype)) # fails on fractions and overflows
+            except pa.ArrowInvalid:
+                print(f'{os.path.basename(path)}: {col} is not {dtype}, kept as float64')
+    if dateCol is not None:
+        dates = pc.strptime(pc.utf8_slice_codeunits(table[dateCol], 0, 10), format='%Y-%m-%d', unit='s')
+        table = table.set_column(table.schema.get_field_index(dateCol), dateCol, pc.cast(dates, pa.date32()))
+
+    # sorted rows give each row group a narrow range of markets and dates, so filters on them skip most groups
+    sortCols = [col for col in [find_column(header, 'Location'), dateCol] if col is not None]
+    if sortCols:
+        table = table.sort_by([(col, 'ascending') for col in sortCols])
+    tmp_path = out_path + '.tmp'
+    pq.write_table(table, tmp_path, row_group_size=activityRowGroupSize, compression='zstd')
+    os.replace(tmp_path, out_path)
+    return out_path
+
+def cache_batches(files, cache_dir=activityCacheDir, n_workers=None):
+    # Parquet copy of each batch file, converting the files that are new or changed in parallel.
+    # Copies are named by the hash of their source, so an edited batch is converted again and its old copy removed.
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    def cached(path):
+        name = os.path.basename(path)
+        entry = file_hash(path, manifest.get(name))
+        out_path = os.path.join(cache_dir, f"{name[:-len('.csv')]}-{entry['sha256'][:16]}.parquet")
+        if not os.path.isfile(out_path):
+            print(f'caching {name}')
+            convert_batch(path, out_path)
+            for old in glob.glob(os.path.join(cache_dir, f"{name[:-len('.csv')]}-*.parquet")):
+                if old != out_path:
+                    os.remove(old)
+        return name, entry, out_path
+
+    with ThreadPoolExecutor(max_workers=n_workers or min(len(files), os.cpu_count() or 1) or 1) as executor:
+        results = list(executor.map(cached, files))
+
+    manifest.update({name: entry for name, entry, _ in results})
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return [out_path for _, _, out_path in results]
+
+def load_activity_raw(dataset_name='ETH_20250623', mkt_days=None, instruments=None, start=None, end=None, locs=None, columns=None,
+                      raw_dir=activityRawDir, cache_dir=activityCacheDir, n_workers=None, as_pandas=True):
+    # Load the activity_raw batches of a dataset as one frame, reading only what the filters keep.
+    # mkt_days [list]:     e.g. [0, 1], as the inlist(mktday,0,1) of 01_importer.do
+    # instruments [list]:  e.g. ['PSB.SD']
+    # start, end [str]:    inclusive date range, e.g. '2017-07-01'
+    # locs [list]:         markets (Location)
+    # columns [list]:      columns to read, all if None (names are matched case-insensitively)
+    # The first call converts the CSVs to a Parquet cache (see cache_batches), later calls only read the cache.
+    files = raw_batch_files(dataset_name, raw_dir)
+    if not files:
+        raise FileNotFoundError(f'no df_{dataset_name}_batch*.csv files in {raw_dir}')
+    paths = cache_batches(files, cache_dir, n_workers)
+
+    # batches may differ in their columns or in the types inferred for untyped columns
+    schema = pa.unify_schemas([pq.read_schema(path) for path in paths], promote_options='permissive')
+    dataset = ds.dataset(paths, schema=schema, format='parquet')
+    names = schema.names
+
+    conditions = []
+    def field(name):
+        col = find_column(names, name)
+        if col is None:
+            raise KeyError(f'cannot filter on {name}: no such column')
+        return ds.field(col)
+    if mkt_days is not None:
+        conditions.append(field('mktDay').isin(list(mkt_days)))
+    if instruments is not None:
+        conditions.append(field('instrument').isin(list(instruments)))
+    if start is not None:
+        conditions.append(field('date') >= pa.scalar(date.fromisoformat(str(start)[:10]), pa.date32()))
+    if end is not None:
+        conditions.append(field('date') <= pa.scalar(date.fromisoformat(str(end)[:10]), pa.date32()))
+    if locs is not None:
+        conditions.append(field('Location').isin(list(locs)))
+    filter = None
+    for condition in conditions:
+        filter = condition if filter is None else filter & condition
+
+    if columns is not None:
+        columns = [find_column(names, col) or col for col in columns]
+    table = dataset.to_table(columns=columns, filter=filter, use_threads=True)
+    return table.to_pandas(date_as_object=False) if as_pandas else table
@@ -0,0 +1,179 @@
+import os, sys, json, time, shutil, argparse, tempfile, threading, importlib
+from fake_services import FakeServices
+
+# -------------------------------------------------------------------------------------------------------------------------------
+# DOWNLOADER BENCHMARK
+#
+# Runs the download flow of download_imagery against the local stand-in of fake_services, and reports wall time,
+# requests per endpoint and time spent sleeping. Sleeps of download_imagery are recorded at their full length and
+# actually slept for sleep_scale of it, so that the fixed waits of the flow show up in the report without making
+# a run take hours. Example:
+#
+#   python benchmark_downloader.py --mode scheduler --locs 20 --scenes 1200 --error-rate 0.05 --latency 0.02
+# -------------------------------------------------------------------------------------------------------------------------------
+
+bucket_name = "mai_2023"  # bucket of the market geojsons, read by buildGeometryCatalog
+image_bucket = "benchmark_images"
+api_key = "benchmark"
+
+
+class SleepClock:
+    # Stands in for the time module inside download_imagery: records the requested sleeps and sleeps sleep_scale of them.
+    # time() and monotonic() run ahead of the real clock by the sleep that was skipped, so that waits measured
+    # by the module (e.g. order_listing_delay) and the processing time of fake orders pass at the same pace as the sleeps
+    def __init__(self, sleep_scale):
+        self.sleep_scale = sleep_scale
+        self.requested = 0.0
+        self.slept = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0)
+        start = time.perf_counter()
+        time.sleep(seconds * self.sleep_scale)
+        with self.lock:
+            self.requested += seconds
+            self.slept += time.perf_counter() - start
+            self.calls += 1
+
+    def skipped(self):
+        with self.lock:
+            return self.requested - self.slept
+
+    def time(self):
+        return time.time() + self.skipped()
+
+    def monotonic(self):
+        return time.monotonic() + self.skipped()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def market_locations(n, locGroup):
+    # n market points in a grid, as {mktID: (lon, lat)}, and the (loc, locGroup) pairs downloaded for them
+    markets = {}
+    for i in range(n):
+        lon, lat = 38.0 + (i % 10) * 0.1, 13.0 + (i // 10) * 0.1
+        markets[f"lon{lon:.4f}lat{lat:.4f}"] = (lon, lat)
+    locs = [(mktID.replace(".", "_", 2), locGroup) for mktID in markets]
+    return markets, locs
+
+
+def run_benchmark(args):
+    services = FakeServices(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        scenes_per_loc=args.scenes,
+        search_page_size=args.page_size,
+        orders_page_size=args.page_size,
+        order_seconds=args.order_seconds,
+        duplicate_rate=args.duplicate_rate,
+        seed=args.seed,
+    ).start()
+    markets, locs = market_locations(args.locs, args.loc_group)
+    services.add_markets(bucket_name, args.loc_group, markets)
+
+    # the storage client of download_imagery talks to the stand-in instead of GCS
+    os.environ["STORAGE_EMULATOR_HOST"] = services.url
+    workdir = tempfile.mkdtemp(prefix="benchmark_downloader_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.makedirs("./temp/Jsons", exist_ok=True)
+
+    try:
+        import_start = time.perf_counter()
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        download_imagery = importlib.import_module("download_imagery")
+        import_seconds = time.perf_counter() - import_start
+
+        download_imagery.search_url = f"{services.url}/data/v1/quick-search"
+        download_imagery.order_url = f"{services.url}/compute/ops/orders/v2"
+        clock = SleepClock(args.sleep_scale)
+        download_imagery.time = clock
+        services.clock = clock.time
+
+        start = time.perf_counter()
+        if args.mode == "downloader":
+            statuses = {}
+            for loc, locGroup in locs:
+                # downloader only returns a message if the location failed
+                statuses[loc] = download_imagery.downloader(
+                    loc, locGroup, args.end_date, args.max_running, args.max_cloud_cover,
+                    api_key, image_bucket, private_key="",
+                ) or "complete"
+        elif args.mode == "scheduler":
+            statuses = download_imagery.download_scheduler(
+                locs, args.end_date, args.max_running, args.max_cloud_cover, api_key, image_bucket,
+                private_key="", poll_interval=args.poll_interval,
+            )
+        else:
+            # metadata only: deliver every scene of each location, then build the property tables
+            for loc, locGroup in locs:
+                hull = download_imagery.loadConvexHull(loc, locGroup)
+                scenes = services.scenes(hull["geometry"]["coordinates"])
+                services.deliver({
+                    "id": "benchmark",
+                    "payload": {
+                        "products": [{"item_ids": [scene["id"] for scene in scenes]}],
+                        "delivery": {"google_cloud_storage": {"bucket": image_bucket, "path_prefix": loc}},
+                    },
+                })
+            services.requests.clear()
+            start = time.perf_counter()
+            statuses = {}
+            for loc, _ in locs:
+                _, added = download_imagery.process_json_files(loc, image_bucket)
+                statuses[loc] = f"{added} rows"
+        wall = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "mode": args.mode,
+        "locations": len(locs),
+        "import_seconds": round(import_seconds, 3),
+        "wall_seconds": round(wall, 3),
+        "sleep_requested_seconds": round(clock.requested, 1),
+        "sleep_actual_seconds": round(clock.slept, 3),
+        "sleep_calls": clock.calls,
+        "requests": dict(sorted(services.requests.items())),
+        "total_requests": sum(services.requests.values()),
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the download flow against a local Planet/GCS stand-in")
+    parser.add_argument("--mode", choices=["downloader", "scheduler", "metadata"], default="scheduler")
+    parser.add_argument("--locs", type=int, default=5, help="number of market locations")
+    parser.add_argument("--loc-group", default="79_Tigray_1")
+    parser.add_argument("--scenes", type=int, default=600, help="catalog size: scenes per location")
+    parser.add_argument("--page-size", type=int, default=250, help="features per search page and orders per listing page")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Planet requests answered with 429/503")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds of the injected 429s")
+    parser.add_argument("--order-seconds", type=float, default=600, help="time until an order is delivered")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="share of scenes delivered twice")
+    parser.add_argument("--sleep-scale", type=float, default=0.01, help="share of each requested sleep actually slept")
+    parser.add_argument("--poll-interval", type=float, default=30)
+    parser.add_argument("--max-running", type=int, default=10)
+    parser.add_argument("--max-cloud-cover", type=float, default=50)
+    parser.add_argument("--end-date", default="2024-12-31")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this json file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import os, sys, glob, time, shutil, argparse, tempfile
+import numpy as np
+import pandas as pd
+
+# -------------------------------------------------------------------------------------------------------------------------------
+# INCREMENTAL RUN CHECK
+#
+# Builds a synthetic measures/properties export around the shapes of the sample market in datasets/intermediate_outputs,
+# runs activity_processor_incremental on it without its newest images, then again with them, and checks that the
+# second run took the incremental path and kept the rows of the first. Also runs activity_processor on the full export
+# for the timing, the set of rows and the activity_measure_norm values, a shuffled copy of the export, which must be seen
+# as unchanged, and a year of new images with higher activity, which moves the statistics and must trigger a full run. Example:
+#
+#   python check_incremental.py --new 3
+# -------------------------------------------------------------------------------------------------------------------------------
+
+sample_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'datasets', 'intermediate_outputs')
+loc, locGroup, country = 'lon38_5671lat9_2948', '79_Ethiopia', 'Ethiopia'
+market_weekdays = [1, 5]
+norm_tolerance = 0.02 # share of rows whose activity_measure_norm may differ between the incremental and a full run
+
+
+def synthetic_export(shapes, seed, start='2017-03-01', end='2023-12-31', scale=1.0):
+    # one image every three days, with a row per detected area of the shapes; activity is higher in the
+    # inner rings on the market weekdays, and a few images have outlying values or small footprints
+    rng = np.random.default_rng(seed)
+    areas = shapes[['weekdayShp', 'strictness', 'subStrictn']].drop_duplicates().to_numpy()
+    dates = pd.date_range(start, end, freq='3D')
+    seconds = rng.integers(25000, 30000, len(dates))
+    idents = [f"{d:%Y%m%d}_{s // 3600:02d}{s % 3600 // 60:02d}{s % 60:02d}_" + (f"{rng.integers(1000, 9999)}_3B" if d.year < 2021 else f"{rng.integers(10, 99)}_{rng.integers(1000, 9999)}")
+              for d, s in zip(dates, seconds)]
+
+    img, area = np.repeat(np.arange(len(dates)), len(areas)), np.tile(np.arange(len(areas)), len(dates))
+    weekdayShp, strictness, subStrictn = areas[area].T
+    weekday = ((dates.weekday + 1) % 7).to_numpy()[img]
+    market = (weekday == weekdayShp) & np.isin(weekdayShp, market_weekdays) & (subStrictn != 100)
+    counts = rng.integers(80, 200, len(img)) * np.where(rng.random(len(img)) < 0.05, 0.3, 1)
+    values = scale * rng.normal(1.0 + 0.8 * market + 0.1 * strictness / 30, 0.3) * np.where(rng.random(len(img)) < 0.02, 8, 1)
+    measures = pd.DataFrame({
+        'ident': [f'X{idents[i]}_maxpMax_w7' for i in img],
+        'strictnessRank': strictness,
+        'subStrictnessRank': np.where((subStrictn == 100) & (rng.random(len(img)) < 0.5), np.nan, subStrictn),
+        'weekdayShp': weekdayShp,
+        'sumsum': values * counts,
+        'ccount': counts,
+    })
+    properties = pd.DataFrame({
+        'system:index': [i + '_AnalyticMS_SR' for i in idents],
+        'acquired': (dates + pd.to_timedelta(seconds, unit='s')).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'clear_percent': rng.choice([95, 99, 100, 60, 5], len(dates)),
+        'cloud_percent': rng.choice([0, 10, 60], len(dates)),
+        'ground_control': True,
+        'gsd': 3.9,
+        'item_id': idents,
+    })
+    return measures, properties
+
+
+def compare_norm(df, full, keys):
+    # share of rows whose activity_measure_norm differs from the full run, and the largest difference
+    both = df.reset_index(drop=True).merge(full.reset_index(drop=True)[keys + ['activity_measure_norm']], on=keys, suffixes=('', '_full'))
+    a, b = both['activity_measure_norm'].to_numpy(dtype=float), both['activity_measure_norm_full'].to_numpy(dtype=float)
+    differs = ~np.isclose(a, b, rtol=1e-6, equal_nan=True)
+    return differs.mean(), np.nanmax(np.abs(a - b)) if differs.any() else 0.0
+
+def run(af, measures, label):
+    measures.to_csv(af.intermediate_csv_path('measures', locGroup, loc), index=False)
+    start = time.perf_counter()
+    df = af.activity_processor_incremental(loc, None, locGroup, country)
+    seconds = time.perf_counter() - start
+    state = af.load_activity_state(loc)
+    print(f'{label}: {state["run"]} run, {len(df)} rows, {seconds:.2f}s')
+    return df, state['run'], seconds
+
+
+def check(n_new, seed, keep):
+    import geopandas as gpd
+    workdir = tempfile.mkdtemp(prefix='check_incremental_')
+    cwd = os.getcwd()
+    try:
+        # the functions read ../datasets relative to the working directory, as in the notebooks
+        os.makedirs(os.path.join(workdir, 'code'))
+        os.makedirs(os.path.join(workdir, 'datasets', 'intermediate_outputs'))
+        for path in glob.glob(os.path.join(sample_dir, f'{locGroup}_shapes_*{loc}.*')):
+            shutil.copy(path, os.path.join(workdir, 'datasets', 'intermediate_outputs'))
+        os.chdir(os.path.join(workdir, 'code'))
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import activity_functions as af
+
+        shapes = gpd.read_file(os.path.join('..', 'datasets', 'intermediate_outputs', f'{locGroup}_shapes_shp_MpM6_{locGroup}{loc}.shp'))
+        measures, properties = synthetic_export(shapes, seed)
+        shifted, shifted_properties = synthetic_export(shapes, seed + 1, '2024-01-01', '2024-12-31', scale=1.5)
+        properties.to_csv(af.intermediate_csv_path('properties', locGroup, loc), index=False)
+        images = af.image_ids(measures['ident'])
+        newest = sorted(images.unique())[-n_new:]
+
+        first, kind, _ = run(af, measures[~images.isin(newest)], 'without the newest images')
+        assert kind == 'full', kind
+        second, kind, inc_seconds = run(af, measures, f'with {n_new} new images')
+        assert kind == 'incremental', f'expected an incremental run, got a {kind} run'
+        shuffled, kind, _ = run(af, measures.sample(frac=1, random_state=seed), 'shuffled export')
+        assert kind == 'incremental' and len(shuffled) == len(second), 'a shuffled export must not trigger a full run'
+
+        start = time.perf_counter()
+        full = af.activity_processor(loc, None, locGroup, country)
+        full_seconds = time.perf_counter() - start
+        print(f'full run of the same export: {len(full)} rows, {full_seconds:.2f}s')
+
+        keys = ['image_id', 'weekdayThisAreaIsActive']
+        rows = lambda df: set(map(tuple, df[keys].astype(str).to_numpy()))
+        assert rows(second) == rows(full), 'incremental and full run differ in their rows'
+        assert rows(first) < rows(second), 'the new images added no rows'
+        old = second.reset_index(drop=True).merge(first.reset_index(drop=True)[keys + ['activity_measure_norm']], on=keys, suffixes=('', '_first'))
+        assert np.allclose(old['activity_measure_norm'], old['activity_measure_norm_first'], equal_nan=True), 'rows of the first run changed'
+        share, largest = compare_norm(second, full, keys)
+        print(f'activity_measure_norm differs from the full run in {share:.2%} of rows (largest difference {largest:.3g})')
+        assert share <= norm_tolerance, 'the incremental run drifted from the full run'
+
+        pd.concat([properties, shifted_properties]).to_csv(af.intermediate_csv_path('properties', locGroup, loc), index=False)
+        third, kind, _ = run(af, pd.concat([measures, shifted]), 'with a year of higher activity')
+        assert kind == 'full', 'statistics moved by the new images must trigger a full run'
+        share, _ = compare_norm(third, af.activity_processor(loc, None, locGroup, country), keys)
+        assert share == 0, 'a full run must match activity_processor'
+        print(f'ok: incremental run {inc_seconds:.2f}s, full run {full_seconds:.2f}s')
+    finally:
+        os.chdir(cwd)
+        if keep:
+            print('kept', workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that activity_processor_incremental only processes new images')
+    parser.add_argument('--new', type=int, default=3, help='number of newest images left out of the first run (a few, as more move the statistics and trigger a full run)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args()
+    check(args.new, args.seed, args.keep)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from weather_join import read_csv_columns, guess_column, unit_vectors, chord_to_km, km_to_chord
+
+conflictPath = os.path.join('..', 'datasets', 'conflict', '2012-07-01-2025-07-01-Ethiopia.csv') # ACLED export used by 04_figure5.do
+conflictDropTypes = ['Strategic developments'] # event types left out, as in 04_figure5.do
+conflictRadiiKm = (5, 10, 25, 50) # distances from the market within which events are counted
+conflictWindowsWeeks = (1, 4, 13, 52) # lookback windows, in weeks up to and including the week of a row
+_conflictEvents = {} # events and their KD-tree, by (path, dropped types), loaded once per session
+
+# Weeks run Monday to Sunday and are numbered by week_ordinals (weeks since Monday 1969-12-29), so events and
+# activity rows fall in the same week by integer arithmetic. For a set of markets and weeks, the features are
+# built on dense (week x market) arrays: events near each market are found in one KD-tree query for the largest
+# radius, added to the week they happened, and summed cumulatively over weeks, so the total over any lookback
+# window is the difference of two rows. Smaller radii and other windows reuse the same query.
+
+def week_ordinals(dates): # weeks since Monday 1969-12-29, -1 for missing dates
+    days = pd.DatetimeIndex(pd.to_datetime(dates)).values.astype('datetime64[D]').astype(np.int64)
+    weeks = (days + 3) // 7
+    return np.where(pd.isna(dates), -1, weeks)
+
+def week_start(weeks): # Monday of each week ordinal
+    return pd.to_datetime(np.asarray(weeks, dtype=np.int64) * 7 - 3, unit='D')
+
+def parse_event_dates(event_date): # ACLED dates, e.g. '01 July 2025' (the DMY of 04_figure5.do) or ISO dates
+    event_date = pd.Series(event_date).astype(str)
+    dates = pd.to_datetime(event_date, format='%d %B %Y', errors='coerce')
+    iso = dates.isna()
+    dates[iso] = pd.to_datetime(event_date[iso], format='ISO8601', errors='coerce')
+    return dates
+
+def load_events(path=conflictPath, drop_types=conflictDropTypes): # events sorted by week, with a KD-tree over their locations
+    key = (path, tuple(drop_types))
+    if key in _conflictEvents:
+        return _conflictEvents[key]
+    events = read_csv_columns(path, ['event_date', 'event_type', 'latitude', 'longitude', 'fatalities'])
+    events = events[~events['event_type'].isin(drop_types)]
+    events['event_date'] = parse_event_dates(events['event_date']).to_numpy()
+    events['latitude'] = pd.to_numeric(events['latitude'], errors='coerce')
+    events['longitude'] = pd.to_numeric(events['longitude'], errors='coerce')
+    events = events.dropna(subset=['event_date', 'latitude', 'longitude'])
+    events['fatalities'] = pd.to_numeric(events['fatalities'], errors='coerce').fillna(0)
+    events['week'] = week_ordinals(events['event_date'])
+    events = events.sort_values('week', kind='stable').reset_index(drop=True)
+    tree = cKDTree(unit_vectors(events['latitude'].to_numpy(), events['longitude'].to_numpy()))
+    print(f'{len(events)} conflict events from {path}')
+    _conflictEvents[key] = {'events': events, 'tree': tree}
+    return _conflictEvents[key]
+
+def events_near(lat, lon, conflict, max_km): # (market, event, km) of every event within max_km of a market, in one query
+    markets = cKDTree(unit_vectors(lat, lon))
+    pairs = markets.sparse_distance_matrix(conflict['tree'], km_to_chord(max_km), output_type='ndarray')
+    return pairs['i'], pairs['j'], chord_to_km(pairs['v'])
+
+def conflict_grid(lat, lon, first_week, last_week, conflict, radii=conflictRadiiKm, windows=conflictWindowsWeeks):
+    # Features of every market and week from first_week to last_week, as {column: (week x market) array}:
+    # conflict_{r}km_{w}w (number of events) and fatalities_{r}km_{w}w within r km of the market in the last w weeks.
+    # Markets without coordinates get zeros.
+    n_mkts = len(lat)
+    start = first_week - max(windows) # earliest week a window reaches back to
+    ok = ~(np.isnan(lat) | np.isnan(lon))
+    mkt, ev, km = events_near(np.where(ok, lat, 0), np.where(ok, lon, 0), conflict, max(radii))
+    keep = ok[mkt]
+    weeks = conflict['events']['week'].to_numpy()[ev] - start
+    keep &= (weeks >= 0) & (weeks <= last_week - start)
+    mkt, ev, km, weeks = mkt[keep], ev[keep], km[keep], weeks[keep]
+    fatalities = conflict['events']['fatalities'].to_numpy()[ev]
+
+    grid = {}
+    end = np.arange(first_week, last_week + 1) - start + 1 # row of each week in the cumulative sums below
+    size = (last_week - start + 2) * n_mkts # a leading row of zeros makes window sums at the first week plain differences
+    for r in radii:
+        near = km <= r
+        cell = (weeks[near] + 1) * n_mkts + mkt[near]
+        for name, weight in [('conflict', None), ('fatalities', fatalities[near])]:
+            total = np.bincount(cell, weights=weight, minlength=size).reshape(-1, n_mkts).cumsum(axis=0)
+            for w in windows:
+                grid[f'{name}_{r}km_{w}w'] = (total[end] - total[end - w]).astype(np.float32)
+    return grid
+
+def market_week_conflict(markets, start, end, loc_col=None, lat_col=None, lon_col=None, radii=conflictRadiiKm,
+                         windows=conflictWindowsWeeks, path=conflictPath, drop_types=conflictDropTypes):
+    # Conflict features of every market (one row per market, with its coordinates) and week from start to end,
+    # as a long frame with the market, the Monday of the week (week) and one column per radius and window.
+    loc_col = loc_col or guess_column(markets, ['Location', 'mktID'])
+    lat_col = lat_col or guess_column(markets, ['mkt_lat', 'marketLat', 'latitude'])
+    lon_col = lon_col or guess_column(markets, ['mkt_lon', 'marketLon', 'longitude'])
+    markets = markets.drop_duplicates(loc_col)
+    first_week, last_week = week_ordinals([start, end])
+    grid = conflict_grid(markets[lat_col].to_numpy(dtype=float), markets[lon_col].to_numpy(dtype=float),
+                         first_week, last_week, load_events(path, drop_types), radii, windows)
+    out = pd.DataFrame({
+        loc_col: np.tile(markets[loc_col].to_numpy(), last_week - first_week + 1),
+        'week': week_start(np.repeat(np.arange(first_week, last_week + 1), len(markets))),
+    })
+    for col, values in grid.items():
+        out[col] = values.ravel()
+    return out
+
+def join_conflict(df, loc_col=None, date_col='date', lat_col=None, lon_col=None, radii=conflictRadiiKm,
+                  windows=conflictWindowsWeeks, path=conflictPath, drop_types=conflictDropTypes):
+    # Attach conflict features to activity rows (e.g. from load_activity_raw or read_panel) by the market and week of each row,
+    # see conflict_grid for the columns. Column names default to those of the activity data, as in join_weather.
+    loc_col = loc_col or guess_column(df, ['Location', 'mktID'])
+    lat_col = lat_col or guess_column(df, ['mkt_lat', 'marketLat'])
+    lon_col = lon_col or guess_column(df, ['mkt_lon', 'marketLon'])
+    df = df.copy()
+    weeks = week_ordinals(df[date_col])
+    if not (weeks >= 0).any():
+        return df
+    first_week, last_week = weeks[weeks >= 0].min(), weeks.max()
+
+    markets = df[[loc_col, lat_col, lon_col]].drop_duplicates(loc_col)
+    grid = conflict_grid(markets[lat_col].to_numpy(dtype=float), markets[lon_col].to_numpy(dtype=float),
+                         first_week, last_week, load_events(path, drop_types), radii, windows)
+    rows = weeks - first_week
+    cols = pd.Index(markets[loc_col]).get_indexer(df[loc_col])
+    ok = weeks >= 0
+    for col, values in grid.items():
+        out = np.full(len(df), np.nan, dtype=np.float32)
+        out[ok] = values[rows[ok], cols[ok]]
+        df[col] = out
+    return df
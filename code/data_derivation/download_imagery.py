@@ -1,25 +1,44 @@
-import os, re, json, time, requests, subprocess, geojson, logging, warnings
+import os, re, json, time, random, sqlite3, itertools, threading, requests, geojson, logging, warnings
 from datetime import datetime
 from shapely.geometry import shape
 import pandas as pd
-from google.cloud import storage
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from google.cloud import storage
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 
 # -------------------------------------------------------------------------------------------------------------------------------
 # GLOBAL VARIABLES
 # -------------------------------------------------------------------------------------------------------------------------------
 
 warnings.filterwarnings("ignore")
-storage_client = storage.Client(project="planetupload")
-bucketName = "mai_2023"
-bucket = storage_client.get_bucket(bucketName)
+gcs_project = "planetupload"
+bucketName = "mai_2023"  # bucket of the market geojsons, read by buildGeometryCatalog
+gcs_clients = {}  # GCS clients by process and purpose, created on first use by gcs_client
+gcs_lock = threading.Lock()
+gcs_pool_size = 32  # connections kept open per GCS client
 order_url = "https://api.planet.com/compute/ops/orders/v2"
 search_url = "https://api.planet.com/data/v1/quick-search"
-session = requests.Session()
 colspecs = [(0, 24), (26, 38), (40, 82), (84, 93), (95, 1000)]
 max_retries = 10
-retry_interval = 5
+retry_interval = 5  # base delay in seconds of the exponential backoff between retries
+max_retry_interval = 120  # cap of the backoff delay
+request_timeout = 60
+anchor_min_clear_percent = 0  # lowest clear_percent and clear_confidence_percent of the relaxed anchor search
+max_concurrent_searches = 8
+order_chunk_size = 499  # items per order, Planet's limit minus the anchor image
+order_listing_delay = 60  # seconds during which a new order counts as in flight even if not listed yet
+download_queue_file = "./temp/download_queue.json"
+inventory_db = "./temp/gcs_inventory.sqlite"  # local index of the blobs in the image buckets, see refreshInventory
+required_assets = {"AnalyticMS_SR_harmonized", "udm2", "metadata"}  # files of a complete image delivery
+inventory_max_age = 300
+delete_batch_size = 100  # deletes per GCS batch request (the API allows at most 100)
+metadata_table_dir = "./temp/imgProperties"  # image property tables written by process_json_files
+geometry_catalog_db = "./temp/geometry_catalog.sqlite"  # convex hulls of the markets per country, see buildGeometryCatalog
+geometry_catalog_max_age = 86400  # seconds after which a catalog is rebuilt when a location is missing from it
+planet_sessions = {}  # one pooled session per process and Planet API key, shared by all Planet requests
+planet_lock = threading.Lock()
+planet_paused_until = 0  # set when Planet rate-limits us, so that all threads back off together
 endDate = datetime.today().strftime("%Y-%m-%d")
 date_pattern1 = r"_20\d{2}-\d{2}-\d{2}_"
 date_pattern2 = r"PSScene/20\d{2}\d{2}\d{2}_"
@@ -112,8 +131,8 @@ def downloader(
             print(f"  - Product Bundle: analytic_sr_udm2")
             print(f"  - Item Type: PSScene")
             print(f"  - Tools: Clip, COG format, Harmonize to Sentinel-2")
-            print(f"  - Number of chunks: {(preview_info['image_count'] + 498) // 499}")
-            print(f"  - Items per chunk: {min(499, preview_info['image_count'])}")
+            print(f"  - Number of chunks: {-(-preview_info['image_count'] // order_chunk_size)}")
+            print(f"  - Items per chunk: {min(order_chunk_size, preview_info['image_count'])}")
             
             if preview_info.get('sample_product_ids'):
                 print(f"\nSample Product IDs (first 5):")
@@ -128,396 +147,134 @@ def downloader(
     # Extract json of each feature, convert to convex hull geometry, and export to temp folder as a json
     saveConvexHull(loc, locGroup)
 
-    # While loc downloads not completed
-    complete = False
-    status = ""
-    downloads_initiated = 0
-    while not complete:
-        # find locs whose imagery downloads are processing and check if they have finished:
-        if status == "initiated":
-            status = checkExistingImages(
-                loc,
-                locGroup,
-                endDate,
-                maxCloudCover,
-                planet_api_key,
-                status,
-                gcs_bucket
-            )
-
-            # Check if downloads are complete
-            if status == "complete":
-                complete = True
-
-            # check if the location has reached the attempted downloads limit -- if so, mark as failed
-            if downloads_initiated > 4:
-                print(f"{loc} reached download limit without success -- marking as failed.")
-                complete = True
-                response_text = "Failed due to repeated unsuccessful attempts."
-                return response_text
-
-        # If no orders are currently running for this location
-        running_locs = checkRunningOrders(planet_api_key)
-        if loc not in running_locs and status != "complete":
-            status = requestDownloads(
-                loc,
-                locGroup,
-                endDate,
-                private_key,
-                maxRunningDownloads,
-                maxCloudCover,
-                planet_api_key,
-                gcs_bucket
-            )
-            downloads_initiated += 1
-
-        time.sleep(10)
+    # The location is downloaded by download_scheduler on its own, which orders chunks of order_chunk_size items and waits
+    # on the order states. Its queue has a file of its own, kept only until the location is done, so that an interrupted run resumes
+    queue_file = os.path.splitext(download_queue_file)[0] + f"_{loc}.json"
+    status = download_scheduler(
+        [(loc, locGroup)], endDate, maxRunningDownloads, maxCloudCover, planet_api_key, gcs_bucket, private_key,
+        queue_file=queue_file,
+    ).get(loc)
+    if os.path.isfile(queue_file):
+        os.remove(queue_file)
+
+    if status != "complete":
+        print(f"{loc} reached download limit without success -- marking as failed.")
+        response_text = "Failed due to repeated unsuccessful attempts."
+        return response_text
 
     print(f"All downloads complete for {loc}!")
 
 
-def requestDownloads(
-    loc,
-    locGroup,
-    endDate,
-    private_key,
-    maxRunningDownloads,
-    maxCloudCover,
-    planet_api_key=None,
-    gcs_bucket=None
-):
-    # Function to request the downloads needed for a given location.
-    # Inputs:
-    # new_products [list]:      list of sr-corrected image product ids that should be downloaded from Planet
-    # forAnchoring [string]:    planet image product id that should be used for anchoring the downloaded images
-    # private_key [string]:     file path to planet encrypted private key
+def submitOrder(loc, itemIDs, chunk, geojson_data, planet_api_key, gcs_bucket, private_key):
+    # Places the order of one chunk of items of a location, delivered to gs://{gcs_bucket}/{loc}.
+    # Returns a status ("submitted", "no_new_items" or "failed") and the order json
+    order_payload = fn_order_payload()
+    order_payload["products"][0]["item_ids"] = itemIDs
+    order_payload["name"] = f"{loc} chunk {chunk}"
+    order_payload["delivery"]["google_cloud_storage"]["bucket"] = gcs_bucket
+    order_payload["delivery"]["google_cloud_storage"]["path_prefix"] = loc
+    order_payload["delivery"]["google_cloud_storage"]["credentials"] = (private_key)
+    order_payload["tools"][0]["clip"]["aoi"] = geojson_data["geometry"]
 
-    # Validation: Cannot request downloads without a bucket
-    if gcs_bucket is None or gcs_bucket == "":
-        logger.error(f"Cannot request downloads for {loc}: No GCS bucket provided")
-        return "failed"
-    
-    # Validation: Cannot request downloads without an API key
-    if planet_api_key is None or planet_api_key == "":
-        logger.error(f"Cannot request downloads for {loc}: No Planet API key provided")
-        return "failed"
-
-    session = requests.Session()
-    session.auth = (planet_api_key, "")
-
-    new_products, forAnchoring, status = checkExistingImages(
-        loc,
-        locGroup,
-        endDate,
-        maxCloudCover,
-        planet_api_key,
-        "initiated",  # Default status when requesting downloads
-        gcs_bucket
+    order_response = planet_request(
+        "POST", order_url, planet_api_key, ok_status=(202,), json=order_payload
     )
+    if order_response is None or is_retryable(order_response.status_code):
+        logger.debug("Maximum retry attempts reached. Request failed.")
+        return "failed", None
 
-    if status == "complete":
-        return status
-    
-    logger.debug(f"New SR products found: {new_products[0:5]} ...")
-    orders = []
-
-    with open(f"./temp/Jsons/{loc}feature.geojson") as f:
-        geojson_data = json.loads(f.read())
-
-    running = checkRunningOrders(planet_api_key)
-    len_running = len(running)
-
-    if len_running > maxRunningDownloads:
-        print(f"{len_running} running orders -- waiting for some to finish before starting {loc}...")
-        time.sleep(120)
+    logger.debug(f"Order status code: {order_response.status_code}")
+    try:
+        order = order_response.json()
+    except ValueError:
+        logger.debug("failed")
+        return "failed", None
+
+    if order_response.status_code != 202:
+        logger.debug(order)
+        if (
+            "Order request resulted in no acceptable assets" in json.dumps(order)
+            or "Unable to accept order: Cannot coregister single item. " in json.dumps(order)
+        ):
+            return "no_new_items", order
+        return "failed", order
+
+    logger.debug(f"Order ID: {order.get('id')} \n")
+    return "submitted", order
+
+
+def findNewProducts(loc, locGroup, endDate, maxCloudCover, planet_api_key, gcs_bucket, features_sr=None):
+    # Compares the Planet imagery available for a location to what is already in gs://{gcs_bucket}/{loc}.
+    # features_sr are the results of a search already run for the location (e.g. by searchAvailableImgs_many).
+    # Returns the product IDs still to download and the anchor product ID (None if no anchor image was found)
+
+    # Search for collections that already exist for the location, and store them in a list
+    logger.debug(f"Looking up existing imagery for {loc}...")
+    pattern = r"{}/(.*?)_3B_".format(loc)  # pattern to search for
+
+    # Retrieve list of existing images in GCS bucket
+    existing = [
+        f"gs://{gcs_bucket}/{blob['name']}"
+        for blob in inventoryBlobs(gcs_bucket, loc)
+        if re.search(pattern, blob["name"]) and blob["name"].endswith(".tif")
+    ]
 
-    else:
-        max_retries = 10
-
-        if len(new_products) >= 10:
-            print(f"SR download initiated for {loc} -- requesting {len(new_products)} products")
-            # Database update to mark location as initiated
-            #updateLocationFileStatus(loc, "00DownStatus", "initiated", replace=True)
-            status = "initiated"  # In lieu of the above line, use a status variable to track initiation
-
-            for i in range(0, len(new_products), 499):
-                logger.debug(f"Chunk {i}")
-                itemIDs = []
-                itemIDs.extend(new_products[i : i + 499])
-                itemIDs.append(str(forAnchoring))
-
-                order_payload = fn_order_payload()
-                order_payload["products"][0]["item_ids"] = itemIDs
-                order_payload["name"] = f"{loc} chunk {i}"
-                order_payload["delivery"]["google_cloud_storage"]["bucket"] = gcs_bucket
-                order_payload["delivery"]["google_cloud_storage"]["path_prefix"] = loc
-                order_payload["delivery"]["google_cloud_storage"]["credentials"] = (private_key)
-                order_payload["tools"][0]["clip"]["aoi"] = geojson_data["geometry"]
-
-                for attempt in range(max_retries + 1):
-                    order_response = session.post(order_url, json=order_payload)
-                    try:
-                        if order_response.status_code == 202:
-                            break
-                        else:
-                            logger.debug(
-                                f"Request attempt {attempt + 1} failed with status code: {order_response.status_code}"
-                            )
-                    except Exception as e:
-                        logger.debug(
-                            f"Request attempt {attempt + 1} failed with error: {e}"
-                        )
-                    if attempt < max_retries:
-                        # Sleep before the next retry
-                        time.sleep(retry_interval)
-                    else:
-                        logger.debug("Maximum retry attempts reached. Request failed.")
-                        status = "failed"
-                        return status
-                
-                orders.append(order_response.json())
-
-                logger.debug(f"Order status code: {order_response.status_code}")
-                try:
-                    logger.debug(f"Order ID: {order_response.json()['id']} \n")
-                except:
-                    logger.debug("failed")
-
-                if order_response.status_code != 202:
-                    logger.debug(order_response.json())
-                    if (
-                        "Order request resulted in no acceptable assets"
-                        in json.dumps(order_response.json())
-                        or "Unable to accept order: Cannot coregister single item. "
-                        in json.dumps(order_response.json())
-                    ):
-                        logger.debug(f"SR download marked complete for {loc} since no new items were registered.")
-                        status = "complete"
-                        return status
-
-                time.sleep(60)
-    
-    # Return status of initiated if we reach this point (normal case)
-    return "initiated"
+    logger.debug(f"Found {len(existing) / 2} images for {loc} -- updating location file.")
+    # Logic to count unique images based on naming pattern
+    #updateLocationFileStatus(loc, "totalDownloaded", len(existing) / 2, replace=True)
 
+    # Convex hull of the location, looked up in the geometry catalog if it is not saved yet
+    geojson_data = loadConvexHull(loc, locGroup)
 
-def checkExistingImages(
-    loc,
-    locGroup,
-    endDate,
-    maxCloudCover,
-    planet_api_key=None,
-    status="",
-    gcs_bucket=None
-):
-    # Takes a location, locGroup, and end date, and compares available Planet imagery to what is currently downloaded.
-    # If this is the first time running for this loc, it creates a storage folder for the downloaded images.
-    #
-    # Inputs:
-    # loc:      string (e.g: "lon14_115lat38_4743")
-    # locGroup: string (e.g: "79_Tigray_1")
-    # endDate:  string (e.g: "2023-09-30")
-    #
-    # Returns:
-    # new_products:      list of planet product IDs for SR images that we want, but don't have.
-    # forAnchoring:      string of a planet product ID to use for anchoring (QUESTION: could re-making the anchor each time cause problems?
-    # GEEbucket:         string of a generated GEE image bucket name for this location
-
-    # Validation: Cannot check existing images without an API key
-    if planet_api_key is None or planet_api_key == "":
-        logger.error(f"Cannot check existing images for {loc}: No Planet API key provided")
-        return [], "", "failed"
-    
-    # Validation: Cannot check existing images without a bucket (in normal mode)
-    if gcs_bucket is None or gcs_bucket == "":
-        logger.error(f"Cannot check existing images for {loc}: No GCS bucket provided")
-        return [], "", "failed"
-
-    session = requests.Session()
-    session.auth = (planet_api_key, "")
-
-    logger.debug(f"Checking existing images for {loc} in {locGroup} up to {endDate}:")
-
-    # Logic to skip if downloads already marked complete
-    if status == "complete":
-        print("All downloads marked complete for", loc, " -- skipping image check.")
-        new_products, forAnchoring = ("none", "none")
-        status = "complete"
-        return new_products, forAnchoring, status
-
-    # If image downloads already running, don't run.
-    running = checkRunningOrders(planet_api_key)
-    logger.debug(f"locs with running Planet orders: {set(running)}")
-    if loc in running:
-        logger.debug(f"Downloads currently running for {loc} -- skipping image check.")
-        new_products, forAnchoring = ("none", "none")
-        status = "initiated"
-        time.sleep(180)
+    # Get images to download
+    if features_sr is None:
+        features_sr = searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key)
 
-    else:
-        # Search for collections that already exist for the location, and store them in a list
-        logger.debug(f"Looking up existing imagery for {loc}...")
-        pattern = r"{}/(.*?)_3B_".format(loc)  # pattern to search for
-        tif_pattern = r"\.tif$"  # Matches strings ending with .tif
-
-        # Retrieve list of existing images in GCS bucket
-        os.system(f"gcloud storage ls --recursive gs://{gcs_bucket}/{loc} > ./temp/alreadyUp{loc}.txt")
-        existing = []
-        with open(f"./temp/alreadyUp{loc}.txt", "r") as file:
-            for line in file:
-                line = line.strip()
-                if re.search(pattern, line):
-                    tif_match = re.search(tif_pattern, line)
-                    if tif_match:
-                        existing.append(line)  # Append the entire
-
-        logger.debug(f"Found {len(existing) / 2} images for {loc} -- updating location file.")
-        # Logic to count unique images based on naming pattern
-        #updateLocationFileStatus(loc, "totalDownloaded", len(existing) / 2, replace=True)
-
-        # Open up the convex hull json
-        with open(f"./temp/Jsons/{loc}feature.geojson") as f:
-            geojson_data = json.loads(f.read())  
-
-        ### Look for an anchor image
-        # Search parameters for anchoring image
-        search_percent = 99
-        while True:  # loop until anchor image is found
-            search_para_1 = fn_search_para_1()
-            search_para_1["filter"]["config"][0]["config"]["coordinates"] = (
-                geojson_data["geometry"]["coordinates"]
-            )
-            search_para_1["filter"]["config"][1]["config"]["gte"] = (
-                "2020-01-01" + "T00:00:00Z"
-            )
-            search_para_1["filter"]["config"][1]["config"]["lte"] = (
-                endDate + "T23:59:59Z"
-            )
-            search_para_1["filter"]["config"][2]["config"]["lte"] = 0  # cloud cover
-            search_para_1["filter"]["config"][3]["config"]["lte"] = (
-                0  # anomalous_pixels
-            )
-            search_para_1["filter"]["config"][4]["config"]["gte"] = (
-                search_percent  # clear_confidence_percent
-            )
-            search_para_1["filter"]["config"][5]["config"]["gte"] = (
-                search_percent  # clear_percent
-            )
-            search_para_1["filter"]["config"][6]["config"] = ["true"]  # ground_control
-
-            search_percent -= 1  # reduce by 1 before next loop
-
-            # Search for anchor products using the Data API
-            max_retries = 10
-            for attempt in range(max_retries + 1):
-                try:
-                    search_response = session.post(search_url, json=search_para_1)
-                    if search_response.status_code == 200:
-                        # Request succeeded, break out of the loop
-                        break
-                    else:
-                        logger.debug(
-                            f"Request attempt {attempt + 1} failed with status code: {search_response.status_code}"
-                        )
-                except Exception as e:
-                    logger.debug(
-                        f"Request attempt {attempt + 1} failed with error: {e}"
-                    )
-                if attempt < max_retries:
-                    # Sleep before the next retry
-                    time.sleep(retry_interval)
-                else:
-                    logger.debug("Maximum retry attempts reached. Request failed.")
-
-            # Count number of features in first page
-            geojson = search_response.json()
-            features = geojson["features"]
-
-            # Loop over all pages to count total number of features
-            while True:
-                next_link = geojson.get("_links", {}).get("_next")
-                if next_link is None:
-                    break
-
-                page_url = next_link
-                for attempt in range(max_retries + 1):
-                    try:
-                        r = session.get(page_url)
-                        if r.status_code == 200:
-                            # Request succeeded, break out of the loop
-                            break
-                        else:
-                            logger.debug(
-                                f"Request attempt {attempt + 1} failed with status code: {r.status_code}"
-                            )
-                    except Exception as e:
-                        logger.debug(
-                            f"Request attempt {attempt + 1} failed with error: {e}"
-                        )
-                    if attempt < max_retries:
-                        # Sleep before the next retry
-                        time.sleep(retry_interval)
-                    else:
-                        logger.debug("Maximum retry attempts reached. Request failed.")
-                geojson = r.json()
-                features += geojson["features"]
+    ### Look for an anchor image, ranked among the images found above or, failing that, one relaxed search
+    forAnchoring = selectAnchor(loc, geojson_data, endDate, planet_api_key, features_sr)
+    if forAnchoring is None:
+        return [], None
 
-            if len(features) != 0:
-                logger.debug(
-                    f"Image found for anchoring with search_percent = {search_percent}"
-                )
-                break  # break out of loop once anchor image is found
+    # Retrieve the product IDs from the search response that we don't already have
+    product_ids = []
+    for i in features_sr:
+        product_ids.append(i["id"])
+    new_products = remove_overlapping_strings(product_ids, existing)
 
-        # Retrieve the product IDs from the search response
-        product_ids = []
-        for i in features:
-            product_ids.append(i["id"])  # EDIT:
+    logger.debug(f"{loc} total number of products available: {len(product_ids)}")
+    logger.debug(f"{loc} total number of existing products: {len(existing)}")
+    logger.debug(f"{loc} number of new products available: {len(new_products)}")
 
-        # Arbitrarily choose the last image for anchoring
-        forAnchoring = product_ids[-1]
+    # Report images whose delivery is incomplete, e.g. a tif without its udm2 or metadata json
+    partial = partialDownloads(gcs_bucket, loc)
+    if partial:
+        logger.warning(f"{loc}: {len(partial)} images partially downloaded, e.g. {list(partial.items())[:3]}")
 
-        # Get images to download
-        features_sr = searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key)
+    return new_products, forAnchoring
 
-        # Retrieve the product IDs from the search response that we don't already have
-        product_ids = []
-        for i in features_sr:
-            product_ids.append(i["id"])
-        new_products = remove_overlapping_strings(product_ids, existing)
-
-        logger.debug(f"{loc} total number of products available: {len(product_ids)}")
-        logger.debug(f"{loc} total number of existing products: {len(existing)}")
-        logger.debug(f"{loc} number of new products available: {len(new_products)}")
-
-        # If the number of new products is less than 5 for both download types, mark the location complete
-        if len(new_products) < 10:
-            print(f"All images already downloaded for {loc} -- marking complete")
-
-            # delete duplicate images
-            deleteDuplicates_gcs(loc, gcs_bucket)
-            # Extract harmonized files and image IDs
-            _, image_IDs = extract_harmonized_files_and_ids(
-                f"gs://{gcs_bucket}/{loc}", loc
-            )
-            logger.debug("image_IDs: %d, %s", len(image_IDs), image_IDs[0:5])
-
-            # Process JSON files and create FeatureCollection
-            features_json, features = process_json_files(loc, gcs_bucket)
-            geojson = create_geojson(features_json)
-            client = storage.Client()
-            bucket = client.bucket(gcs_bucket)
-            blob = bucket.blob(f"imgProperties/{loc}.geojson")
-            blob.upload_from_string(
-                json.dumps(geojson), content_type="application/json"
-            )
-            print("image properties uploaded", loc)
 
-            # Database update to mark location complete
-            #updateLocationFileStatus(loc, "00DownStatus", "complete", replace=True)
-            status = "complete" # In lieu of the above line, use a status variable to track completion
-            print(f"Downloading complete for {loc}")
+def finalizeLocation(loc, gcs_bucket):
+    # Cleans up the downloads of a completed location and uploads the properties of its images
 
-    return new_products, forAnchoring, status
+    # delete duplicate images
+    deleteDuplicates_gcs(loc, gcs_bucket)
+    # Extract harmonized files and image IDs
+    _, image_IDs = extract_harmonized_files_and_ids(
+        f"gs://{gcs_bucket}/{loc}", loc
+    )
+    logger.debug("image_IDs: %d, %s", len(image_IDs), image_IDs[0:5])
+
+    # Process JSON files and create FeatureCollection
+    table_path, _ = process_json_files(loc, gcs_bucket)
+    geojson = create_geojson(table_features(table_path) if table_path and os.path.isfile(table_path) else [])
+    bucket = gcs_client().bucket(gcs_bucket)
+    blob = bucket.blob(f"imgProperties/{loc}.geojson")
+    blob.upload_from_string(
+        json.dumps(geojson), content_type="application/json"
+    )
+    if table_path and os.path.isfile(table_path):
+        bucket.blob(f"imgProperties/{loc}.parquet").upload_from_filename(table_path)
+    print("image properties uploaded", loc)
 
 
 def searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key=None):
@@ -527,9 +284,6 @@ def searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key=Non
     
     logger.debug(f"Requesting available images for cloud cover {maxCloudCover}...")
 
-    session = requests.Session()
-    session.auth = (planet_api_key, "")
-
     # Create new search parameters to capture all images of interest
     search_para_2 = fn_search_para_2()
     search_para_2["filter"]["config"][0]["config"]["coordinates"] = geojson_data[
@@ -539,55 +293,8 @@ def searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key=Non
     search_para_2["filter"]["config"][1]["config"]["lte"] = endDate + "T23:59:59Z"
     search_para_2["filter"]["config"][2]["config"]["lte"] = maxCloudCover
 
-    # Search for products using the Data API
-    for attempt in range(max_retries + 1):
-        try:
-            search_response = session.post(search_url, json=search_para_2)
-            if search_response.status_code == 200:
-                # Request succeeded, break out of the loop
-                break
-            else:
-                logger.debug(
-                    f"Request attempt {attempt + 1} failed with status code: {search_response.status_code}"
-                )
-        except Exception as e:
-            logger.debug(f"Request attempt {attempt + 1} failed with error: {e}")
-        if attempt < max_retries:
-            # Sleep before the next retry
-            time.sleep(retry_interval)
-        else:
-            logger.debug("Maximum retry attempts reached. Request failed.")
-
-    # Retrieve all features that are returned from the seatch
-    geojson = search_response.json()
-    features = geojson["features"]
-
-    # Loop over all pages to count total number of features
-    while True:
-        next_link = geojson.get("_links", {}).get("_next")
-        if next_link is None:
-            break
-
-        page_url = next_link
-        for attempt in range(max_retries + 1):
-            try:
-                r = session.get(page_url)
-                if r.status_code == 200:
-                    # Request succeeded, break out of the loop
-                    break
-                else:
-                    logger.debug(
-                        f"Request attempt {attempt + 1} failed with status code: {r.status_code}"
-                    )
-            except Exception as e:
-                logger.debug(f"Request attempt {attempt + 1} failed with error: {e}")
-            if attempt < max_retries:
-                # Sleep before the next retry
-                time.sleep(retry_interval)
-            else:
-                logger.debug("Maximum retry attempts reached. Request failed.")
-        geojson = r.json()
-        features += geojson["features"]
+    # Retrieve all features that are returned from the search, over all pages
+    features = planet_search(search_para_2, planet_api_key)
 
     # Create lists of the SR and non-SR features that are returned from the search
     features_sr = [
@@ -600,6 +307,287 @@ def searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key=Non
     return features_sr
 
 
+def is_anchor_candidate(feature, endDate):
+    # The anchor search filters of fn_search_para_1 (apart from the clear percentages), checked on a search result
+    props = feature.get("properties", {})
+    return (
+        "2020-01-01" <= props.get("acquired", "")[:10] <= endDate
+        and props.get("cloud_cover", 1) == 0
+        and props.get("anomalous_pixels", 1) == 0
+        and str(props.get("ground_control")).lower() == "true"
+        and "ortho_analytic_4b_sr" in feature.get("assets", [])
+        and "ortho_udm2" in feature.get("assets", [])
+        and "assets.ortho_analytic_4b_sr:download" in feature.get("_permissions", ["assets.ortho_analytic_4b_sr:download"])
+    )
+
+
+def rank_anchor_candidates(features):
+    # Orders candidates from best to worst: highest threshold at which both clear percentages pass (the criterion of
+    # the former search loop), then clear_percent, clear_confidence_percent and fewest anomalous pixels.
+    # Remaining ties go to the most recent image, then the lowest id, so that the choice is deterministic
+    def quality(feature):
+        props = feature["properties"]
+        clear = props.get("clear_percent", 0)
+        confidence = props.get("clear_confidence_percent", 0)
+        return (-min(clear, confidence), -clear, -confidence, props.get("anomalous_pixels", 0))
+    ranked = sorted(features, key=lambda feature: feature["id"])
+    ranked = sorted(ranked, key=lambda feature: feature["properties"].get("acquired", ""), reverse=True)
+    return sorted(ranked, key=quality)
+
+
+def selectAnchor(loc, geojson_data, endDate, planet_api_key, features=None):
+    # Returns the product ID used for anchoring the downloads of a location. The choice is stored in
+    # ./temp/Jsons/{loc}anchor.json and reused in later runs, so that the anchor of a location does not change.
+    # Inputs:
+    # features [list]:  search results to rank first (e.g. from searchAvailableImgs), to avoid a separate search
+    anchor_file = f"./temp/Jsons/{loc}anchor.json"
+    if os.path.isfile(anchor_file):
+        with open(anchor_file) as f:
+            return json.load(f)["id"]
+
+    candidates = [feature for feature in features or [] if is_anchor_candidate(feature, endDate)]
+    if not candidates:
+        # One relaxed search with the anchor filters
+        search_para_1 = fn_search_para_1()
+        search_para_1["filter"]["config"][0]["config"]["coordinates"] = (
+            geojson_data["geometry"]["coordinates"]
+        )
+        search_para_1["filter"]["config"][1]["config"]["gte"] = "2020-01-01T00:00:00Z"
+        search_para_1["filter"]["config"][1]["config"]["lte"] = endDate + "T23:59:59Z"
+        search_para_1["filter"]["config"][2]["config"]["lte"] = 0  # cloud cover
+        search_para_1["filter"]["config"][3]["config"]["lte"] = 0  # anomalous_pixels
+        search_para_1["filter"]["config"][4]["config"]["gte"] = anchor_min_clear_percent  # clear_confidence_percent
+        search_para_1["filter"]["config"][5]["config"]["gte"] = anchor_min_clear_percent  # clear_percent
+        search_para_1["filter"]["config"][6]["config"] = ["true"]  # ground_control
+        candidates = planet_search(search_para_1, planet_api_key)
+    if not candidates:
+        return None
+
+    anchor = rank_anchor_candidates(candidates)[0]
+    logger.debug(f"Anchor for {loc}: {anchor['id']} out of {len(candidates)} candidates")
+    with open(anchor_file, "w") as f:
+        json.dump({"id": anchor["id"], "properties": anchor["properties"]}, f)
+    return anchor["id"]
+
+
+def searchAvailableImgs_many(geojsons, endDate, maxCloudCover, planet_api_key=None, max_workers=None):
+    # Runs searchAvailableImgs for many locations at once.
+    # Inputs:
+    # geojsons [dict]:  convex hull geojson per location
+    # Returns a dict of SR features per location; locations whose search failed are left out, so that callers search them again
+    features_by_loc = {}
+    with ThreadPoolExecutor(max_workers=max_workers or max_concurrent_searches) as executor:
+        future_to_loc = {
+            executor.submit(searchAvailableImgs, geojson_data, endDate, maxCloudCover, planet_api_key): loc
+            for loc, geojson_data in geojsons.items()
+        }
+        for future in as_completed(future_to_loc):
+            loc = future_to_loc[future]
+            try:
+                features_by_loc[loc] = future.result()
+            except Exception as exc:
+                logger.error(f"Search for {loc} generated an exception: {exc}")
+    return features_by_loc
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+# DOWNLOAD SCHEDULER
+# -------------------------------------------------------------------------------------------------------------------------------
+
+def download_scheduler(
+    locs,
+    endDate="2024-12-31",
+    maxRunningDownloads=10,
+    maxCloudCover=50,
+    planet_api_key=None,
+    gcs_bucket=None,
+    private_key="",
+    poll_interval=30,
+    queue_file=download_queue_file,
+    max_attempts=5,
+):
+    # Downloads the imagery of many locations, keeping maxRunningDownloads orders in flight across all of them.
+    # Order states are polled with one listing per round, and the next chunk is ordered as soon as a slot frees up.
+    # The queue is saved to queue_file after every change, so that a restarted scheduler resumes where it stopped.
+    #
+    # Inputs:
+    # locs [list]:          (loc, locGroup) tuples, downloaded in this order
+    # max_attempts [int]:   rounds of orders per location before it is marked failed (as in downloader)
+    #
+    # Returns the status of each location ("complete" or "failed")
+
+    if planet_api_key is None or planet_api_key == "" or gcs_bucket is None or gcs_bucket == "":
+        logger.error("Cannot schedule downloads: a Planet API key and a GCS bucket are required")
+        return {}
+
+    queue = load_download_queue(queue_file, locs)
+    while True:
+        try:
+            running = runningOrders(planet_api_key)
+        except Exception as e:
+            logger.error(f"Listing running orders failed: {e} -- retrying in {poll_interval}s")
+            time.sleep(poll_interval)
+            continue
+        now = time.time()
+        in_flight = set(running) | {
+            order["id"] for entry in queue.values() for order in entry["orders"]
+            if now - order["submitted"] < order_listing_delay
+        }
+        free = maxRunningDownloads - len(in_flight)
+        progress = False
+        # the image searches of the locations checked this round run concurrently, before the locations are processed
+        searches = searchLocations(queue, in_flight, free, now, endDate, maxCloudCover, planet_api_key, max_attempts)
+
+        for loc, entry in queue.items():
+            # locations that are done, or waiting to retry a failed step, are skipped
+            if entry["status"] in ("complete", "failed") or now < entry.get("retry_at", 0):
+                continue
+            try:
+                # locations whose orders have all finished are checked again, or finalized if Planet had nothing left to deliver
+                if entry["status"] == "ordering" and not entry["chunks"] and not in_flight & {o["id"] for o in entry["orders"]}:
+                    entry["status"] = "finalizing" if entry.get("no_new_items") else "pending"
+                    invalidateInventory(gcs_bucket, loc)
+
+                # a first check needs a free slot, checks after finished orders do not
+                if entry["status"] == "pending" and (free > 0 or entry["attempts"] > 0):
+                    planLocation(loc, entry, endDate, maxCloudCover, planet_api_key, gcs_bucket, max_attempts, searches.get(loc))
+                    save_download_queue(queue, queue_file)
+                    progress = True
+
+                if entry["status"] == "finalizing":
+                    finalizeLocation(loc, gcs_bucket)
+                    entry["status"] = "complete"
+                    print(f"Downloading complete for {loc}")
+                    save_download_queue(queue, queue_file)
+                    progress = True
+
+                while entry["status"] == "ordering" and entry["chunks"] and free > 0:
+                    chunk = entry["chunks"][0]
+                    geojson_data = loadConvexHull(loc, entry["locGroup"])
+                    order_status, order = submitOrder(
+                        loc, chunk["items"] + [entry["anchor"]], chunk["start"], geojson_data,
+                        planet_api_key, gcs_bucket, private_key
+                    )
+                    if order_status == "failed":
+                        print(f"Order of chunk {chunk['start']} failed for {loc} -- marking as failed.")
+                        entry["status"] = "failed"
+                    elif order_status == "no_new_items":
+                        # Planet accepts none of the items, so searching again would find the same ones: the location
+                        # is complete once its other orders finish
+                        print(f"No deliverable items left for {loc} -- marking complete once its orders finish")
+                        entry["chunks"] = []
+                        entry["no_new_items"] = True
+                    else:
+                        entry["chunks"].pop(0)
+                        entry["orders"].append({"id": order["id"], "submitted": time.time()})
+                        in_flight.add(order["id"])
+                        free -= 1
+                    save_download_queue(queue, queue_file)
+                    progress = True
+            except Exception as e:
+                # a failed step (e.g. the image search, the hull lookup or the finalization) is retried, it does not stop the other locations
+                retryLocation(loc, entry, f"{type(e).__name__}: {e}", max_attempts)
+                save_download_queue(queue, queue_file)
+                progress = True
+
+        if all(entry["status"] in ("complete", "failed") for entry in queue.values()):
+            break
+        if not progress:
+            time.sleep(poll_interval)
+
+    print(f"Scheduler finished: {sum(e['status'] == 'complete' for e in queue.values())} complete, "
+          f"{sum(e['status'] == 'failed' for e in queue.values())} failed")
+    return {loc: entry["status"] for loc, entry in queue.items()}
+
+
+def searchLocations(queue, in_flight, free, now, endDate, maxCloudCover, planet_api_key, max_attempts):
+    # Runs the image searches of the queued locations that download_scheduler checks this round through searchAvailableImgs_many:
+    # the locations whose orders have all finished, those waiting for a new check, and as many first checks as there are free slots.
+    # Locations whose hull lookup or search fails are left out, planLocation then searches them itself (and retries on failure)
+    geojsons = {}
+    for loc, entry in queue.items():
+        if now < entry.get("retry_at", 0) or entry["attempts"] >= max_attempts:
+            continue
+        finished = (
+            entry["status"] == "ordering" and not entry["chunks"] and not entry.get("no_new_items")
+            and not in_flight & {o["id"] for o in entry["orders"]}
+        )
+        if entry["status"] == "pending" and entry["attempts"] == 0:
+            if free <= 0:
+                continue
+            free -= 1
+        elif not finished and entry["status"] != "pending":
+            continue
+        try:
+            geojsons[loc] = loadConvexHull(loc, entry["locGroup"])
+        except Exception as e:
+            logger.debug(f"Hull lookup for {loc} failed before its search: {e}")
+    if not geojsons:
+        return {}
+    return searchAvailableImgs_many(geojsons, endDate, maxCloudCover, planet_api_key)
+
+
+def planLocation(loc, entry, endDate, maxCloudCover, planet_api_key, gcs_bucket, max_attempts, features_sr=None):
+    # Compares available to downloaded imagery of a queued location, and either marks it for finalization
+    # or splits its new products into the chunks to order (features_sr: search results from searchLocations, if any)
+    if entry["attempts"] >= max_attempts:
+        print(f"{loc} reached download limit without success -- marking as failed.")
+        entry["status"] = "failed"
+        return
+    new_products, forAnchoring = findNewProducts(
+        loc, entry["locGroup"], endDate, maxCloudCover, planet_api_key, gcs_bucket, features_sr
+    )
+
+    if forAnchoring is None:
+        logger.error(f"No image found for anchoring {loc}")
+        entry["status"] = "failed"
+    elif len(new_products) < 10:
+        print(f"All images already downloaded for {loc} -- marking complete")
+        entry["status"] = "finalizing"
+    else:
+        print(f"SR download initiated for {loc} -- requesting {len(new_products)} products")
+        entry["attempts"] += 1
+        entry["anchor"] = str(forAnchoring)
+        entry["chunks"] = [
+            {"start": i, "items": new_products[i : i + order_chunk_size]}
+            for i in range(0, len(new_products), order_chunk_size)
+        ]
+        entry["status"] = "ordering"
+
+
+def retryLocation(loc, entry, error, max_attempts):
+    # Counts a failed step of a queued location as an attempt, retried after a backoff until max_attempts are used up
+    entry["attempts"] += 1
+    if entry["attempts"] >= max_attempts:
+        print(f"{loc} failed {entry['attempts']} times -- marking as failed. Last error: {error}")
+        entry["status"] = "failed"
+        return
+    delay = retry_delay(entry["attempts"])
+    logger.error(f"{loc}: {error} -- retrying in {delay:.0f}s (attempt {entry['attempts']} of {max_attempts})")
+    entry["retry_at"] = time.time() + delay
+
+
+def load_download_queue(queue_file, locs):
+    # Queue saved by a previous run, with the locations not in it added as pending
+    queue = {}
+    if os.path.isfile(queue_file):
+        with open(queue_file) as f:
+            queue = json.load(f)
+    for loc, locGroup in locs:
+        queue.setdefault(
+            loc, {"locGroup": locGroup, "status": "pending", "attempts": 0, "anchor": None, "chunks": [], "orders": []}
+        )
+    return queue
+
+
+def save_download_queue(queue, queue_file):
+    # Written to a temporary file first, so that an interrupted save does not corrupt the queue
+    os.makedirs(os.path.dirname(queue_file) or ".", exist_ok=True)
+    with open(queue_file + ".tmp", "w") as f:
+        json.dump(queue, f)
+    os.replace(queue_file + ".tmp", queue_file)
+
+
 # -------------------------------------------------------------------------------------------------------------------------------
 # PREVIEW FUNCTIONS
 # -------------------------------------------------------------------------------------------------------------------------------
@@ -646,7 +634,7 @@ def show_request_structure_overview(loc, locGroup, endDate, maxCloudCover, gcs_b
     else:
         print(f"     - Destination Bucket: [Would be specified]")
         print(f"     - Path Prefix: {loc}")
-    print(f"     - Chunking: ~499 images per order (Planet limit)")
+    print(f"     - Chunking: ~{order_chunk_size} images per order (Planet limit)")
     
     print(f"\n4. Order Status Monitoring:")
     print(f"   URL: https://api.planet.com/compute/ops/orders/v2?state=running&state=queued")
@@ -677,12 +665,8 @@ def get_download_preview(loc, locGroup, endDate, maxCloudCover, planet_api_key):
     Returns a dictionary with image count and other useful information.
     """
     try:
-        # Extract json of each feature, convert to convex hull geometry, and export to temp folder as a json
-        saveConvexHull(loc, locGroup)
-        
-        # Open up the convex hull json
-        with open(f"./temp/Jsons/{loc}feature.geojson") as f:
-            geojson_data = json.loads(f.read())
+        # Convex hull of the location, from the geometry catalog
+        geojson_data = loadConvexHull(loc, locGroup)
         
         # Get available images using the same logic as the actual download
         features_sr = searchAvailableImgs(geojson_data, endDate, maxCloudCover, planet_api_key)
@@ -717,6 +701,213 @@ def get_download_preview(loc, locGroup, endDate, maxCloudCover, planet_api_key):
         }
 
 
+# -------------------------------------------------------------------------------------------------------------------------------
+# PLANET API CLIENT
+# -------------------------------------------------------------------------------------------------------------------------------
+
+def planet_session(planet_api_key):
+    # Returns the session for this API key, creating it on first use. Sessions keep their connections
+    # open between requests and are safe to share between the threads of searchAvailableImgs_many.
+    # Forked worker processes create their own, since open connections cannot be shared between processes.
+    key = (os.getpid(), planet_api_key)
+    with planet_lock:
+        session = planet_sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.auth = (planet_api_key, "")
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrent_searches * 2)
+            session.mount("https://", adapter)
+            planet_sessions[key] = session
+    return session
+
+
+def is_retryable(status_code):
+    # Rate limits, timeouts and server errors are worth retrying, other client errors are not
+    return status_code in (408, 429) or status_code >= 500
+
+
+def retry_delay(attempt, response=None):
+    # Seconds to wait before the next attempt: the Retry-After header if Planet sent one,
+    # otherwise exponential backoff with full jitter
+    if response is not None and response.headers.get("Retry-After"):
+        try:
+            return float(response.headers["Retry-After"])
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_retry_interval, retry_interval * 2**attempt))
+
+
+def planet_request(method, url, planet_api_key, ok_status=(200,), **kwargs):
+    # Sends a request to a Planet API with the shared session, retrying failed attempts.
+    # Returns the last response (which the caller checks against ok_status), or None if no attempt got a response.
+    global planet_paused_until
+    session = planet_session(planet_api_key)
+    response = None
+    for attempt in range(max_retries + 1):
+        # wait while another thread has been told to slow down
+        pause = planet_paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        try:
+            response = session.request(method, url, timeout=request_timeout, **kwargs)
+            if response.status_code in ok_status or not is_retryable(response.status_code):
+                return response
+            logger.debug(
+                f"Request attempt {attempt + 1} failed with status code: {response.status_code}"
+            )
+        except requests.RequestException as e:
+            response = None
+            logger.debug(f"Request attempt {attempt + 1} failed with error: {e}")
+        if attempt < max_retries:
+            delay = retry_delay(attempt, response)
+            if response is not None and response.status_code == 429:
+                with planet_lock:
+                    planet_paused_until = max(planet_paused_until, time.monotonic() + delay)
+            time.sleep(delay)
+        else:
+            logger.debug("Maximum retry attempts reached. Request failed.")
+    return response
+
+
+def planet_pages(method, url, planet_api_key, next_key="_next", **kwargs):
+    # Yields the json of each page of a paginated Planet response, following the next links
+    while url:
+        response = planet_request(method, url, planet_api_key, **kwargs)
+        if response is None:
+            raise requests.ConnectionError(f"No response from {url}")
+        response.raise_for_status()
+        data = response.json()
+        yield data
+        # next pages are plain GETs of the link
+        method, kwargs = "GET", {}
+        url = data.get("_links", {}).get(next_key)
+
+
+def planet_search(search_para, planet_api_key):
+    # Runs a Data API quick search and returns the features of all pages
+    features = []
+    for page in planet_pages("POST", search_url, planet_api_key, json=search_para):
+        features += page["features"]
+    return features
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+# GCS INVENTORY
+# -------------------------------------------------------------------------------------------------------------------------------
+
+def gcs_client(purpose="default"):
+    # Returns the GCS client of this process, creating it on first use, so that importing the module needs no
+    # credentials or network. The client keeps its connections open and is shared by all functions and threads.
+    # Batches (deleteDuplicates_gcs) use a client of their own, since a client sends every request made while one
+    # of its batches is open as part of that batch, whichever thread makes it.
+    # The client is given a session with a connection pool of gcs_pool_size, as its threads share it. It is passed
+    # through _http, a private hook of storage.Client: the client has no public option for its transport
+    # (client_options only sets endpoints and credentials), so check it when upgrading google-cloud-storage.
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+
+    key = (os.getpid(), purpose)
+    with gcs_lock:
+        client = gcs_clients.get(key)
+        if client is None:
+            if os.environ.get("STORAGE_EMULATOR_HOST"):
+                credentials = AnonymousCredentials()  # as storage.Client does for an emulator
+            else:
+                credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+            session = AuthorizedSession(credentials)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=gcs_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            client = storage.Client(project=gcs_project, credentials=credentials, _http=session)
+            gcs_clients[key] = client
+    return client
+
+
+def inventory_connection():
+    # Opens the local index of bucket contents, one row per blob
+    os.makedirs(os.path.dirname(inventory_db) or ".", exist_ok=True)
+    con = sqlite3.connect(inventory_db)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS blobs (bucket TEXT, name TEXT, loc TEXT, image_id TEXT, asset TEXT, "
+        "generation INTEGER, size INTEGER, PRIMARY KEY (bucket, name))"
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS blobs_image ON blobs (bucket, loc, image_id)")
+    con.execute("CREATE TABLE IF NOT EXISTS listings (bucket TEXT, loc TEXT, listed REAL, PRIMARY KEY (bucket, loc))")
+    return con
+
+
+def parse_blob_name(name):
+    # Location, Planet item ID and asset type of a delivered file, e.g.
+    # "{loc}/{order}/PSScene/20230101_071234_12_2439_3B_AnalyticMS_SR_harmonized_clip_file_format.tif"
+    # -> (loc, "20230101_071234_12_2439", "AnalyticMS_SR_harmonized"). Item ID and asset are None for other files.
+    loc = name.split("/")[0]
+    match = re.match(r"(20\d{6}_\d{6}\w*?)_(3B_.+|metadata\.json)$", name.split("/")[-1])
+    if not match:
+        return loc, None, None
+    asset = re.sub(r"(_clip_file_format|_clip)?\.(tif|json|xml)$", "", match.group(2))
+    return loc, match.group(1), re.sub(r"^3B_", "", asset)
+
+
+def refreshInventory(gcs_bucket, loc, max_age=None):
+    # Updates the index of gs://{gcs_bucket}/{loc}/ with one listing, unless it was listed less than max_age seconds ago.
+    # Only blobs that are new or have a new generation are written; blobs no longer listed are removed.
+    max_age = inventory_max_age if max_age is None else max_age
+    con = inventory_connection()
+    try:
+        listed = con.execute("SELECT listed FROM listings WHERE bucket = ? AND loc = ?", (gcs_bucket, loc)).fetchone()
+        if listed and time.time() - listed[0] < max_age:
+            return
+
+        known = dict(con.execute("SELECT name, generation FROM blobs WHERE bucket = ? AND loc = ?", (gcs_bucket, loc)))
+        seen, changed = set(), []
+        for blob in gcs_client().list_blobs(gcs_bucket, prefix=f"{loc}/", fields="items(name,generation,size),nextPageToken"):
+            seen.add(blob.name)
+            if known.get(blob.name) != blob.generation:
+                changed.append((gcs_bucket, blob.name, *parse_blob_name(blob.name), blob.generation, blob.size))
+        gone = [(gcs_bucket, name) for name in known if name not in seen]
+
+        with con:
+            con.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)", changed)
+            con.executemany("DELETE FROM blobs WHERE bucket = ? AND name = ?", gone)
+            con.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (gcs_bucket, loc, time.time()))
+        logger.debug(f"Inventory of {loc}: {len(seen)} blobs, {len(changed)} new or changed, {len(gone)} removed")
+    finally:
+        con.close()
+
+
+def inventoryBlobs(gcs_bucket, loc, max_age=None):
+    # Blobs under gs://{gcs_bucket}/{loc}/ as dicts (name, image_id, asset, generation, size), in listing order
+    refreshInventory(gcs_bucket, loc, max_age)
+    con = inventory_connection()
+    con.row_factory = sqlite3.Row
+    try:
+        rows = con.execute(
+            "SELECT name, image_id, asset, generation, size FROM blobs WHERE bucket = ? AND loc = ? ORDER BY name",
+            (gcs_bucket, loc),
+        ).fetchall()
+    finally:
+        con.close()
+    return [dict(row) for row in rows]
+
+
+def forgetInventoryBlob(gcs_bucket, name):
+    # Removes a deleted blob from the index
+    con = inventory_connection()
+    with con:
+        con.execute("DELETE FROM blobs WHERE bucket = ? AND name = ?", (gcs_bucket, name))
+    con.close()
+
+
+def invalidateInventory(gcs_bucket, loc):
+    # Makes the next inventoryBlobs call list the location again, e.g. after new orders were delivered to it
+    con = inventory_connection()
+    with con:
+        con.execute("DELETE FROM listings WHERE bucket = ? AND loc = ?", (gcs_bucket, loc))
+    con.close()
+
+
 # -------------------------------------------------------------------------------------------------------------------------------
 # UTILITY FUNCTIONS
 # -------------------------------------------------------------------------------------------------------------------------------
@@ -726,153 +917,230 @@ def checkRunningOrders(planet_api_key=None):
         logger.warning("Cannot check running orders: No Planet API key provided")
         return []
 
-    url = "https://api.planet.com/compute/ops/orders/v2?state=running&state=queued"
-    headers = {
-        "Authorization": f"api-key {planet_api_key}",
-        "Content-Type": "application/json"
-    }
-    orders = []
-    while url:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+    return list(runningOrders(planet_api_key).values())
+
+
+def runningOrders(planet_api_key):
+    # Location name of each running or queued order, by order ID, from one (paginated) listing
+    url = f"{order_url}?state=running&state=queued"
+    orders = {}
+    for data in planet_pages("GET", url, planet_api_key, next_key="next"):
         # Filter for only running or queued orders
-        filtered = [o['name'].split(' ')[0] for o in data.get('orders', []) if o.get('state') in ['running', 'queued']]
-        orders.extend(filtered)
-        url = data.get('_links', {}).get('next')
+        for o in data.get('orders', []):
+            if o.get('state') in ['running', 'queued']:
+                orders[o['id']] = o['name'].split(' ')[0]
     
     return orders
 
 
 def remove_overlapping_strings(list1, list2):
-    # checks for each of the strings in list1 whether it forms at least part of any of the strings in list2. We use it to filter out already downloaded imagery from the new set of tasks
-
-    return [string for string in list1 if string not in "|".join(list2)]
+    # keeps the product IDs of list1 that are not the Planet item ID of any of the files in list2. We use it to filter out already downloaded imagery from the new set of tasks
+    # (files whose name has no item ID are compared as a whole)
+    existing = {parse_blob_name(string)[1] or string for string in list2}
+    return [string for string in list1 if string not in existing]
+
+
+def partialDownloads(gcs_bucket, loc):
+    # Item IDs with some but not all of required_assets in gs://{gcs_bucket}/{loc}, with the assets they lack
+    assets = {}
+    for blob in inventoryBlobs(gcs_bucket, loc):
+        if blob["image_id"]:
+            assets.setdefault(blob["image_id"], set()).add(blob["asset"])
+    return {
+        image_id: sorted(required_assets - found)
+        for image_id, found in sorted(assets.items())
+        if required_assets - found
+    }
 
 
 def saveConvexHull(loc, locGroup):
-    storage_client = storage.Client()
-    bucketName = "mai_2023"
-    bucket = storage_client.get_bucket(bucketName)
+    # Saves the convex hull of a location to ./temp/Jsons/{loc}feature.geojson, taken from the geometry catalog
+    hull = catalogHull(loc, locGroup)
+    if hull is None:
+        # Database updates to mark location as failed due to missing GeoJSON
+        #updateLocationFileStatus(loc, "00DownStatus", "failed", replace=True)
+        #updateLocationFileStatus(loc, "00aDownNoSRStatus", "failed", replace=True)
+        #updateLocationFileStatus(loc, "notes", "missingGeoJSON", replace=True)
+        # In lieu of database updates, we raise an exception to indicate failure
+        raise Exception(
+            f"GeoJSON not found for {loc}. Check that it is uploaded to google storage correctly"
+        )
+
+    # Save the convex hull as a GeoJSON file
+    os.makedirs("./temp/Jsons", exist_ok=True)
+    with open(f"./temp/Jsons/{loc}feature.geojson", "w") as file:
+        json.dump(hull, file)
+
+    if os.path.isfile(f"./temp/Jsons/{loc}feature.geojson"):
+        logger.debug(f"GeoJSON saved successfully for {loc}")
+    else:
+        print(f"WARNING: GeoJSON failed to save for {loc}...")
+
+
+def loadConvexHull(loc, locGroup):
+    # Convex hull of a location as a GeoJSON feature, saved by saveConvexHull if it is not there yet
+    if not os.path.isfile(f"./temp/Jsons/{loc}feature.geojson"):
+        saveConvexHull(loc, locGroup)
+    with open(f"./temp/Jsons/{loc}feature.geojson") as f:
+        return json.loads(f.read())
+
+
+def convexHullFeature(feature):
+    # GeoJSON feature with the convex hull of a market geometry (polygons are kept as they are)
+    geometry = feature["geometry"]
+    shapely_geometry = shape(geometry)
+
+    if geometry["type"] == "MultiPolygon":
+        # Compute the convex hull for a MultiPolygon
+        convex_hull = shapely_geometry.convex_hull
+    else:
+        # Compute the convex hull for a Polygon
+        convex_hull = shapely_geometry
+
+    # Convert the convex hull to GeoJSON
+    return json.loads(geojson.dumps(geojson.Feature(geometry=convex_hull, properties={})))
+
+
+def geometry_catalog_connection():
+    os.makedirs(os.path.dirname(geometry_catalog_db) or ".", exist_ok=True)
+    con = sqlite3.connect(geometry_catalog_db)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS hulls (country TEXT, mktID TEXT, jsonID TEXT, feature TEXT, "
+        "minx REAL, miny REAL, maxx REAL, maxy REAL, PRIMARY KEY (country, mktID))"
+    )
+    con.execute("CREATE TABLE IF NOT EXISTS catalogs (country TEXT PRIMARY KEY, built REAL)")
+    return con
+
+
+def catalogCountry(locGroup):
+    # Catalogs are kept per country: the country code and country of locGroup (e.g. "79_Tigray_1" -> "79_Tigray")
+    return "_".join(locGroup.split("_")[:2])
+
+
+def buildGeometryCatalog(locGroup, MAX_WORKERS=10):
+    # Reads the market FeatureCollections of the country of locGroup from gs://mai_2023 once,
+    # and stores the convex hull of every market in the local geometry catalog
+    storage_client = gcs_client()
+    bucket = storage_client.bucket(bucketName)
     country = locGroup.split("_")[1]
     countryCode = locGroup.split("_")[0]
 
-    # pull a list of gcloud storage buckets, and find the names of the json outputs
-    output = str(
-        subprocess.check_output([f"gcloud storage ls gs://mai_2023/**"], shell=True)
-    )
-    jsonIDs = set(re.findall(rf"gs://mai_2023/((\d+_)?[A-Z]\w+(_\d+)?)/", output))
-    jsonIDs = [jsonID[0] for jsonID in jsonIDs]
+    # find the names of the json outputs among the top level folders of the bucket
+    folders = storage_client.list_blobs(bucketName, delimiter="/")
+    list(folders)  # the folder names are collected while iterating
     jsonIDs = [
+        match.group(1)
+        for prefix in folders.prefixes
+        if (match := re.match(r"((\d+_)?[A-Z]\w+(_\d+)?)/$", prefix))
+    ]
+    jsonIDs = sorted(
         ID
-        for ID in list(jsonIDs)
+        for ID in jsonIDs
         if (country in ID or (countryCode in ID and countryCode != ""))
-    ]
-
-    for jsonID in jsonIDs:
-        try:
-            data_string = bucket.get_blob(
-                f"{jsonID}/{jsonID}.geojson"
-            ).download_as_string()
-        except:
-            continue
-
-        data = json.loads(data_string)
-        for j in data["features"]:
-            mktID = j["properties"]["mktID"].replace(
-                ".", "_", 2
-            )  # fix name format of mktID
-
-            if mktID == loc:  # if this is the location we are looking for
-                dumped = json.dumps(j)  # dump feature json into string format
-                added = (
-                    '{"type": "FeatureCollection", "features": [{'
-                    + dumped[1:-1]
-                    + "}]}"
-                )  # add type classification to the string
-
-                # Create a GeoJSON string and load it as a Shapely geometry
-                geometry = geojson.loads(added)
-                geometry_type = geometry["features"][0]["geometry"]["type"]
-                shapely_geometry = shape(geometry["features"][0]["geometry"])
-
-                if geometry_type == "MultiPolygon":
-                    # Compute the convex hull for a MultiPolygon
-                    convex_hull = shapely_geometry.convex_hull
-                    convex_hull_geometry_type = "Polygon"
-                else:
-                    # Compute the convex hull for a Polygon
-                    convex_hull = shapely_geometry
-                    convex_hull_geometry_type = "Polygon"
-
-                # Convert the convex hull to GeoJSON
-                convex_hull_geojson = geojson.Feature(
-                    geometry=convex_hull, properties={}
-                )
-
-                # Save the convex hull as a GeoJSON file
-                with open(f"./temp/Jsons/{loc}feature.geojson", "w") as file:
-                    geojson.dump(convex_hull_geojson, file)
-
-                if os.path.isfile(f"./temp/Jsons/{loc}feature.geojson"):
-                    logger.debug(f"GeoJSON saved successfully for {loc}")
-                else:
-                    print(f"WARNING: GeoJSON failed to save for {loc}...")
-
-                return
-    # Database updates to mark location as failed due to missing GeoJSON
-    #updateLocationFileStatus(loc, "00DownStatus", "failed", replace=True)
-    #updateLocationFileStatus(loc, "00aDownNoSRStatus", "failed", replace=True)
-    #updateLocationFileStatus(loc, "notes", "missingGeoJSON", replace=True)
-    # In lieu of database updates, we raise an exception to indicate failure
-    raise Exception(
-        f"GeoJSON not found for {loc}. Check that it is uploaded to google storage correctly"
     )
 
+    def hulls(jsonID):
+        blob = bucket.get_blob(f"{jsonID}/{jsonID}.geojson")
+        if blob is None:
+            return []
+        data = json.loads(blob.download_as_string())
+        rows = []
+        for j in data["features"]:
+            mktID = j["properties"]["mktID"].replace(".", "_", 2)  # fix name format of mktID
+            hull = convexHullFeature(j)
+            rows.append((catalogCountry(locGroup), mktID, jsonID, json.dumps(hull), *shape(hull["geometry"]).bounds))
+        return rows
 
-def deleteDuplicates_gcs(loc, gcs_bucket=None):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        rows = [row for jsonID_rows in executor.map(hulls, jsonIDs) for row in jsonID_rows]
+
+    con = geometry_catalog_connection()
+    with con:
+        con.execute("DELETE FROM hulls WHERE country = ?", (catalogCountry(locGroup),))
+        # the first collection (by name) listing a market wins
+        con.executemany("INSERT OR IGNORE INTO hulls VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        con.execute("INSERT OR REPLACE INTO catalogs VALUES (?, ?)", (catalogCountry(locGroup), time.time()))
+    con.close()
+    print(f"Geometry catalog for {catalogCountry(locGroup)}: {len(rows)} markets from {len(jsonIDs)} collections")
+
+
+def catalogHull(loc, locGroup):
+    # Convex hull of a location from the geometry catalog, building the catalog of its country if needed.
+    # A catalog older than geometry_catalog_max_age is rebuilt once if the location is not in it
+    con = geometry_catalog_connection()
+    built = con.execute("SELECT built FROM catalogs WHERE country = ?", (catalogCountry(locGroup),)).fetchone()
+    con.close()
+    if built is None:
+        buildGeometryCatalog(locGroup)
+
+    con = geometry_catalog_connection()
+    row = con.execute("SELECT feature FROM hulls WHERE country = ? AND mktID = ?", (catalogCountry(locGroup), loc)).fetchone()
+    con.close()
+    if row is None and built is not None and time.time() - built[0] > geometry_catalog_max_age:
+        buildGeometryCatalog(locGroup)
+        return catalogHull(loc, locGroup)
+    return json.loads(row[0]) if row else None
+
+
+def deleteDuplicates_gcs(loc, gcs_bucket=None, dry_run=False):
     """
     List all file names in a specific GCS folder (excluding paths), including subfolders.
-    If a file name is already in the list, delete the duplicate file from GCS.
+    Of files with the same name, keep the newest (highest generation, then the first path)
+    and delete the others from GCS in batch requests.
 
     Parameters:
     loc (str): The location identifier.
     gcs_bucket (str): The name of the GCS bucket containing the objects.
+    dry_run (bool): Only report what would be deleted.
+
+    Returns:
+    dict: number of files, duplicates deleted (or to delete) and bytes reclaimed.
     """
     if gcs_bucket is None or gcs_bucket == "":
         logger.warning(f"Cannot delete duplicates for {loc}: No GCS bucket provided")
         return
     
     try:
-        # Initialize the GCS client
-        client = storage.Client()
-        bucket = client.bucket(gcs_bucket)
-
-        # Set to track unique file names
-        unique_file_names = set()
-
-        # List blobs within the specified folder
-        blobs = client.list_blobs(gcs_bucket, prefix=loc)
+        # Group the blobs within the specified folder by file name (exclude path)
+        copies = {}
+        for blob in inventoryBlobs(gcs_bucket, loc):
+            copies.setdefault(blob["name"].split("/")[-1], []).append(blob)
+
+        duplicates = []
+        for blobs in copies.values():
+            blobs = sorted(blobs, key=lambda blob: (-(blob["generation"] or 0), blob["name"]))
+            duplicates.extend(blobs[1:])
+        report = {
+            "files": len(copies),
+            "duplicates": len(duplicates),
+            "bytes_reclaimed": sum(blob["size"] or 0 for blob in duplicates),
+        }
+        if dry_run or not duplicates:
+            logger.debug(f"Duplicates in folder {loc} of bucket {gcs_bucket}: {report}")
+            return report
 
-        for blob in blobs:
+        client = gcs_client("batch")
+        bucket = client.bucket(gcs_bucket)
+        deleted = 0
+        for i in range(0, len(duplicates), delete_batch_size):
+            chunk = duplicates[i : i + delete_batch_size]
             try:
-                # Extract the file name (exclude path)
-                file_name = blob.name.split("/")[-1]
-
-                if file_name in unique_file_names:
-                    # Duplicate detected, delete the blob
-                    logger.debug(f"Duplicate file detected and deleted: {blob.name}")
-                    blob.delete()
-                else:
-                    # Add the file name to the set
-                    unique_file_names.add(file_name)
-
+                with client.batch():
+                    for blob in chunk:
+                        bucket.blob(blob["name"], generation=blob["generation"]).delete()
+                deleted += len(chunk)
             except Exception as e:
-                logger.error(f"Failed to process object {blob.name}: {e}")
-
-        logger.debug(
-            f"Processed {len(unique_file_names)} unique files in folder {loc} of bucket {gcs_bucket}"
-        )
+                logger.error(f"Failed to delete a batch of duplicates of {loc}: {e}")
+            for blob in chunk:
+                forgetInventoryBlob(gcs_bucket, blob["name"])
+        if deleted < len(duplicates):
+            # list again to see which of the failed batches were deleted
+            invalidateInventory(gcs_bucket, loc)
+
+        report["duplicates"] = deleted
+        report["bytes_reclaimed"] = sum(blob["size"] or 0 for blob in duplicates[:deleted])
+        logger.debug(f"Processed {len(copies)} unique files in folder {loc} of bucket {gcs_bucket}: {report}")
+        return report
 
     except Exception as e:
         logger.error(f"Error processing folder {loc} in bucket {gcs_bucket}: {e}")
@@ -881,17 +1149,13 @@ def deleteDuplicates_gcs(loc, gcs_bucket=None):
 # Function to extract harmonized files and image IDs
 def extract_harmonized_files_and_ids(GCS_BUCKET, loc):
     # print('GCS bucket', GCS_BUCKET)
-    cloud_files = (
-        subprocess.check_output(["gsutil", "ls", "-r", GCS_BUCKET])
-        .decode("utf-8")
-        .splitlines()
-    )
+    # Extract bucket name from GCS_BUCKET path (e.g., "gs://bucket-name/location" -> "bucket-name")
+    bucket_name = GCS_BUCKET.split("/")[2]
+    cloud_files = [f"gs://{bucket_name}/{blob['name']}" for blob in inventoryBlobs(bucket_name, loc)]
     # print('cloud_files',cloud_files)
     harmonized_files = [
         file for file in cloud_files if "_SR_" in file and file.endswith(".tif")
     ]
-    # Extract bucket name from GCS_BUCKET path (e.g., "gs://bucket-name/location" -> "bucket-name")
-    bucket_name = GCS_BUCKET.split("/")[2]
     harmonized_files = [
         file.replace(f"gs://{bucket_name}/{loc}/", "").replace(
             "_clip_file_format.tif", ""
@@ -916,9 +1180,9 @@ def extract_harmonized_files_and_ids(GCS_BUCKET, loc):
     return harmonized_files, image_IDs
 
 
-def process_blob(blob_name, image_IDs, imageBucket):
+def process_blob(blob_name, image_id, imageBucket):
+    # Downloads the metadata json of one image and keeps the allowed properties. Returns None if that fails
     try:
-        image_id = [image_id for image_id in image_IDs if image_id in blob_name][0]
         blob = imageBucket.blob(blob_name)
         json_content = blob.download_as_text()
         json_data = json.loads(json_content)
@@ -932,55 +1196,108 @@ def process_blob(blob_name, image_IDs, imageBucket):
         filtered_properties["image_ID"] = image_id
         json_data["properties"] = filtered_properties
 
-        return json_data # Or return whatever you need
+        return json_data
     except Exception as e:
         print(f"Error processing blob {blob_name}: {e}")
-        return None, None
-
-
-def process_json_files(loc, gcs_bucket=None, MAX_WORKERS=10):
+        return None
+
+
+def bounded_map(fn, items, max_workers, max_pending=None):
+    # Yields fn(item) for all items in completion order, with at most max_pending calls submitted at a time
+    max_pending = max_pending or 2 * max_workers
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(fn, item) for item in itertools.islice(items, max_pending)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+            pending |= {executor.submit(fn, item) for item in itertools.islice(items, len(done))}
+
+
+def properties_schema():
+    # Arrow schema of the image property table: the columns of create_geojson, the image ID, the
+    # system:index used by the activity step to identify images, and the footprint as GeoJSON
+    types = {"String": pa.string(), "Integer": pa.int64(), "Float": pa.float64()}
+    columns = [(name, types[kind]) for name, kind in create_geojson([])["columns"].items()]
+    return pa.schema([("image_ID", pa.string()), ("system:index", pa.string())] + columns + [("geometry", pa.string())])
+
+
+def property_row(json_data, schema):
+    # Flattens a filtered metadata json into a row of the property table
+    props = json_data["properties"]
+    row = {name: props.get(name) for name in schema.names}
+    row["system:index"] = f"{props['image_ID']}_3B_AnalyticMS_SR_harmonized"  # as in the GEE image collection
+    row["geometry"] = json.dumps(json_data["geometry"]) if json_data.get("geometry") else None
+    for name in schema.names:
+        if row[name] is not None and pa.types.is_integer(schema.field(name).type):
+            row[name] = int(row[name])
+        elif row[name] is not None and pa.types.is_floating(schema.field(name).type):
+            row[name] = float(row[name])
+    return row
+
+
+def process_json_files(loc, gcs_bucket=None, MAX_WORKERS=10, table_path=None, batch_size=500):
+    # Adds the properties of the images of a location that are not in its property table yet to the table
+    # (Parquet, by default {metadata_table_dir}/{loc}.parquet). Metadata jsons are fetched by at most MAX_WORKERS
+    # threads and written in batches of batch_size rows, so memory does not grow with the number of images.
+    # The table can be read by prepare_properties of the activity step (kind='metadata').
+    # Returns the path of the table and the number of images added
     if gcs_bucket is None or gcs_bucket == "":
         logger.warning(f"Cannot process JSON files for {loc}: No GCS bucket provided")
-        return [], []
-    
+        return None, 0
+
+    table_path = table_path or os.path.join(metadata_table_dir, f"{loc}.parquet")
+    schema = properties_schema()
+    done = set()
+    if os.path.isfile(table_path):
+        done = set(pq.read_table(table_path, columns=["image_ID"]).column("image_ID").to_pylist())
+
     _, image_IDs = extract_harmonized_files_and_ids(f"gs://{gcs_bucket}/{loc}", loc)
-    # print('image_IDs',image_IDs)
-    client = storage.Client()
-    imageBucket = client.bucket(gcs_bucket)
-    blobs = list(imageBucket.list_blobs(prefix=f"{loc}"))
-    # print('blobs',blobs)
-    # filter blobs that end with '_metadata.json'
-    filenames = [f"{image_id}_metadata.json" for image_id in image_IDs]
+    imageBucket = gcs_client().bucket(gcs_bucket)
+    # image ID of each metadata json, by file name
+    id_by_filename = {f"{image_id}_metadata.json": image_id for image_id in image_IDs if image_id and image_id not in done}
     metadata_blobs = [
-        blob.name for blob in blobs if blob.name.split("/")[-1] in filenames
+        (blob["name"], id_by_filename[blob["name"].split("/")[-1]])
+        for blob in inventoryBlobs(gcs_bucket, loc)
+        if blob["name"].split("/")[-1] in id_by_filename
     ]
-    # print('metadata_blobs',metadata_blobs)
-    print(f"Processing {len(metadata_blobs)} metadata jsons for {loc}.")
-
-    features = []
+    print(f"Processing {len(metadata_blobs)} new metadata jsons for {loc} ({len(done)} already in the table).")
+    if not metadata_blobs:
+        return table_path, 0
+
+    # rows of the existing table are copied first, new rows are appended as they arrive
+    os.makedirs(os.path.dirname(table_path) or ".", exist_ok=True)
+    added, rows = 0, []
+    with pq.ParquetWriter(table_path + ".tmp", schema) as writer:
+        if done:
+            for batch in pq.ParquetFile(table_path).iter_batches():
+                writer.write_batch(batch)
+        fetch = lambda item: process_blob(item[0], item[1], imageBucket)
+        for json_data in bounded_map(fetch, metadata_blobs, MAX_WORKERS):
+            if json_data:
+                rows.append(property_row(json_data, schema))
+            if len(rows) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                added, rows = added + len(rows), []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            added += len(rows)
+    os.replace(table_path + ".tmp", table_path)
+
+    return table_path, added
+
+
+def table_features(table_path):
+    # GeoJSON features of the images in a property table, as produced by process_blob
     features_json = []
-
-    # I/O-bound operations
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # submit all tasks
-        future_to_blob = {
-            executor.submit(process_blob, blob_name, image_IDs, imageBucket): blob_name
-            for blob_name in metadata_blobs
-        }
-
-        # as each task completes, collect the result
-        for future in as_completed(future_to_blob):
-            blob_name = future_to_blob[future]
-            try:
-                json_data, feature = future.result()
-                if json_data:
-                    features_json.append(json_data)
-                if feature:
-                    features.append(features)
-            except Exception as exc:
-                print(f"{blob_name} generated an exception: {exc}")
-
-    return features_json, features
+    for batch in pq.ParquetFile(table_path).iter_batches():
+        for row in batch.to_pylist():
+            geometry = row.pop("geometry")
+            row.pop("system:index")
+            properties = {k: v for k, v in row.items() if v is not None}
+            features_json.append({"type": "Feature", "geometry": json.loads(geometry) if geometry else None, "properties": properties})
+    return features_json
 
 
 # Function to create the GeoJSON structure
@@ -0,0 +1,400 @@
+import re, json, time, uuid, random, hashlib, threading
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote, unquote
+
+# -------------------------------------------------------------------------------------------------------------------------------
+# LOCAL STAND-IN FOR THE PLANET AND GCS APIS
+#
+# Serves the parts of the Planet Data API (quick-search), the Planet Orders API (v2) and the GCS JSON API that
+# download_imagery uses, from memory, so that the download flow can be run and timed without credentials
+# (see benchmark_downloader.py). Planet requests go to {url}/data/v1/quick-search and {url}/compute/ops/orders/v2;
+# the storage client is pointed at the server with STORAGE_EMULATOR_HOST={url}.
+# -------------------------------------------------------------------------------------------------------------------------------
+
+default_config = {
+    "latency": 0.0,             # seconds added to every response
+    "error_rate": 0.0,          # share of Planet requests answered with an error from error_codes
+    "error_codes": [429, 503],
+    "retry_after": 0,           # Retry-After header (seconds) sent with 429 responses
+    "scenes_per_loc": 1000,     # catalog size: scenes available for each searched geometry
+    "search_page_size": 250,    # features per quick-search page (pagination depth = scenes / page size)
+    "orders_page_size": 20,     # orders per page of the order listing
+    "order_seconds": 600.0,     # time an order stays queued/running before its files are delivered
+    "duplicate_rate": 0.0,      # share of delivered scenes that are delivered twice (redelivery)
+    "seed": 0,
+}
+
+
+class FakeServices:
+    # In-memory Planet catalog, orders and GCS buckets, with an HTTP server in a background thread.
+    # requests counts the requests per endpoint.
+
+    def __init__(self, **config):
+        self.config = dict(default_config, **config)
+        self.random = random.Random(self.config["seed"])
+        self.lock = threading.RLock()
+        self.buckets = {}  # bucket -> {name: {"data": bytes, "generation": int}}
+        self.orders = {}  # order id -> order
+        self.searches = {}  # search id -> matching scenes
+        self.requests = {}
+        self.generation = 0
+        self.server = None
+        self.clock = time.time  # clock of order processing, replaced by benchmark_downloader to skip its sleeps
+
+    # --- lifecycle ---------------------------------------------------------------------------------------------------------
+
+    def start(self, port=0):
+        services = self
+
+        class Handler(FakeHandler):
+            pass
+
+        Handler.services = services
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    # --- GCS objects -------------------------------------------------------------------------------------------------------
+
+    def put_object(self, bucket, name, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            self.generation += 1
+            self.buckets.setdefault(bucket, {})[name] = {"data": data, "generation": self.generation}
+            return self.object_resource(bucket, name)
+
+    def object_resource(self, bucket, name):
+        blob = self.buckets[bucket][name]
+        return {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "id": f"{bucket}/{name}/{blob['generation']}",
+            "generation": str(blob["generation"]),
+            "size": str(len(blob["data"])),
+            "contentType": "application/octet-stream",
+        }
+
+    def add_markets(self, bucket, jsonID, markets):
+        # Uploads a market FeatureCollection as read by saveConvexHull. markets: {mktID: (lon, lat)}
+        features = []
+        for mktID, (lon, lat) in markets.items():
+            square = [[lon - 0.01, lat - 0.01], [lon + 0.01, lat - 0.01], [lon + 0.01, lat + 0.01], [lon - 0.01, lat + 0.01], [lon - 0.01, lat - 0.01]]
+            features.append({"type": "Feature", "properties": {"mktID": mktID}, "geometry": {"type": "Polygon", "coordinates": [square]}})
+        self.put_object(bucket, f"{jsonID}/{jsonID}.geojson", json.dumps({"type": "FeatureCollection", "features": features}))
+
+    # --- Planet catalog ----------------------------------------------------------------------------------------------------
+
+    def scenes(self, coordinates):
+        # Deterministic catalog of a geometry
+        seed = int(hashlib.md5(json.dumps(coordinates).encode()).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        start = datetime(2016, 1, 1)
+        scenes = []
+        for i in range(self.config["scenes_per_loc"]):
+            acquired = start + timedelta(days=i * 3000 // max(self.config["scenes_per_loc"], 1), seconds=rng.randrange(25000, 40000))
+            scene_id = f"{acquired:%Y%m%d_%H%M%S}_{rng.randrange(10, 99)}_{rng.randrange(1000, 9999):04x}"
+            clear = rng.choice([100, 99, 98, 95, 90, 80, 60, 40])
+            properties = {
+                "acquired": acquired.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "cloud_cover": 0 if clear >= 95 else round(rng.random() * 0.6, 2),
+                "cloud_percent": 100 - clear,
+                "clear_percent": clear,
+                "clear_confidence_percent": max(clear - rng.randrange(0, 5), 0),
+                "anomalous_pixels": 0 if rng.random() < 0.9 else 1,
+                "ground_control": rng.random() < 0.8,
+                "instrument": "PS2" if acquired.year < 2020 else "PSB.SD",
+                "gsd": 3.9,
+                "view_angle": round(rng.random() * 5, 1),
+                "satellite_id": f"{rng.randrange(1000, 9999):04x}",
+                "visible_percent": clear,
+            }
+            scenes.append({
+                "id": scene_id,
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": coordinates},
+                "properties": properties,
+                "assets": ["ortho_analytic_4b", "ortho_analytic_4b_sr", "ortho_udm2"],
+                "_permissions": ["assets.ortho_analytic_4b_sr:download", "assets.ortho_udm2:download"],
+            })
+        return scenes
+
+    def matches(self, scene, filters):
+        # Evaluates the AndFilter of a search on a scene (geometry and asset filters always pass)
+        props = scene["properties"]
+        for f in filters:
+            config = f.get("config")
+            if f["type"] == "DateRangeFilter":
+                value = props[f["field_name"]]
+                if config.get("gte") and value < config["gte"].replace("Z", ""):
+                    return False
+                if config.get("lte") and value[:19] > config["lte"].replace("Z", "")[:19]:
+                    return False
+            elif f["type"] == "RangeFilter":
+                value = props.get(f["field_name"], 0)
+                if config.get("gte") is not None and value < config["gte"]:
+                    return False
+                if config.get("lte") is not None and value > config["lte"]:
+                    return False
+            elif f["type"] == "StringInFilter":
+                if str(props.get(f["field_name"])).lower() not in [str(c).lower() for c in config]:
+                    return False
+        return True
+
+    # --- Planet orders -----------------------------------------------------------------------------------------------------
+
+    def update_orders(self):
+        # Orders past their processing time are delivered to their bucket and marked success
+        now = self.clock()
+        with self.lock:
+            for order in self.orders.values():
+                if order["state"] in ("queued", "running") and now >= order["created"] + self.config["order_seconds"]:
+                    self.deliver(order)
+                    order["state"] = "success"
+                elif order["state"] == "queued" and now >= order["created"] + self.config["order_seconds"] / 2:
+                    order["state"] = "running"
+
+    def deliver(self, order):
+        delivery = order["payload"]["delivery"]["google_cloud_storage"]
+        bucket, prefix = delivery["bucket"], delivery["path_prefix"]
+        for item_id in order["payload"]["products"][0]["item_ids"]:
+            for copy in range(2 if self.random.random() < self.config["duplicate_rate"] else 1):
+                folder = f"{prefix}/{order['id'] if copy == 0 else order['id'] + '-redelivery'}/PSScene"
+                self.put_object(bucket, f"{folder}/{item_id}_3B_AnalyticMS_SR_harmonized_clip_file_format.tif", b"\0" * 64)
+                self.put_object(bucket, f"{folder}/{item_id}_3B_udm2_clip_file_format.tif", b"\0" * 16)
+                metadata = {"id": item_id, "type": "Feature", "geometry": {"type": "Point", "coordinates": [0, 0]},
+                            "properties": {"acquired": f"{item_id[:4]}-{item_id[4:6]}-{item_id[6:8]}T00:00:00Z", "clear_percent": 90,
+                                           "cloud_percent": 10, "instrument": "PSB.SD", "gsd": 3.9}}
+                self.put_object(bucket, f"{folder}/{item_id}_metadata.json", json.dumps(metadata))
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    services = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    # --- helpers -----------------------------------------------------------------------------------------------------------
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send(self, status, payload=None, headers=None, raw=None, content_type="application/json"):
+        data = raw if raw is not None else (json.dumps(payload).encode() if payload is not None else b"")
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def injected_error(self):
+        # Randomly answers a Planet request with an error, as configured
+        config = self.services.config
+        with self.services.lock:
+            fail = self.services.random.random() < config["error_rate"]
+            code = self.services.random.choice(config["error_codes"])
+        if fail:
+            self.body()  # read the request body, or it stays on the keep-alive connection and is parsed as the next request
+            self.services.count(f"planet_error_{code}")
+            self.send(code, {"message": "injected error"}, {"Retry-After": str(config["retry_after"])} if code == 429 else None)
+        return fail
+
+    def route(self, method):
+        time.sleep(self.services.config["latency"])
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path
+        if path.startswith("/data/v1/") or path.startswith("/compute/ops/orders/v2"):
+            if self.injected_error():
+                return
+            return self.planet(method, path, query)
+        return self.gcs(method, path, query)
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    # --- Planet ------------------------------------------------------------------------------------------------------------
+
+    def planet(self, method, path, query):
+        services = self.services
+        if method == "POST" and path == "/data/v1/quick-search":
+            services.count("planet_search")
+            search = json.loads(self.body())
+            filters = search["filter"]["config"]
+            coordinates = filters[0]["config"]["coordinates"]
+            features = [scene for scene in services.scenes(coordinates) if services.matches(scene, filters[1:])]
+            search_id = uuid.uuid4().hex
+            with services.lock:
+                services.searches[search_id] = features
+            return self.search_page(search_id, 0)
+        if method == "GET" and path.startswith("/data/v1/searches/"):
+            services.count("planet_search_page")
+            search_id = path.split("/")[4]
+            return self.search_page(search_id, int(query.get("_page", ["0"])[0]))
+
+        services.update_orders()
+        if method == "POST" and path == "/compute/ops/orders/v2":
+            services.count("planet_order")
+            payload = json.loads(self.body())
+            items = payload["products"][0]["item_ids"]
+            if len(items) <= 1:
+                return self.send(400, {"field": {"Details": [{"message": "Unable to accept order: Cannot coregister single item. "}]}})
+            order = {"id": uuid.uuid4().hex, "name": payload["name"], "state": "queued", "created": services.clock(), "payload": payload}
+            with services.lock:
+                services.orders[order["id"]] = order
+            return self.send(202, {"id": order["id"], "name": order["name"], "state": "queued"})
+        if method == "GET" and path == "/compute/ops/orders/v2":
+            services.count("planet_order_list")
+            states = query.get("state", [])
+            with services.lock:
+                orders = [
+                    {"id": o["id"], "name": o["name"], "state": o["state"]}
+                    for o in services.orders.values()
+                    if not states or o["state"] in states
+                ]
+            page = int(query.get("_page", ["0"])[0])
+            size = services.config["orders_page_size"]
+            links = {}
+            if (page + 1) * size < len(orders):
+                links["next"] = f"{services.url}/compute/ops/orders/v2?{'&'.join('state=' + s for s in states)}&_page={page + 1}"
+            return self.send(200, {"orders": orders[page * size : (page + 1) * size], "_links": links})
+        return self.send(404, {"message": f"unknown Planet endpoint {method} {path}"})
+
+    def search_page(self, search_id, page):
+        services = self.services
+        with services.lock:
+            features = services.searches[search_id]
+        size = services.config["search_page_size"]
+        links = {}
+        if (page + 1) * size < len(features):
+            links["_next"] = f"{services.url}/data/v1/searches/{search_id}/results?_page={page + 1}"
+        return self.send(200, {"type": "FeatureCollection", "features": features[page * size : (page + 1) * size], "_links": links})
+
+    # --- GCS ---------------------------------------------------------------------------------------------------------------
+
+    def gcs(self, method, path, query):
+        services = self.services
+        if method == "POST" and path.startswith("/batch/storage/v1"):
+            services.count("gcs_batch")
+            return self.gcs_batch()
+        if method == "POST" and (match := re.match(r"^/upload/storage/v1/b/([^/]+)/o$", path)):
+            services.count("gcs_upload")
+            return self.gcs_upload(match.group(1), query)
+
+        download = path.startswith("/download/")
+        path = path[len("/download"):] if download else path
+        if match := re.match(r"^/storage/v1/b/([^/]+)/o/(.+)$", path):
+            bucket, name = match.group(1), unquote(match.group(2))
+            with services.lock:
+                exists = name in services.buckets.get(bucket, {})
+                if method == "DELETE":
+                    services.count("gcs_delete")
+                    if exists:
+                        del services.buckets[bucket][name]
+                    return self.send(204 if exists else 404, None if exists else {"error": {"code": 404}})
+                if not exists:
+                    services.count("gcs_get")
+                    return self.send(404, {"error": {"code": 404, "message": "No such object"}})
+                if download or query.get("alt") == ["media"]:
+                    services.count("gcs_download")
+                    return self.send(200, raw=services.buckets[bucket][name]["data"], content_type="application/octet-stream")
+                services.count("gcs_get")
+                return self.send(200, services.object_resource(bucket, name))
+        if match := re.match(r"^/storage/v1/b/([^/]+)/o$", path):
+            services.count("gcs_list")
+            return self.gcs_list(match.group(1), query)
+        if match := re.match(r"^/storage/v1/b/([^/]+)$", path):
+            services.count("gcs_get_bucket")
+            return self.send(200, {"kind": "storage#bucket", "name": match.group(1), "id": match.group(1)})
+        return self.send(404, {"error": {"code": 404, "message": f"unknown GCS endpoint {method} {path}"}})
+
+    def gcs_list(self, bucket, query):
+        prefix = query.get("prefix", [""])[0]
+        delimiter = query.get("delimiter", [None])[0]
+        start = int(query.get("pageToken", ["0"])[0])
+        size = int(query.get("maxResults", ["1000"])[0])
+        with self.services.lock:
+            names = sorted(name for name in self.services.buckets.get(bucket, {}) if name.startswith(prefix))
+            items, prefixes = [], set()
+            for name in names:
+                rest = name[len(prefix):]
+                if delimiter and delimiter in rest:
+                    prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+                else:
+                    items.append(self.services.object_resource(bucket, name))
+        response = {"kind": "storage#objects", "items": items[start : start + size], "prefixes": sorted(prefixes)}
+        if start + size < len(items):
+            response["nextPageToken"] = str(start + size)
+        return self.send(200, response)
+
+    def gcs_upload(self, bucket, query):
+        body = self.body()
+        if query.get("uploadType") == ["multipart"]:
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            parts = list(message.iter_parts())
+            metadata = json.loads(parts[0].get_content())
+            data = parts[1].get_payload(decode=True)
+            name = metadata.get("name") or query.get("name", [""])[0]
+        else:
+            name, data = query.get("name", [""])[0], body
+        return self.send(200, self.services.put_object(bucket, name, data))
+
+    def gcs_batch(self):
+        # multipart/mixed batch of requests, answered with one part per request in the same order
+        body = self.body()
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        boundary = "batch_" + uuid.uuid4().hex
+        out = []
+        for i, part in enumerate(message.iter_parts()):
+            request_line = part.get_payload(decode=True).decode().split("\r\n")[0]
+            method, url = request_line.split(" ")[:2]
+            match = re.match(r"^(?:https?://[^/]+)?/storage/v1/b/([^/]+)/o/([^?]+)", url)
+            status, reason = 404, "Not Found"
+            if method == "DELETE" and match:
+                bucket, name = match.group(1), unquote(match.group(2))
+                with self.services.lock:
+                    if name in self.services.buckets.get(bucket, {}):
+                        del self.services.buckets[bucket][name]
+                        status, reason = 204, "No Content"
+                self.services.count("gcs_delete")
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{i + 1}>\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=UTF-8\r\nContent-Length: 2\r\n\r\n{{}}\r\n"
+            )
+        raw = ("".join(out) + f"--{boundary}--\r\n").encode()
+        return self.send(200, raw=raw, content_type=f"multipart/mixed; boundary={boundary}")
+
+
+def object_url(services, bucket, name):
+    # Public URL of an object of the fake GCS, e.g. for debugging
+    return f"{services.url}/download/storage/v1/b/{bucket}/o/{quote(name, safe='')}?alt=media"
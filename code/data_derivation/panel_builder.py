@@ -0,0 +1,197 @@
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from region_assignment import merge_regions, region_layers, region_lookup_path, datasetsDir
+
+panelSource = 'gs://exports-mai2023/activity_cleaned_2024/df_{loc}.csv' # per-market activity outputs, {loc} is replaced by the market
+panelDir = os.path.join(datasetsDir, 'activity_panel') # Parquet dataset of all markets, partitioned by country/year
+panelWorkers = 8 # markets fetched at the same time
+panelMaxPending = 16 # markets fetched ahead of the writer, which bounds the memory of a build
+panelRowsPerGroup = 250000
+normYears = range(2018, 2024) # reference years of the activity_measure_norm_{year} columns harmonized by 01_importer.do
+newGenerationYear = 2021 # reference years from this one normalize the new generation (PSB.SD) images, earlier ones the PS2 images
+panelSchema = pa.schema([ # narrow schema of the panel: one row per image and active weekday of a market
+    ('Location', pa.string()),
+    ('image_id', pa.string()),
+    ('date', pa.date32()),
+    ('acquired', pa.timestamp('us', tz='UTC')),
+    ('month', pa.int8()),
+    ('weekday', pa.int8()),
+    ('weekdayThisAreaIsActive', pa.int8()),
+    ('mktDay', pa.int8()),
+    ('instrument', pa.string()),
+    ('clear_percent', pa.float32()),
+    ('diff_to_median_time', pa.float32()),
+    ('mkt_lat', pa.float64()),
+    ('mkt_lon', pa.float64()),
+    ('activity_metric', pa.string()),
+    ('activity_measure', pa.float64()),
+    ('activity_measure_norm', pa.float64()),
+] + [(f'activity_measure_norm_{year}', pa.float64()) for year in normYears] + [
+    ('country', pa.string()),
+    ('year', pa.int16()),
+])
+panelPartitioning = ds.partitioning(pa.schema([('country', pa.string()), ('year', pa.int16())]), flavor='hive')
+referenceYear = 2021 # year whose market days set the scale of activity_measure_norm
+
+def selected_areas(header): # area column selected for each market day, from the maxVar_s_{day}_maxpMax columns of the first row
+    areas = {}
+    for col in header.columns:
+        match = re.fullmatch(r'maxVar_s_(\d)_maxpMax(_1)?', col)
+        if match and pd.notna(header[col].iloc[0]):
+            areas[int(match.group(1))] = header[col].iloc[0].replace('maxpmax', 'maxpMax')
+    return areas
+
+def normalized_activity(df, ref_year):
+    # activity_measure less the mean of non-market days, in percent of the market day mean of ref_year, by detected area and
+    # instrument; defined for the images of the generation of ref_year (PS2 before newGenerationYear, the new generation from then)
+    keys = ['weekdayThisAreaIsActive', 'instrument']
+    year = pd.to_datetime(df['date']).dt.year
+    generation = (df['instrument'] == 'PS2') if ref_year < newGenerationYear else (df['instrument'] != 'PS2')
+    mean_nonmktday = df[generation & (df['mktDay'] == 0)].groupby(keys)['activity_measure'].mean().rename('mean_nonmktday')
+    mean0 = df['activity_measure'] - df[keys].join(mean_nonmktday, on=keys)['mean_nonmktday']
+    mean_mktday = mean0[generation & (df['mktDay'] == 1) & (year == ref_year)].groupby([df[k] for k in keys]).mean().rename('mean_mktday')
+    return (100 * mean0 / df[keys].join(mean_mktday, on=keys)['mean_mktday']).where(generation)
+
+def read_market_output(loc, source=panelSource): # read the columns of a per-market output that the panel needs
+    path = source.format(loc=loc)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    # the area columns differ between markets: read the first row to find the selected ones, then only the needed columns
+    header = pd.read_csv(path, nrows=1)
+    keep = set(panelSchema.names) | {'ident'} | set(selected_areas(header).values())
+    return pd.read_csv(path, usecols=lambda col: col in keep or col.startswith('maxVar_s_'))
+
+def narrow_market_output(df, loc, country): # normalize a per-market output to panelSchema
+    df = df.rename(columns={'ident': 'image_id'})
+    areas = selected_areas(df)
+
+    # as in the export cell of postprocessing.ipynb, the activity of each market day is taken from its selected area and normalized again;
+    # outputs without the selected areas keep their activity_measure, and their activity_measure_norm if they have one
+    rederive = bool(areas)
+    if rederive:
+        df['activity_measure'] = np.nan
+        for market_day, target_var in areas.items():
+            df.loc[df['weekdayThisAreaIsActive'] == market_day, 'activity_measure'] = df[target_var]
+        df['activity_metric'] = df['weekdayThisAreaIsActive'].map(areas)
+
+    # zero on non-market days and scale by the market days of a reference year: referenceYear for activity_measure_norm,
+    # each of normYears for the per-year columns read by 01_importer.do
+    for col, ref_year in [('activity_measure_norm', referenceYear)] + [(f'activity_measure_norm_{year}', year) for year in normYears]:
+        if rederive or col not in df.columns:
+            df[col] = normalized_activity(df, ref_year)
+
+    out = pd.DataFrame(index=df.index)
+    for field in panelSchema:
+        out[field.name] = df[field.name] if field.name in df.columns else None
+    out['Location'] = loc
+    if country is not None or out['country'].isna().all():
+        out['country'] = country
+    out['date'] = pd.to_datetime(out['date']).dt.date
+    out['acquired'] = pd.to_datetime(out['acquired'], utc=True, errors='coerce', format='ISO8601')
+    out['year'] = pd.to_datetime(out['date']).dt.year
+    out = out.dropna(subset=['date'])
+    return pa.RecordBatch.from_pandas(out.reset_index(drop=True), schema=panelSchema, preserve_index=False)
+
+def fetch_market(market, source=panelSource): # read and narrow one market, returning the error instead of raising so one bad market does not stop the build
+    loc, country = market
+    try:
+        return loc, narrow_market_output(read_market_output(loc, source), loc, country), None
+    except Exception as e:
+        return loc, None, f'{type(e).__name__}: {e}'
+
+def iter_market_batches(markets, source=panelSource, n_workers=panelWorkers, max_pending=panelMaxPending):
+    # fetch markets in a thread pool and yield their record batches in input order,
+    # with at most max_pending markets fetched but not yet consumed
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        markets = iter(markets)
+        for market in markets:
+            pending.append(executor.submit(fetch_market, market, source))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def build_panel(markets, source=panelSource, out_dir=panelDir, n_workers=panelWorkers, max_pending=panelMaxPending):
+    # Build the activity panel of many markets as one Parquet dataset partitioned by country/year (e.g. out_dir/country=Ethiopia/year=2021/).
+    # markets: list of (loc, country) tuples
+    # source: path or URL template of the per-market outputs, csv or parquet (e.g. a local folder with df_{loc}.csv)
+    # Partitions of the countries and years being written are replaced, others are kept.
+    # Returns a dict of {loc: error message} for markets that failed.
+    problemLocs = {}
+    counts = {'markets': 0, 'rows': 0}
+
+    def batches():
+        for loc, batch, error in iter_market_batches(markets, source, n_workers, max_pending):
+            if error is not None:
+                print(f'problem with {loc}', error)
+                problemLocs[loc] = error
+                continue
+            counts['markets'] += 1
+            counts['rows'] += batch.num_rows
+            yield batch
+
+    os.makedirs(out_dir, exist_ok=True)
+    ds.write_dataset(
+        batches(), out_dir, schema=panelSchema, format='parquet', partitioning=panelPartitioning,
+        existing_data_behavior='delete_matching', basename_template='part-{i}.parquet',
+        min_rows_per_group=panelRowsPerGroup, max_rows_per_group=4 * panelRowsPerGroup,
+    )
+    print(f"{counts['markets']}/{len(markets)} markets written to {out_dir} ({counts['rows']} rows), {len(problemLocs)} failed")
+    return problemLocs
+
+def panel_dataset(panel_dir=panelDir):
+    return ds.dataset(panel_dir, format='parquet', partitioning=panelPartitioning, schema=panelSchema)
+
+def read_panel(panel_dir=panelDir, country=None, years=None, locs=None, columns=None): # read part of the panel, reading only the matching partitions and row groups
+    filter = None
+    for expr in [
+        ds.field('country') == country if country is not None else None,
+        ds.field('year').isin(list(years)) if years is not None else None,
+        ds.field('Location').isin(list(locs)) if locs is not None else None,
+    ]:
+        if expr is not None:
+            filter = expr if filter is None else filter & expr
+    return panel_dataset(panel_dir).to_table(columns=columns, filter=filter).to_pandas()
+
+def export_batch_csvs(dataset_name, panel_dir=None, out_dir=None, country=None, locs_per_batch=50, datasets_dir=datasetsDir):
+    # Write the panel (of a country) in the df_<dataset_name>_batchN.csv layout read by 01_importer.do, locs_per_batch markets per file,
+    # with the market coordinates as marketLat/marketLon, the admlvl1 region of each market from region_assignment and the
+    # activity_measure_norm_{year} columns of normYears that 01_importer.do harmonizes across the imagery generations.
+    # Markets are read batch by batch, so memory is bounded by one batch.
+    # datasets_dir: the datasets folder relative to the working directory; the panel (panel_dir), the batch files (out_dir),
+    # the shapefiles and the region lookup are found in it unless given
+    panel_dir = panel_dir or os.path.join(datasets_dir, 'activity_panel')
+    out_dir = out_dir or os.path.join(datasets_dir, 'activity_raw')
+    layers, lookup_path = region_layers(datasets_dir), region_lookup_path(datasets_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    locFilter = ds.field('country') == country if country is not None else None
+    locs = sorted(set(panel_dataset(panel_dir).to_table(columns=['Location'], filter=locFilter).column('Location').to_pylist()))
+
+    batch_files = []
+    for batch_counter, start in enumerate(range(0, len(locs), locs_per_batch)):
+        df = read_panel(panel_dir, country=country, locs=locs[start:start + locs_per_batch])
+        # 01_importer.do keeps mktid marketlat marketlon admlvl1 (Stata lowercases the names)
+        df['marketLat'], df['marketLon'] = df['mkt_lat'], df['mkt_lon']
+        parts = []
+        for part_country, part in df.groupby('country', sort=False, dropna=False):
+            if pd.isna(part_country): # regions are assigned by country, markets without one get none
+                parts.append(part.assign(admlvl1=None))
+            else:
+                parts.append(merge_regions(part, mkt_col='Location', country=part_country, path=lookup_path, layers=layers, columns=['admlvl1']))
+        df = pd.concat(parts, ignore_index=True)
+        df = df.sort_values(['Location', 'weekdayThisAreaIsActive', 'date'], kind='stable')
+        # Rearrange column order
+        new_order = ['Location', 'weekdayThisAreaIsActive']
+        df = df[new_order + [col for col in df.columns if col not in new_order]]
+        path = os.path.join(out_dir, f'df_{dataset_name}_batch{batch_counter}.csv')
+        df.to_csv(path, index=False)
+        print('saved batch', batch_counter, path)
+        batch_files.append(path)
+    return batch_files
@@ -0,0 +1,129 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+from activity_functions import mktID_coords
+from activity_loader import file_hash
+
+datasetsDir = os.path.join('..', 'datasets') # relative to the working directory, code/ as in the notebooks
+
+def region_layers(datasets_dir=datasetsDir): # polygon layers markets are assigned to: layer -> (shapefile, {attribute: output column})
+    shapefile_dir = os.path.join(datasets_dir, 'shapefiles')
+    equalpop_dir = os.path.join(datasets_dir, 'equal_pop_regions')
+    return {
+        'adm1': (os.path.join(shapefile_dir, 'Eth_Adm1.shp'), {'ADM1_NAME': 'admlvl1'}),
+        'adm2': (os.path.join(shapefile_dir, 'ethiopia_adm2', 'eth_adm2.shp'), {'shapeName': 'admlvl2', 'shapeID': 'adm2_shapeID'}),
+        'redrawnZones': (os.path.join(shapefile_dir, 'redrawnZonesDissolved_20211129.shp'), {'redrawnZon': 'redrawnZone'}),
+        'equalpop_1M': (os.path.join(equalpop_dir, 'subregions_maxpop_1M.shp'), {'region': 'region_equalpop_1M'}),
+        'equalpop_2_5M': (os.path.join(equalpop_dir, 'subregions_maxpop_2_5M.shp'), {'region': 'region_equalpop_2_5M'}),
+        'equalpop_5M': (os.path.join(equalpop_dir, 'subregions_maxpop_5M.shp'), {'region': 'region_equalpop_5M'}),
+    }
+
+def region_lookup_path(datasets_dir=datasetsDir): # one row per market with its region of every layer
+    return os.path.join(datasets_dir, 'market_regions.parquet')
+
+regionLayers = region_layers()
+regionLookupPath = region_lookup_path()
+_regionTrees = {} # layer -> (source hashes, polygons, STRtree), built once per session
+
+def layer_sources(path): # hashes of the files of a shapefile whose changes change the assignment
+    stem = os.path.splitext(path)[0]
+    return {ext: file_hash(stem + ext)['sha256'] for ext in ['.shp', '.dbf'] if os.path.isfile(stem + ext)}
+
+def region_tree(layer, layers=regionLayers): # polygons and STRtree of a layer, rebuilt only when its shapefile changed
+    path, _ = layers[layer]
+    sources = layer_sources(path)
+    if layer in _regionTrees and _regionTrees[layer][0] == sources:
+        return _regionTrees[layer][1], _regionTrees[layer][2]
+    gdf = gpd.read_file(path)
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(epsg=4326)
+    gdf = gdf.reset_index(drop=True)
+    tree = shapely.STRtree(gdf.geometry.values)
+    _regionTrees[layer] = (sources, gdf, tree)
+    return gdf, tree
+
+def assign_layer(points, layer, layers=regionLayers): # region of each point in one layer, as in geoinpoly
+    # id_<layer> is the 1-based row of the polygon, the _ID of shp2dta/geoinpoly; points outside all polygons get none
+    gdf, tree = region_tree(layer, layers)
+    point_idx, poly_idx = tree.query(points, predicate='intersects')
+    # a point on a shared border lies in several polygons: keep the first, as geoinpoly does
+    order = np.lexsort((poly_idx, point_idx))
+    point_idx, poly_idx = point_idx[order], poly_idx[order]
+    first = np.r_[True, point_idx[1:] != point_idx[:-1]]
+    match = np.full(len(points), -1)
+    match[point_idx[first]] = poly_idx[first]
+
+    found = match >= 0
+    ids = pd.array(match + 1, dtype='Int32')
+    ids[~found] = pd.NA
+    out = pd.DataFrame({f'id_{layer}': ids})
+    for attr, col in layers[layer][1].items():
+        values = gdf[attr].take(np.where(found, match, 0)).reset_index(drop=True)
+        if pd.api.types.is_integer_dtype(values):
+            values = values.astype('Int32')
+        out[col] = values.where(found)
+    return out
+
+def assign_regions(mktIDs, country='Ethiopia', layers=regionLayers): # regions of every layer for a list of markets
+    mktIDs = pd.Series(pd.unique(pd.Series(mktIDs).dropna()), dtype=object)
+    mkt_lat, mkt_lon = mktID_coords(mktIDs, country)
+    points = shapely.points(mkt_lon.to_numpy(), mkt_lat.to_numpy())
+    out = pd.DataFrame({'mktID': mktIDs, 'country': country, 'mkt_lat': mkt_lat, 'mkt_lon': mkt_lon})
+    for layer in layers:
+        assigned = assign_layer(points, layer, layers)
+        print(f'{layer}: {assigned.iloc[:, 0].notna().sum()}/{len(out)} markets assigned')
+        out = pd.concat([out, assigned], axis=1)
+    return out
+
+def read_region_lookup(path=regionLookupPath): # lookup table and the layer sources it was built from
+    if not os.path.isfile(path):
+        return None, {}
+    table = pq.read_table(path)
+    meta = table.schema.metadata or {}
+    sources = json.loads(meta.get(b'region_sources', b'{}'))
+    return table.to_pandas(), sources
+
+def build_region_lookup(mktIDs, country='Ethiopia', path=regionLookupPath, layers=regionLayers):
+    # Lookup table of the regions of every market, kept at path so later builds only assign markets that are new.
+    # Markets already in the table are assigned again only when a layer or its shapefile changed.
+    sources = {layer: layer_sources(layers[layer][0]) for layer in layers}
+    lookup, known_sources = read_region_lookup(path)
+    if lookup is not None and known_sources != sources:
+        print('region layers changed, assigning all markets again')
+        lookup = None
+
+    mktIDs = pd.unique(pd.Series(mktIDs).dropna())
+    if lookup is not None:
+        known = set(lookup.loc[lookup['country'] == country, 'mktID'])
+        new = [mktID for mktID in mktIDs if mktID not in known]
+    else:
+        new = list(mktIDs)
+    if not new:
+        return lookup
+
+    assigned = assign_regions(new, country, layers)
+    lookup = assigned if lookup is None else pd.concat([lookup, assigned], ignore_index=True)
+    lookup = lookup.sort_values(['country', 'mktID'], kind='stable').reset_index(drop=True)
+
+    table = pa.Table.from_pandas(lookup, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'region_sources': json.dumps(sources).encode()})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    pq.write_table(table, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    print(f'{len(new)} markets assigned, {len(lookup)} in {path}')
+    return lookup
+
+def merge_regions(df, mkt_col='mktID', country='Ethiopia', path=regionLookupPath, layers=regionLayers, columns=None):
+    # add the regions of each market to a frame (e.g. a panel read with read_panel, mkt_col='Location') from the lookup table
+    lookup = build_region_lookup(df[mkt_col].unique(), country, path, layers)
+    if lookup is None:
+        return df
+    lookup = lookup[lookup['country'] == country].drop(columns=['country', 'mkt_lat', 'mkt_lon'])
+    if columns is not None:
+        lookup = lookup[['mktID'] + list(columns)]
+    return df.merge(lookup.rename(columns={'mktID': mkt_col}), on=mkt_col, how='left')
@@ -0,0 +1,212 @@
+import os
+import re
+import csv
+import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow.csv as pacsv
+from scipy.spatial import cKDTree
+
+weatherDir = os.path.join('..', 'datasets', 'weather')
+rainCap = 400 # monthly precipitation (mm) from which values are capped, as in 02_mergeWeatherData.do
+rainCapUpper = 10000 # values above this are left as they are (same as the do file)
+maxCellDistanceKm = 100 # markets farther than this from every rain cell get no rainfall
+defaultLags = range(1, 9) # monthly lags L1precip..L8precip, as in 02_mergeWeatherData.do
+cloudColumns = { # candidate names of the columns of the clouds_at_markets exports, matched case-insensitively
+    'location': ['Location', 'mktID', 'loc'],
+    'date': ['date', 'dateCloud', 'day'],
+    'value': ['cloud_prob', 'cloud_probability', 'probability', 'mean'],
+}
+earthRadiusKm = 6371.0088
+_weatherStores = {} # stores loaded in this session, by (kind, country, weather_dir)
+
+# A store holds one variable as a dense (time x location) array:
+#   {'values': float32 array, 'locations': pd.Index of location keys, 'start': first time ordinal, 'freq': 'M' or 'D'}
+# Time ordinals are months since year 0 (year*12 + month-1) for 'M' and days since 1970-01-01 for 'D', so the row of a
+# date is its ordinal minus start, and a lookup of many (location, date) pairs is two integer index computations.
+
+def time_ordinals(dates, freq): # time ordinal of each date, see above
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    if freq == 'M':
+        return (dates.year * 12 + dates.month - 1).to_numpy(dtype=np.int64, na_value=-1)
+    return (dates.values.astype('datetime64[D]').astype(np.int64))
+
+def make_store(locations, ordinals, values, freq): # dense store from long (location, time ordinal, value) arrays
+    locIndex = pd.Index(pd.unique(locations))
+    start, stop = int(ordinals.min()), int(ordinals.max())
+    store = np.full((stop - start + 1, len(locIndex)), np.nan, dtype=np.float32)
+    store[ordinals - start, locIndex.get_indexer(locations)] = values
+    return {'values': store, 'locations': locIndex, 'start': start, 'freq': freq}
+
+def positions(store, locations, dates): # (row, column) of each (location, date) pair in a store, -1 where it has none
+    rows = time_ordinals(dates, store['freq']) - store['start']
+    cols = store['locations'].get_indexer(locations)
+    ok = (rows >= 0) & (rows < store['values'].shape[0]) & (cols >= 0)
+    return np.where(ok, rows, -1), np.where(ok, cols, -1)
+
+def take(values, pos): # values at positions, NaN where there is none
+    rows, cols = pos
+    ok = rows >= 0
+    out = np.full(len(rows), np.nan, dtype=values.dtype)
+    out[ok] = values[rows[ok], cols[ok]]
+    return out
+
+def lookup(store, locations, dates): # value of each (location, date) pair, NaN where the store has none
+    return take(store['values'], positions(store, locations, dates))
+
+def lagged(values, lag): # values of lag steps earlier on the time axis
+    out = np.full_like(values, np.nan)
+    if lag < values.shape[0]:
+        out[lag:] = values[:values.shape[0] - lag]
+    return out
+
+def rolling(values, window, how='sum', min_periods=None): # sum or mean over the last window steps (including the current one)
+    # computed from cumulative sums of the values and of their non-missing counts, so the cost does not depend on window
+    min_periods = window if min_periods is None else min_periods
+    present = ~np.isnan(values)
+    sums = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(np.where(present, values, 0), axis=0, dtype=np.float64)])
+    counts = np.concatenate([np.zeros((1, values.shape[1])), np.cumsum(present, axis=0)])
+    lower = np.maximum(np.arange(1, values.shape[0] + 1) - window, 0)
+    total = sums[1:] - sums[lower]
+    n = counts[1:] - counts[lower]
+    out = total if how == 'sum' else total / np.where(n > 0, n, 1)
+    return np.where(n >= min_periods, out, np.nan).astype(values.dtype)
+
+def find_columns(path, names): # actual names of the wanted columns of a csv, matched case-insensitively
+    with open(path, newline='', encoding='ISO-8859-2') as f:
+        header = next(csv.reader(f))
+    lower = {col.lower(): col for col in header}
+    return {name: lower.get(name.lower()) for name in names}
+
+def read_csv_columns(path, names): # only the wanted columns of a csv, renamed to the names asked for
+    cols = find_columns(path, names)
+    missing = [name for name, col in cols.items() if col is None]
+    if missing:
+        raise KeyError(f'{path} has no column {missing}')
+    table = pacsv.read_csv(path, read_options=pacsv.ReadOptions(encoding='ISO-8859-2'),
+                           convert_options=pacsv.ConvertOptions(include_columns=list(cols.values())))
+    return table.to_pandas().rename(columns={col: name for name, col in cols.items()})
+
+def read_all(paths, names, n_workers=None): # read many csvs in parallel
+    with ThreadPoolExecutor(max_workers=n_workers or min(len(paths), os.cpu_count() or 1)) as executor:
+        return list(executor.map(lambda path: read_csv_columns(path, names), paths))
+
+def clean_precipitation(meters): # meters to mm, capped as in 02_mergeWeatherData.do
+    mm = meters * 1000
+    return np.where((mm >= rainCap) & (mm <= rainCapUpper), rainCap, mm)
+
+def rain_months(dateRain): # YYYYMM (int or string) to time ordinals
+    dateRain = pd.Series(dateRain).astype(str).str[:6].astype(int)
+    return (dateRain // 100 * 12 + dateRain % 100 - 1).to_numpy()
+
+def load_rain_cells(country='Ethiopia', weather_dir=weatherDir, n_workers=None):
+    # Monthly precipitation of every rain cell, from {country}_rain_cell*of*_*.csv, as a store keyed by cell ID.
+    # The cells' coordinates are in store['cells'] (lat, lon by cell ID).
+    key = ('rain_cells', country, weather_dir)
+    if key not in _weatherStores:
+        paths = sorted(glob.glob(os.path.join(weather_dir, f'{country}_rain_cell*of*_*.csv')))
+        if not paths:
+            raise FileNotFoundError(f'no rain cell exports of {country} in {weather_dir}')
+        df = pd.concat(read_all(paths, ['lat', 'lon', 'dateRain', 'total_precipitation'], n_workers), ignore_index=True)
+        df = df.dropna(subset=['lon'])
+        cells = df[['lat', 'lon']].drop_duplicates().sort_values(['lat', 'lon']).reset_index(drop=True)
+        cells.index.name = 'cell_ID'
+        cellIDs = pd.MultiIndex.from_frame(cells).get_indexer(pd.MultiIndex.from_frame(df[['lat', 'lon']]))
+        store = make_store(cellIDs, rain_months(df['dateRain']), clean_precipitation(df['total_precipitation'].to_numpy()), 'M')
+        store['cells'] = cells
+        _weatherStores[key] = store
+    return _weatherStores[key]
+
+def load_rain_adm2(country='Ethiopia', weather_dir=weatherDir):
+    # Monthly precipitation of every admin-2 region (by shapeName), from {country}_rain_byadm2_*.csv
+    key = ('rain_adm2', country, weather_dir)
+    if key not in _weatherStores:
+        paths = sorted(glob.glob(os.path.join(weather_dir, f'{country}_rain_byadm2_*.csv')))
+        if not paths:
+            raise FileNotFoundError(f'no admin-2 rain exports of {country} in {weather_dir}')
+        df = read_csv_columns(paths[-1], ['shapeName', 'dateRain', 'mean'])
+        _weatherStores[key] = make_store(df['shapeName'].to_numpy(), rain_months(df['dateRain']), clean_precipitation(df['mean'].to_numpy()), 'M')
+    return _weatherStores[key]
+
+def load_cloud_prob(weather_dir=weatherDir, n_workers=None):
+    # Cloud probability at the markets from clouds_at_markets/cloud_prob_YYYY_MM.csv, by market and day
+    # (by market and month for exports without a date column)
+    key = ('cloud_prob', None, weather_dir)
+    if key not in _weatherStores:
+        paths = sorted(glob.glob(os.path.join(weather_dir, 'clouds_at_markets', 'cloud_prob_*.csv')))
+        if not paths:
+            raise FileNotFoundError(f'no cloud probability exports in {weather_dir}')
+
+        def read(path):
+            header = find_columns(path, sum(cloudColumns.values(), []))
+            cols = {role: next((header[c] for c in candidates if header[c]), None) for role, candidates in cloudColumns.items()}
+            if cols['location'] is None or cols['value'] is None:
+                raise KeyError(f'{path}: no location or cloud probability column among {cloudColumns}')
+            df = read_csv_columns(path, [c for c in cols.values() if c]).rename(columns={c: role for role, c in cols.items() if c})
+            if cols['date'] is None: # monthly export: the month is in the file name
+                year, month = map(int, re.search(r'cloud_prob_(\d{4})_(\d{2})', path).groups())
+                df['date'] = pd.Timestamp(year, month, 1)
+            return df, cols['date'] is None
+
+        with ThreadPoolExecutor(max_workers=n_workers or min(len(paths), os.cpu_count() or 1)) as executor:
+            parts = list(executor.map(read, paths))
+        freq = 'M' if all(monthly for _, monthly in parts) else 'D'
+        df = pd.concat([part for part, _ in parts], ignore_index=True).dropna(subset=['date'])
+        df = df.groupby(['location', pd.Series(time_ordinals(df['date'], freq), name='t')], sort=False)['value'].mean().reset_index()
+        _weatherStores[key] = make_store(df['location'].to_numpy(), df['t'].to_numpy(), df['value'].to_numpy(), freq)
+    return _weatherStores[key]
+
+def unit_vectors(lat, lon): # points on the unit sphere, whose straight-line (chord) distances order like great-circle ones
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def chord_to_km(chord):
+    return 2 * earthRadiusKm * np.arcsin(np.clip(chord / 2, 0, 1))
+
+def km_to_chord(km):
+    return 2 * np.sin(np.asarray(km) / (2 * earthRadiusKm))
+
+def nearest_cells(lat, lon, cells): # nearest rain cell of each point and its great-circle distance in km
+    chord, idx = cKDTree(unit_vectors(cells['lat'].to_numpy(), cells['lon'].to_numpy())).query(unit_vectors(lat, lon))
+    return cells.index.to_numpy()[idx], chord_to_km(chord)
+
+def guess_column(df, candidates):
+    lower = {col.lower(): col for col in df.columns}
+    return next((lower[c.lower()] for c in candidates if c.lower() in lower), None)
+
+def join_weather(df, country='Ethiopia', weather_dir=weatherDir, loc_col=None, date_col='date', lat_col=None, lon_col=None,
+                 adm2_col=None, lags=defaultLags, windows=(3, 6, 12), clouds=True):
+    # Attach weather to activity rows (e.g. from load_activity_raw or read_panel), with one vectorized lookup per variable:
+    # - precipitation (mm) of the month of each row, from the rain cell nearest to the market, and its cell_ID and km_to_cell
+    # - L{l}precip: precipitation l months earlier, for l in lags
+    # - precip_sum_{w}m / precip_mean_{w}m: over the last w months, for w in windows
+    # - precipitation_adm2: precipitation of the admin-2 region in adm2_col, if given
+    # - cloud_prob: cloud probability at the market on the date (or month) of the row, if clouds
+    # Column names default to those of the activity data (Location/mktid, mkt_lat/marketlat, mkt_lon/marketlon).
+    loc_col = loc_col or guess_column(df, ['Location', 'mktID'])
+    lat_col = lat_col or guess_column(df, ['mkt_lat', 'marketLat'])
+    lon_col = lon_col or guess_column(df, ['mkt_lon', 'marketLon'])
+    df = df.copy()
+    dates = pd.to_datetime(df[date_col])
+
+    rain = load_rain_cells(country, weather_dir)
+    markets = df[[loc_col, lat_col, lon_col]].drop_duplicates(loc_col)
+    cellIDs, km = nearest_cells(markets[lat_col].to_numpy(), markets[lon_col].to_numpy(), rain['cells'])
+    marketCells = pd.DataFrame({'cell_ID': np.where(km < maxCellDistanceKm, cellIDs, -1), 'km_to_cell': km}, index=markets[loc_col])
+    df['cell_ID'] = marketCells['cell_ID'].reindex(df[loc_col]).to_numpy()
+    df['km_to_cell'] = marketCells['km_to_cell'].reindex(df[loc_col]).to_numpy()
+
+    pos = positions(rain, df['cell_ID'], dates) # shared by all rain variables, since they have the same layout
+    df['precipitation'] = take(rain['values'], pos)
+    for lag in lags:
+        df[f'L{lag}precip'] = take(lagged(rain['values'], lag), pos)
+    for window in windows:
+        df[f'precip_sum_{window}m'] = take(rolling(rain['values'], window, 'sum'), pos)
+        df[f'precip_mean_{window}m'] = take(rolling(rain['values'], window, 'mean'), pos)
+
+    if adm2_col is not None:
+        df['precipitation_adm2'] = lookup(load_rain_adm2(country, weather_dir), df[adm2_col], dates)
+    if clouds:
+        df['cloud_prob'] = lookup(load_cloud_prob(weather_dir), df[loc_col], dates)
+    return df